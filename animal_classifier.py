@@ -0,0 +1,117 @@
+"""Map a music ``definition_score`` to the animal template of the card.
+
+The thresholds live in ``data/animal_thresholds.yaml`` (next to
+``genre_weights.yaml``) as an ascending list of ``max_score`` / ``animal``
+pairs plus a ``fallback`` for scores above the last bound.  A score maps
+to the first entry whose ``max_score`` it does not exceed, i.e. the same
+``<=`` ladder that used to be written out as ``if/elif`` in app.py; the
+lookup is a ``bisect`` over the bounds.
+
+The file's mtime is checked on every lookup, so edited thresholds are
+picked up without restarting workers.  An edit that does not validate
+is reported and the previous table stays in use.
+
+``classify_many`` scores whole NumPy arrays at once for offline
+re-scoring of listening histories.  Run ``python animal_classifier.py``
+to validate the table and list animals that have no template yet.
+"""
+import os
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+
+import numpy as np
+import yaml
+
+from template_store import template_path
+
+THRESHOLDS_PATH = os.getenv("ANIMAL_THRESHOLDS_PATH", "data/animal_thresholds.yaml")
+
+Classifier = namedtuple("Classifier", ["bounds", "animals", "fallback", "mtime_ns", "missing_templates"])
+
+_classifier = None
+_rejected_mtime_ns = None  # 検証に失敗した版は更新されるまで読み直さない
+_classifier_lock = threading.Lock()
+
+
+def load_classifier(path=THRESHOLDS_PATH):
+    """Read and validate a thresholds file; raises ValueError if it is malformed."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    with open(path, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+
+    entries = config.get("thresholds") or []
+    fallback = config.get("fallback")
+    if not entries or not fallback:
+        raise ValueError(f"{path}: 'thresholds' and 'fallback' are required")
+    try:
+        bounds = [float(entry["max_score"]) for entry in entries]
+        animals = [str(entry["animal"]) for entry in entries]
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"{path}: every threshold needs a numeric max_score and an animal ({error})")
+    if any(lower >= upper for lower, upper in zip(bounds, bounds[1:])):
+        raise ValueError(f"{path}: max_score must be strictly ascending")
+
+    # テンプレート未作成の動物は生成時に 404 になるので起動時に知らせる
+    missing = sorted({
+        animal for animal in animals + [str(fallback)]
+        if not os.path.exists(template_path(animal))
+    })
+    return Classifier(bounds, animals, str(fallback), mtime_ns, missing)
+
+
+def get_classifier(path=THRESHOLDS_PATH):
+    """Return the current table, reloading it when the file has changed."""
+    global _classifier, _rejected_mtime_ns
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError as error:
+        if _classifier is None:
+            raise
+        print(f"⚠️ Animal thresholds not readable, keeping the loaded table: {error}")
+        return _classifier
+
+    current = _classifier
+    if current is not None and mtime_ns in (current.mtime_ns, _rejected_mtime_ns):
+        return current
+    with _classifier_lock:
+        if _classifier is not None and mtime_ns in (_classifier.mtime_ns, _rejected_mtime_ns):
+            return _classifier
+        try:
+            loaded = load_classifier(path)
+        except (OSError, ValueError, yaml.YAMLError) as error:
+            if _classifier is None:
+                raise
+            print(f"⚠️ Animal thresholds reload failed, keeping the previous table: {error}")
+            _rejected_mtime_ns = mtime_ns
+            return _classifier
+        if loaded.missing_templates:
+            print(f"⚠️ Animals without a template: {', '.join(loaded.missing_templates)}")
+        print(f"✅ Animal thresholds loaded: {len(loaded.bounds)} entries")
+        _classifier = loaded
+        return loaded
+
+
+def classify(score, classifier=None):
+    """Return the animal for one score."""
+    classifier = classifier or get_classifier()
+    index = bisect_left(classifier.bounds, score)
+    return classifier.animals[index] if index < len(classifier.animals) else classifier.fallback
+
+
+def classify_many(scores, classifier=None):
+    """Return an array of animals for an array of scores."""
+    classifier = classifier or get_classifier()
+    names = np.array(classifier.animals + [classifier.fallback], dtype=object)
+    return names[np.searchsorted(classifier.bounds, np.asarray(scores), side="left")]
+
+
+if __name__ == "__main__":
+    table = load_classifier()
+    previous = float("-inf")
+    for bound, animal in zip(table.bounds, table.animals):
+        print(f"{previous:>10g} < score <= {bound:<10g} {animal}")
+        previous = bound
+    print(f"{previous:>10g} < score{'':14} {table.fallback}")
+    if table.missing_templates:
+        print(f"⚠️ Animals without a template: {', '.join(table.missing_templates)}")
@@ -1,48 +1,39 @@
 import base64
+import hashlib
+import hmac
 import os
 import random
 import requests
-from flask import Flask, request, redirect, jsonify, send_from_directory, render_template, session
+import http_client
+from flask import Flask, Response, request, redirect, jsonify, render_template, send_from_directory, session
 from spotipy import Spotify
 from spotipy.oauth2 import SpotifyOAuth
 from flask_session import Session
 import redis
+import threading
 import time
-import yaml
+from collections import OrderedDict
 from datetime import datetime, timezone
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont
+from PIL import Image
 from io import BytesIO
+from urllib.parse import urlsplit
 import json
-import numpy as np  # ✅ ノイズ生成に利用
 from decimal import Decimal
 import re
-
-def add_glitter_effect(base_image, glitter_density=0.009, blur=0.9, alpha=225):
-    """画像全体にグリッターを重ねる"""
-    width, height = base_image.size
-    glitter_layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(glitter_layer)
-
-    num_glitters = int(width * height * glitter_density)
-
-    for _ in range(num_glitters):
-        x = random.randint(0, width - 1)
-        y = random.randint(0, height - 1)
-        size = random.choice([6, 5, 2, 3])
-        color = random.choice([
-            (255, 255, 255, random.randint(150, 220)),  # 白
-            (255, 215, 0, random.randint(130, 200)),    # 金
-            (173, 216, 230, random.randint(120, 180)),  # 水色
-            (255, 182, 193, random.randint(120, 180)),  # ピンク
-        ])
-        draw.ellipse((x, y, x + size, y + size), fill=color)
-
-    glitter_layer = glitter_layer.filter(ImageFilter.GaussianBlur(blur))
-    combined = Image.alpha_composite(base_image.convert("RGBA"), glitter_layer)
-    return combined
-
-
-app = Flask(__name__)
+from animal_classifier import classify as classify_animal, get_classifier
+from cover_encoder import encode_cover
+from genre_index import genre_weight, get_genre_index
+from hologram import warm_layer_cache
+from listening_history import sync_recent_plays
+from template_store import get_template_data_uri, get_template_url, template_path
+import card_render
+import image_store
+import job_queue
+import spotify_tokens
+import static_assets
+
+app = Flask(__name__, static_folder=None)  # /static は serve_static が配信する
+app.jinja_env.globals["asset_url"] = static_assets.asset_url
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev_secret_key")
 
 # Redis + Flask-Session 設定
@@ -50,7 +41,8 @@ redis_client = redis.from_url(os.getenv("REDIS_URL"))
 app.config["SESSION_TYPE"] = "redis"
 app.config["SESSION_REDIS"] = redis_client
 app.config["SESSION_KEY_PREFIX"] = "spotify_session:"  # ✅ ユーザー単位で独立
-app.config["SESSION_COOKIE_NAME"] = "spotify_session_" + os.urandom(8).hex()
+# 複数プロセス（gunicorn の worker・ASGI サーバー）で同じセッションを読めるよう固定名にできる
+app.config["SESSION_COOKIE_NAME"] = os.getenv("SESSION_COOKIE_NAME") or "spotify_session_" + os.urandom(8).hex()
 app.config["SESSION_PERMANENT"] = True
 app.config["PERMANENT_SESSION_LIFETIME"] = 60 * 60 * 24 * 7 
 app.config["SESSION_USE_SIGNER"] = True
@@ -60,189 +52,848 @@ app.config["SESSION_COOKIE_SECURE"] = True  # ✅ HTTPS環境で安全に送信
 
 Session(app)
 
-try:
-    with open("data/genre_weights.yaml", "r", encoding="utf-8") as f:
-        genre_weights = yaml.safe_load(f)
-except Exception as e:
-    genre_weights = {}
-    print("⚠️ genre_weights.yaml の読み込みに失敗:", e)
+# ✅ ジャンル重みの索引を起動時に作成（以降は YAML 更新時に自動で作り直す）
+get_genre_index()
+
+# ✅ 動物のしきい値表を起動時に読み込んで検証（以降はファイル更新時に自動で再読み込み）
+get_classifier()
+
+# ✅ ワーカー起動時にホログラム用レイヤーを事前生成（例: "768x1024"）
+warm_layer_cache(os.getenv("HOLOGRAM_WARM_SIZES", ""))
 
 # ✅ Render環境変数から取得
 CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+REPLICATE_API_BASE = os.getenv("REPLICATE_API_BASE", "https://api.replicate.com/v1").rstrip("/")
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com/v1").rstrip("/")
+SPOTIFY_ACCOUNTS_BASE = os.getenv("SPOTIFY_ACCOUNTS_BASE", "https://accounts.spotify.com").rstrip("/")
+TEMPLATE_UPLOADS = os.getenv("TEMPLATE_UPLOADS", "1") == "1"
+# Replicate からの webhook を受けるための公開URLと署名シークレット（両方あれば webhook を使う）
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").rstrip("/")
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
 OWNER_SPOTIFY_ID = os.getenv("OWNER_SPOTIFY_ID")
-GALLERY_INDEX_KEY = "music_monster:gallery:index"
+GALLERY_INDEX_KEY = "music_monster:gallery:index"  # 旧形式（LPUSH のリスト）。起動時に移行する
+GALLERY_TIMELINE_KEY = "music_monster:gallery:timeline"
 GALLERY_CARD_PREFIX = "music_monster:gallery:card:"
+GALLERY_EVENTS_CHANNEL = "music_monster:gallery:events"
 SOURCE_TRACKS_PREFIX = "music_monster:source_tracks:"
 SOURCE_PLAYLIST_PREFIX = "music_monster:source_playlist:"
-GALLERY_MAX_ITEMS = 6
+CARD_RESULT_PREFIX = "music_monster:card_result:"
+RENDER_LOCK_PREFIX = "music_monster:render_lock:"
+CARD_STATUS_PREFIX = "music_monster:card_status:"
+CARD_SPEC_PREFIX = "music_monster:card_spec:"
+PREDICTION_PREFIX = "music_monster:prediction:"
+CARD_EVENTS_PREFIX = "music_monster:card_events:"
+WEBHOOK_SEEN_PREFIX = "music_monster:webhook_seen:"
+RENDER_SECONDS_KEY = "music_monster:render_seconds"  # worker が測った1枚あたりの仕上げ時間
+CARD_QUEUE = "cards"
+PLAYLIST_QUEUE = "playlists"
+CLEANUP_QUEUE = "cleanup"
+ARTIST_INFO_PREFIX = "artist_info:"
+GALLERY_PAGE_SIZE = 6  # トップページに並べる枚数
+GALLERY_PAGE_MAX = 48
+GALLERY_RETENTION_ITEMS = int(os.getenv("GALLERY_RETENTION_ITEMS", "5000"))  # カードと画像を残す枚数
+GALLERY_PLAYLIST_RETENTION_ITEMS = int(os.getenv("GALLERY_PLAYLIST_RETENTION_ITEMS", "50"))  # プレイリストを残す枚数
+GALLERY_CACHE_SECONDS = 30  # pub/sub が届かない場合でもこの秒数で読み直す
+GALLERY_PAGE_CACHE_SIZE = 64
+ARTIST_INFO_TTL = 86400
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "50"))  # スコア計算に使う直近の再生数
+SPOTIFY_ARTISTS_BATCH_SIZE = 50  # Spotify の /artists は1回50件まで
+CARD_RESULT_TTL = 60 * 60 * 24 * 7
+RENDER_LOCK_TTL = 180  # gunicorn の --timeout に合わせる
+RENDER_SECONDS_TTL = 60 * 60 * 24
+# cards キューの待ち＋実行中がこの数に達したら /generate_api は 503 + Retry-After を返す（0 = 無制限）
+FINISH_BACKLOG_MAX = int(os.getenv("FINISH_BACKLOG_MAX") or 16 * card_render.RENDER_PROCESSES)
+CARD_STATUS_TTL = 60 * 60 * 24
+WEBHOOK_TOLERANCE_SECONDS = 5 * 60
+PREDICTION_RECONCILE_SECONDS = 120  # webhook が届かないときに Replicate へ確認しに行く間隔
+TERMINAL_PREDICTION_STATUSES = ("succeeded", "failed", "canceled")
+FINAL_CARD_STATUSES = ("succeeded", "failed")
+# プレイリストはカードを返した後に作る: pending → ready / failed
+PLAYLIST_PENDING, PLAYLIST_READY, PLAYLIST_FAILED = "pending", "ready", "failed"
+STATUS_STREAM_SECONDS = 120  # SSE 1本あたりの最大保持時間（ブラウザが自動で再接続する）
+STATUS_KEEPALIVE_SECONDS = 15
+LONG_POLL_MAX_SECONDS = 25
+
+
+# カーソル（スコア:ID）より古いカードを limit 件、JSON 配列1つにまとめて返す
+# 取得は O(log N + limit)。同じスコアのカードはメンバーの逆辞書順に並ぶ
+# カードのキーは読んだ ID と ARGV[4] の prefix から組み立てる（KEYS 外）ので単一ノード前提
+_READ_GALLERY_PAGE_SCRIPT = """
+local max_score, cursor_id, limit = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local ids, scores = {}, {}
+local offset = 0
+while #ids <= limit do
+    local rows = redis.call("zrevrangebyscore", KEYS[1], max_score, "-inf", "WITHSCORES", "LIMIT", offset, limit + 1)
+    if #rows == 0 then
+        break
+    end
+    for i = 1, #rows, 2 do
+        if cursor_id == "" or tonumber(rows[i + 1]) < tonumber(max_score) or rows[i] < cursor_id then
+            table.insert(ids, rows[i])
+            table.insert(scores, rows[i + 1])
+        end
+    end
+    offset = offset + #rows / 2
+end
+local cards = {}
+local count = math.min(#ids, limit)
+for i = 1, count do
+    local card = redis.call("get", ARGV[4] .. ids[i])
+    if card then
+        table.insert(cards, card)
+    end
+end
+local next_cursor = ""
+if #ids > limit then
+    next_cursor = scores[count] .. ":" .. ids[count]
+end
+return {next_cursor, "[" .. table.concat(cards, ",") .. "]"}
+"""
+
+_gallery_pages = OrderedDict()  # (cursor, limit) -> ページ（本文・ETag 付き）
+_gallery_cache = {"generation": 0}
+_gallery_cache_lock = threading.Lock()
+_gallery_listener_started = False
+
+
+def invalidate_gallery_cache():
+    with _gallery_cache_lock:
+        _gallery_pages.clear()
+        _gallery_cache["generation"] += 1
+
+
+def _listen_gallery_events():
+    """Drop the in-process gallery pages whenever any process changes the gallery."""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(GALLERY_EVENTS_CHANNEL)
+            # 再接続までの間に更新されていた可能性があるので一度捨てる
+            invalidate_gallery_cache()
+            for _ in pubsub.listen():
+                invalidate_gallery_cache()
+        except Exception as error:
+            print(f"⚠️ Gallery event listener error: {error}")
+            time.sleep(GALLERY_CACHE_SECONDS)
+
+
+def _start_gallery_listener():
+    global _gallery_listener_started
+    with _gallery_cache_lock:
+        if _gallery_listener_started:
+            return
+        _gallery_listener_started = True
+    threading.Thread(target=_listen_gallery_events, daemon=True).start()
 
 
-def get_public_gallery(limit=GALLERY_MAX_ITEMS):
-    """Return the newest generated cards that are safe to show publicly."""
+def migrate_gallery_index():
+    """Move cards from the old LPUSH list index into the time-ordered sorted set."""
     try:
-        prediction_ids = redis_client.lrange(GALLERY_INDEX_KEY, 0, limit - 1)
-        cards = []
-        for prediction_id in prediction_ids:
-            if isinstance(prediction_id, bytes):
-                prediction_id = prediction_id.decode("utf-8")
-            value = redis_client.get(f"{GALLERY_CARD_PREFIX}{prediction_id}")
-            if value:
-                if isinstance(value, bytes):
-                    value = value.decode("utf-8")
-                cards.append(json.loads(value))
-        return cards
+        legacy_ids = redis_client.lrange(GALLERY_INDEX_KEY, 0, -1)
+        if not legacy_ids:
+            return
+        now_ms = int(time.time() * 1000)
+        # リストは新しい順なので、先頭ほど大きいスコアを付けて順序を保つ
+        redis_client.zadd(GALLERY_TIMELINE_KEY, {
+            (pid.decode("utf-8") if isinstance(pid, bytes) else pid): now_ms - rank
+            for rank, pid in enumerate(legacy_ids)
+        }, nx=True)
+        redis_client.delete(GALLERY_INDEX_KEY)
+        print(f"✅ Gallery index migrated: {len(legacy_ids)} cards")
+    except redis.RedisError as error:
+        print(f"⚠️ Gallery index could not be migrated: {error}")
+
+
+def parse_gallery_cursor(cursor):
+    """Return (score, prediction_id) for a ``next_cursor`` value, or None if it is malformed."""
+    score, _, prediction_id = (cursor or "").partition(":")
+    if not re.fullmatch(r"\d+", score) or not re.fullmatch(r"[A-Za-z0-9]+", prediction_id):
+        return None
+    return score, prediction_id
+
+
+def load_gallery_page(cursor=None, limit=GALLERY_PAGE_SIZE):
+    """Read one page of cards (newest first) and the cursor of the next page in one round trip."""
+    max_score, cursor_id = parse_gallery_cursor(cursor) if cursor else ("+inf", "")
+    next_cursor, cards = redis_client.eval(
+        _READ_GALLERY_PAGE_SCRIPT, 1, GALLERY_TIMELINE_KEY,
+        max_score, cursor_id, limit, GALLERY_CARD_PREFIX,
+    )
+    if isinstance(next_cursor, bytes):
+        next_cursor = next_cursor.decode("utf-8")
+    if isinstance(cards, bytes):
+        cards = cards.decode("utf-8")
+    return json.loads(cards), next_cursor or None
+
+
+def get_gallery_page(cursor=None, limit=GALLERY_PAGE_SIZE):
+    """Return {"cards", "next_cursor", "body", "etag"} for one gallery page.
+
+    Pages are kept in process for GALLERY_CACHE_SECONDS and dropped as soon
+    as ``save_public_card`` or a cleanup job publishes a change.
+    """
+    _start_gallery_listener()
+    key = (cursor or "", limit)
+    with _gallery_cache_lock:
+        page = _gallery_pages.get(key)
+        if page is not None and time.time() < page["expires_at"]:
+            _gallery_pages.move_to_end(key)
+            return page
+        generation = _gallery_cache["generation"]
+    try:
+        cards, next_cursor = load_gallery_page(cursor, limit)
     except Exception as error:
         print(f"⚠️ Public gallery could not be loaded: {error}")
-        return []
+        return {"cards": [], "next_cursor": None, "body": None, "etag": None}
+
+    body = json.dumps({"cards": cards, "next_cursor": next_cursor}, ensure_ascii=False).encode("utf-8")
+    page = {
+        "cards": cards,
+        "next_cursor": next_cursor,
+        "body": body,
+        "etag": hashlib.sha1(body).hexdigest(),
+        "expires_at": time.time() + GALLERY_CACHE_SECONDS,
+    }
+    with _gallery_cache_lock:
+        # 読んでいる間に無効化された場合は古いかもしれないので保存しない
+        if _gallery_cache["generation"] == generation:
+            _gallery_pages[key] = page
+            while len(_gallery_pages) > GALLERY_PAGE_CACHE_SIZE:
+                _gallery_pages.popitem(last=False)
+    return page
 
 
-def remove_source_playlist(playlist_id):
-    """Remove an expired source playlist from the owner's Spotify library."""
-    access_token = session.get("access_token")
-    if not access_token or not playlist_id:
-        return
+def get_public_gallery(limit=GALLERY_PAGE_SIZE):
+    """Return the newest generated cards that are safe to show publicly."""
+    return get_gallery_page(None, limit)["cards"]
+
+
+# ✅ 旧形式のギャラリー一覧があれば時系列 sorted set に移す
+migrate_gallery_index()
+
+
+def card_image_path(prediction_id):
+    """Where cards were written before image_store; only used to clean them up."""
+    return os.path.join("static", "generated", f"hologram_{prediction_id}.png")
+
+
+def get_finished_card(prediction_id):
+    """Return the stored result of an already rendered card, or None."""
     try:
-        response = requests.delete(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}/followers",
-            headers={"Authorization": f"Bearer {access_token}"},
-            timeout=20,
+        value = redis_client.get(f"{CARD_RESULT_PREFIX}{prediction_id}")
+    except redis.RedisError as error:
+        print(f"⚠️ Finished card could not be loaded: {error}")
+        return None
+    if not value:
+        return None
+    # ギャラリーから押し出されたカードの結果は保存スクリプトが一緒に消している
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return json.loads(value)
+
+
+def save_finished_card(prediction_id, finished_card):
+    """Remember the /result response so later polls return it without re-rendering.
+
+    Redis errors are raised: this runs inside a job, which is then retried
+    instead of reporting a card that nobody can load.
+    """
+    redis_client.setex(
+        f"{CARD_RESULT_PREFIX}{prediction_id}", CARD_RESULT_TTL, json.dumps(finished_card)
+    )
+    publish_card_event(prediction_id, finished_card)
+
+
+def publish_card_event(prediction_id, payload):
+    """Push a /result-shaped status update to SSE and long-poll listeners."""
+    try:
+        redis_client.publish(f"{CARD_EVENTS_PREFIX}{prediction_id}", json.dumps(payload))
+    except redis.RedisError as error:
+        print(f"⚠️ Card event could not be published: {error}")
+
+
+_RELEASE_LOCK_SCRIPT = redis_client.register_script(
+    """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+)
+
+
+def acquire_render_lock(prediction_id):
+    """Take the per-prediction render lock; return its token, or None if it is held."""
+    token = os.urandom(16).hex()
+    if redis_client.set(f"{RENDER_LOCK_PREFIX}{prediction_id}", token, nx=True, ex=RENDER_LOCK_TTL):
+        return token
+    return None
+
+
+def release_render_lock(prediction_id, token):
+    """Release the render lock only if it is still ours (it may have expired)."""
+    try:
+        _RELEASE_LOCK_SCRIPT(keys=[f"{RENDER_LOCK_PREFIX}{prediction_id}"], args=[token])
+    except redis.RedisError as error:
+        print(f"⚠️ Render lock could not be released: {error}")
+
+
+def get_card_status(prediction_id):
+    """Return the background finishing state of a card, or None if it was never queued."""
+    value = redis_client.get(f"{CARD_STATUS_PREFIX}{prediction_id}")
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return json.loads(value)
+
+
+def set_card_status(prediction_id, state, **extra):
+    redis_client.setex(
+        f"{CARD_STATUS_PREFIX}{prediction_id}",
+        CARD_STATUS_TTL,
+        json.dumps({"state": state, "updated_at": time.time(), **extra}),
+    )
+    if state == "failed":
+        publish_card_event(prediction_id, {"status": "failed", "image_url": None})
+    elif state != "succeeded":
+        # succeeded はカード本体を保存するときに通知する
+        publish_card_event(prediction_id, {"status": "finishing", "image_url": None})
+
+
+def enqueue_finish_card(prediction_id, spec):
+    """Queue the finishing job once; later calls while it is pending are no-ops."""
+    was_queued = redis_client.set(
+        f"{CARD_STATUS_PREFIX}{prediction_id}",
+        json.dumps({"state": "queued", "updated_at": time.time()}),
+        nx=True,
+        ex=CARD_STATUS_TTL,
+    )
+    if was_queued:
+        job_queue.enqueue(
+            redis_client, CARD_QUEUE, "finish_card", {"prediction_id": prediction_id, **spec}
         )
-        response.raise_for_status()
-        print(f"🗑️ Expired Spotify playlist removed: {playlist_id}")
+        publish_card_event(prediction_id, {"status": "finishing", "image_url": None})
+        print(f"📥 Card finishing queued: {prediction_id}")
+
+
+def webhooks_enabled():
+    return bool(PUBLIC_BASE_URL and REPLICATE_WEBHOOK_SECRET)
+
+
+def decode_json(value):
+    """Decode a JSON value read from Redis (bytes or str); None stays None."""
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return json.loads(value)
+
+
+def _get_json(key):
+    return decode_json(redis_client.get(key))
+
+
+def get_card_spec(prediction_id):
+    """Return what generate_image decided for a card (title, atk, owner, ...)."""
+    return _get_json(f"{CARD_SPEC_PREFIX}{prediction_id}")
+
+
+def get_prediction_state(prediction_id):
+    """Return the locally known Replicate status of a prediction, or None."""
+    return _get_json(f"{PREDICTION_PREFIX}{prediction_id}")
+
+
+def record_prediction(prediction):
+    """Store a Replicate prediction's status and start finishing once it succeeds.
+
+    Used by the webhook and by the fallback poll, so it must be idempotent;
+    a late non-terminal update never overwrites a terminal one.
+    """
+    prediction_id = prediction["id"]
+    status = prediction.get("status")
+    previous = get_prediction_state(prediction_id)
+    if (
+        previous
+        and previous["status"] in TERMINAL_PREDICTION_STATUSES
+        and status not in TERMINAL_PREDICTION_STATUSES
+    ):
+        return previous
+
+    state = {
+        "status": status,
+        "output": prediction.get("output"),
+        "error": prediction.get("error"),
+        "updated_at": time.time(),
+    }
+    redis_client.setex(f"{PREDICTION_PREFIX}{prediction_id}", CARD_STATUS_TTL, json.dumps(state))
+
+    output = state["output"]
+    if status not in TERMINAL_PREDICTION_STATUSES and status != (previous or {}).get("status"):
+        publish_card_event(prediction_id, {"status": status, "image_url": None})
+    if status == "succeeded" and output:
+        image_url = output[0] if isinstance(output, list) else output
+        enqueue_finish_card(prediction_id, {**(get_card_spec(prediction_id) or {}), "image_url": image_url})
+    elif status in ("failed", "canceled"):
+        set_card_status(prediction_id, "failed", error=str(state["error"])[:200])
+    return state
+
+
+def reconcile_prediction(prediction_id):
+    """Fetch a prediction from Replicate and record it; return its state or None."""
+    try:
+        res = http_client.get(prediction_url(prediction_id), headers=replicate_read_headers(), timeout=20)
     except requests.RequestException as error:
-        print(f"⚠️ Expired Spotify playlist could not be removed: {error}")
+        print(f"⚠️ Prediction could not be fetched: {error}")
+        return None
+    return record_fetched_prediction(res)
+
+
+def prediction_url(prediction_id):
+    return f"{REPLICATE_API_BASE}/predictions/{prediction_id}"
 
 
-def create_source_playlist(prediction_id, card_id):
-    """Create one public Spotify playlist from the exact tracks used for a card."""
+def replicate_read_headers():
+    return {"Authorization": f"Token {REPLICATE_API_TOKEN}"}
+
+
+def record_fetched_prediction(res):
+    """Record a ``GET /predictions/<id>`` response (requests or httpx); return its state or None."""
+    if res.status_code != 200:
+        print(f"⚠️ Prediction could not be fetched: {res.text}")
+        return None
+    return record_prediction(res.json())
+
+
+def prediction_needs_reconcile(state):
+    """True when Replicate has to be asked: webhooks are off, nothing is recorded, or they went quiet."""
+    return (
+        not webhooks_enabled()
+        or not state
+        or time.time() - state.get("updated_at", 0) > PREDICTION_RECONCILE_SECONDS
+    )
+
+
+def card_state_keys(prediction_id):
+    """Keys of the finished card, its finishing status and its prediction, in ``build_status_payload`` order."""
+    return [
+        f"{CARD_RESULT_PREFIX}{prediction_id}",
+        f"{CARD_STATUS_PREFIX}{prediction_id}",
+        f"{PREDICTION_PREFIX}{prediction_id}",
+    ]
+
+
+def build_status_payload(finished_card, card_status, state):
+    """Return the /result JSON from the stored records, or None if nothing is known."""
+    # ✅ 仕上げ済みのカードは再描画せずにそのまま返す
+    if finished_card:
+        return finished_card
+
+    # ✅ 仕上げ処理がキュー済みならステータスだけ返す（Replicate への問い合わせ不要）
+    if card_status:
+        if card_status["state"] == "failed":
+            return {"status": "failed", "image_url": None}
+        if card_status["state"] == "succeeded":
+            # 仕上がったのに結果がない = ギャラリーから押し出されて消えた。待っても出てこない
+            return {"status": "failed", "image_url": None, "error": "expired"}
+        return {"status": "finishing", "image_url": None}
+
+    if not state:
+        return None
+    if state["status"] == "succeeded":
+        return {"status": "finishing", "image_url": None}
+    if state["status"] in ("failed", "canceled"):
+        return {"status": "failed", "image_url": None}
+    return {"status": state["status"], "image_url": None}
+
+
+def card_status_payload(prediction_id):
+    """Return the /result JSON for a card, built from local state.
+
+    Replicate is only asked when webhooks are off or have gone quiet for
+    PREDICTION_RECONCILE_SECONDS.  Returns None if nothing is known and
+    Replicate could not be reached.
+    """
+    # 結果と仕上げ状態は1回の MGET で読む（別々に読むと保存の合間に「結果なしで succeeded」が見える）
+    values = redis_client.mget(card_state_keys(prediction_id))
+    finished_card, card_status, state = (decode_json(value) for value in values)
+    if not finished_card and not card_status and prediction_needs_reconcile(state):
+        # ✅ 状態は webhook が Redis に記録する。webhook 未設定・未着のときだけ Replicate に確認
+        state = reconcile_prediction(prediction_id) or state
+    return build_status_payload(finished_card, card_status, state)
+
+
+# カードの持ち主を記録しているレコード（prefix, 持ち主のフィールド）。先に見つかったものを使う
+CARD_OWNER_RECORDS = (
+    (CARD_SPEC_PREFIX, "user_id"),
+    (SOURCE_TRACKS_PREFIX, "user_id"),
+    (CARD_RESULT_PREFIX, "user"),
+)
+ACCESS_ERROR_STATUS_CODES = {"login_required": 401, "forbidden": 403}
+
+
+def card_owner_keys(prediction_id):
+    return [f"{prefix}{prediction_id}" for prefix, _ in CARD_OWNER_RECORDS]
+
+
+def card_access_status(current_user, values):
+    """Return "login_required", "forbidden" or None given the raw values of ``card_owner_keys``."""
+    if not current_user:
+        return "login_required"
+    for (_, owner_field), value in zip(CARD_OWNER_RECORDS, values):
+        record = decode_json(value)
+        if record:
+            return "forbidden" if record.get(owner_field) != current_user else None
+    return None
+
+
+def card_access_error(prediction_id):
+    """Return an error response unless the logged-in user owns this card."""
+    current_user = session.get("user_id")
+    # 持ち主のレコードは MGET 1回でまとめて読む
+    values = redis_client.mget(card_owner_keys(prediction_id)) if current_user else []
+    error = card_access_status(current_user, values)
+    if error:
+        return jsonify({"status": error}), ACCESS_ERROR_STATUS_CODES[error]
+    return None
+
+
+def verify_replicate_webhook(headers, body):
+    """Check Replicate's webhook-id/-timestamp/-signature headers against our secret."""
+    if not REPLICATE_WEBHOOK_SECRET:
+        return False
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature", "")
+    if not webhook_id or not timestamp:
+        return False
     try:
-        playlist_key = f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}"
-        cached = redis_client.get(playlist_key)
-        if cached:
-            if isinstance(cached, bytes):
-                cached = cached.decode("utf-8")
-            return json.loads(cached)
-
-        source = redis_client.get(f"{SOURCE_TRACKS_PREFIX}{prediction_id}")
-        if not source:
-            return None
-        if isinstance(source, bytes):
-            source = source.decode("utf-8")
-        source = json.loads(source)
-        track_uris = source.get("track_uris", [])
-        access_token = session.get("access_token")
-        if source.get("user_id") != session.get("user_id") or not track_uris or not access_token:
-            return None
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            return False
+        key = base64.b64decode(REPLICATE_WEBHOOK_SECRET.removeprefix("whsec_"))
+    except ValueError:
+        return False
+    signed_content = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    expected = base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode()
+    return any(
+        hmac.compare_digest(expected, signature.split(",", 1)[-1])
+        for signature in signatures.split()
+    )
+
+
+def run_finish_card_job(payload):
+    """Worker entry point: render one card under the render lock.
+
+    Raises on failure so the queue can retry it with backoff.
+    """
+    prediction_id = payload["prediction_id"]
+    if get_finished_card(prediction_id):
+        return
+    lock_token = acquire_render_lock(prediction_id)
+    if not lock_token:
+        raise RuntimeError(f"Card is already being rendered: {prediction_id}")
+    try:
+        set_card_status(prediction_id, "rendering")
+        if not get_finished_card(prediction_id):
+            finish_card(prediction_id, payload["image_url"], payload)
+        set_card_status(prediction_id, "succeeded")
+    except Exception:
+        set_card_status(prediction_id, "retrying")
+        raise
+    finally:
+        release_render_lock(prediction_id, lock_token)
 
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-        playlist_response = requests.post(
-            "https://api.spotify.com/v1/me/playlists",
+
+def remove_source_playlist(playlist_id, owner_id):
+    """Remove an expired source playlist from the owner's Spotify library.
+
+    Raises ``requests.RequestException`` so the cleanup job is retried.
+    """
+    if not playlist_id or not owner_id:
+        return
+    access_token = user_access_token(owner_id)
+    if not access_token:
+        print(f"⚠️ No Spotify token for {owner_id}, keeping playlist: {playlist_id}")
+        return
+    response = http_client.delete(
+        f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/followers",
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=20,
+    )
+    if response.status_code == 404:
+        print(f"🗑️ Expired Spotify playlist already gone: {playlist_id}")
+        return
+    response.raise_for_status()
+    print(f"🗑️ Expired Spotify playlist removed: {playlist_id}")
+
+
+def run_expire_playlist_job(payload):
+    """Remove the playlist of a card that left the playlist retention window; the card stays."""
+    prediction_id = payload["prediction_id"]
+    card = _get_json(f"{GALLERY_CARD_PREFIX}{prediction_id}")
+    if not card:
+        return
+    if (get_source_playlist(prediction_id) or {}).get("state") == PLAYLIST_PENDING:
+        # 作成中のプレイリストは出来上がってから消す（リトライで待つ）
+        raise RuntimeError(f"Playlist is still being created: {prediction_id}")
+    if card.get("playlist_id"):
+        remove_source_playlist(card["playlist_id"], card.get("owner_id"))
+        card["playlist_id"] = card["playlist_url"] = None
+        # カードが既に削除されていれば書き戻さない
+        redis_client.set(f"{GALLERY_CARD_PREFIX}{prediction_id}", json.dumps(card), xx=True)
+        redis_client.publish(GALLERY_EVENTS_CHANNEL, prediction_id)
+    redis_client.delete(f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}")
+
+
+def run_cleanup_card_job(payload):
+    """Delete an evicted card's Spotify playlist and images; raises to be retried."""
+    expired_id = payload["prediction_id"]
+    remove_source_playlist(payload.get("playlist_id"), payload.get("owner_id"))
+    if payload.get("image_keys"):
+        image_store.delete_images(payload["image_keys"])
+        print(f"🗑️ Expired public gallery images removed: {expired_id}")
+    # image_store 導入前のカードは static/generated に PNG がある
+    if re.fullmatch(r"[a-z0-9]+", expired_id):
+        expired_image_path = card_image_path(expired_id)
+        if os.path.isfile(expired_image_path):
+            os.remove(expired_image_path)
+            print(f"🗑️ Expired public gallery image removed: {expired_id}")
+
+
+def get_source_playlist(prediction_id):
+    """Return the playlist record of a card: ``state`` plus playlist_id/url once created."""
+    return _get_json(f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}")
+
+
+def save_source_playlist(prediction_id, source_playlist, user_id):
+    """Update a card's playlist record; False (and the playlist removed) if the card is gone."""
+    # ギャラリーから押し出されたカードのレコードは作り直さない（xx）
+    if redis_client.set(
+        f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps(source_playlist), xx=True
+    ):
+        return True
+    # 押し出したときのクリーンアップはこのプレイリストを知らないので、ここで消す
+    print(f"⚠️ Card left the gallery while its playlist was made: {prediction_id}")
+    remove_source_playlist(source_playlist["playlist_id"], user_id)
+    return False
+
+
+def create_source_playlist(prediction_id, card_id, user_id, card_url=None):
+    """Create one public Spotify playlist from the exact tracks used for a card.
+
+    Returns the ready record, or None when there is nothing to create or
+    the card left the gallery meanwhile (a playlist already made for it is
+    then removed again, since cleanup never saw it).  Raises ``requests.RequestException`` or ``spotify_tokens.TokenMissing``
+    (the owner has no token right now) so the job is retried; a playlist
+    that was created but not filled yet is filled on the retry instead of
+    being created twice.
+    """
+    source_playlist = get_source_playlist(prediction_id)
+    if not source_playlist:
+        return None  # カードが既に削除された
+    if source_playlist.get("state") == PLAYLIST_READY:
+        return source_playlist
+
+    source = _get_json(f"{SOURCE_TRACKS_PREFIX}{prediction_id}")
+    if not source:
+        return None
+    track_uris = source.get("track_uris", [])
+    if source.get("user_id") != user_id or not track_uris:
+        return None
+    access_token = user_access_token(user_id)
+    if not access_token:
+        # 曲はあるので失敗にはしない。再ログインで保存されたトークンをリトライで使う
+        raise spotify_tokens.TokenMissing(f"No Spotify token for {user_id}")
+
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    if not source_playlist.get("playlist_id"):
+        playlist_response = http_client.post(
+            f"{SPOTIFY_API_BASE}/me/playlists",
             headers=headers,
             json={
                 "name": f"Music Monster {card_id}",
                 "public": True,
-                "description": f"Source tracks for Music Monster card {card_id}.",
+                "description": " ".join(filter(None, [
+                    f"Source tracks for Music Monster card {card_id}.", card_url,
+                ])),
             },
             timeout=20,
         )
         playlist_response.raise_for_status()
         playlist = playlist_response.json()
-        playlist_id = playlist["id"]
-
-        items_response = requests.post(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}/items",
-            headers=headers,
-            json={"uris": track_uris[:100]},
-            timeout=20,
-        )
-        items_response.raise_for_status()
-        source_playlist = {
-            "playlist_id": playlist_id,
+        source_playlist.update({
+            "playlist_id": playlist["id"],
             "playlist_url": playlist["external_urls"]["spotify"],
             "cover_uploaded": False,
-        }
-        redis_client.set(playlist_key, json.dumps(source_playlist))
-        redis_client.delete(f"{SOURCE_TRACKS_PREFIX}{prediction_id}")
-        print(f"✅ Source Spotify playlist created: {playlist_id}")
-        return source_playlist
-    except (KeyError, ValueError, requests.RequestException) as error:
-        print(f"⚠️ Source Spotify playlist could not be created: {error}")
+        })
+        # 曲の追加に失敗しても次のリトライで同じプレイリストを使う
+        if not save_source_playlist(prediction_id, source_playlist, user_id):
+            return None
+
+    items_response = http_client.post(
+        f"{SPOTIFY_API_BASE}/playlists/{source_playlist['playlist_id']}/items",
+        headers=headers,
+        json={"uris": track_uris[:100]},
+        timeout=20,
+    )
+    items_response.raise_for_status()
+    source_playlist["state"] = PLAYLIST_READY
+    if not save_source_playlist(prediction_id, source_playlist, user_id):
         return None
+    redis_client.delete(f"{SOURCE_TRACKS_PREFIX}{prediction_id}")
+    print(f"✅ Source Spotify playlist created: {source_playlist['playlist_id']}")
+    return source_playlist
+
 
+def upload_playlist_cover(prediction_id, source_playlist, card_image, user_id):
+    """Upload a square, site-themed cover built from the finished card image.
 
-def upload_playlist_cover(prediction_id, source_playlist, image_path):
-    """Upload a square, site-themed cover without scaling the generated card."""
+    Raises ``requests.RequestException`` or ``spotify_tokens.TokenMissing``
+    so the job is retried.
+    """
     if not source_playlist or source_playlist.get("cover_uploaded"):
         return
 
-    access_token = session.get("access_token")
+    access_token = user_access_token(user_id)
     if not access_token:
+        raise spotify_tokens.TokenMissing(f"No Spotify token for {user_id}")
+
+    jpeg_data, quality = encode_cover(card_image)
+    if not jpeg_data:
+        print("⚠️ Spotify playlist cover exceeded the 256 KB limit.")
         return
 
-    try:
-        card_image = Image.open(image_path).convert("RGBA")
-        canvas_size = max(card_image.size)
-        cover = Image.new("RGBA", (canvas_size, canvas_size), (7, 17, 13, 255))
-
-        glow_layer = Image.new("RGBA", cover.size, (0, 0, 0, 0))
-        glow_draw = ImageDraw.Draw(glow_layer)
-        glow_draw.ellipse(
-            (-canvas_size * 0.7, -canvas_size * 0.7, canvas_size * 0.45, canvas_size * 0.45),
-            fill=(128, 207, 100, 74),
-        )
-        glow_draw.ellipse(
-            (canvas_size * 0.55, canvas_size * 0.6, canvas_size * 1.45, canvas_size * 1.5),
-            fill=(22, 77, 60, 115),
-        )
-        cover = Image.alpha_composite(
-            cover, glow_layer.filter(ImageFilter.GaussianBlur(canvas_size // 12))
-        )
-        card_position = (
-            (canvas_size - card_image.width) // 2,
-            (canvas_size - card_image.height) // 2,
-        )
-        cover.alpha_composite(card_image, card_position)
+    response = http_client.put(
+        f"{SPOTIFY_API_BASE}/playlists/{source_playlist['playlist_id']}/images",
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "image/jpeg",
+        },
+        data=base64.b64encode(jpeg_data),
+        timeout=30,
+    )
+    response.raise_for_status()
+    source_playlist["cover_uploaded"] = True
+    # 途中で削除されたカードのレコードは作り直さない
+    redis_client.set(
+        f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps(source_playlist), xx=True
+    )
+    print(f"✅ Spotify playlist cover uploaded: {source_playlist['playlist_id']} (quality {quality})")
+
+
+def publish_playlist_state(prediction_id, source_playlist):
+    """Copy a playlist's state onto the finished card and the gallery card, and notify listeners."""
+    playlist_url = source_playlist.get("playlist_url") if source_playlist["state"] == PLAYLIST_READY else None
+    finished_card = get_finished_card(prediction_id)
+    if finished_card:
+        finished_card["playlist_status"] = source_playlist["state"]
+        finished_card["playlist_url"] = playlist_url
+        save_finished_card(prediction_id, finished_card)  # SSE / long-poll にも届く
+
+    card = _get_json(f"{GALLERY_CARD_PREFIX}{prediction_id}")
+    if card and playlist_url:
+        card["playlist_id"] = source_playlist["playlist_id"]
+        card["playlist_url"] = playlist_url
+        redis_client.set(f"{GALLERY_CARD_PREFIX}{prediction_id}", json.dumps(card), xx=True)
+        redis_client.publish(GALLERY_EVENTS_CHANNEL, prediction_id)
+
+
+def playlist_state_published(prediction_id, source_playlist):
+    """True when the finished card and the gallery card already show the playlist's state."""
+    finished_card = get_finished_card(prediction_id)
+    if finished_card and finished_card.get("playlist_status") != source_playlist["state"]:
+        return False
+    if source_playlist["state"] == PLAYLIST_READY:
+        card = _get_json(f"{GALLERY_CARD_PREFIX}{prediction_id}")
+        if card and card.get("playlist_url") != source_playlist.get("playlist_url"):
+            return False
+    return True
+
+
+def fail_source_playlist(prediction_id, error):
+    """Mark a pending playlist as failed (the card itself is unaffected)."""
+    source_playlist = get_source_playlist(prediction_id)
+    if not source_playlist or source_playlist.get("state") != PLAYLIST_PENDING:
+        return
+    source_playlist.update({"state": PLAYLIST_FAILED, "error": str(error)[:200]})
+    redis_client.set(
+        f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps(source_playlist), xx=True
+    )
+    publish_playlist_state(prediction_id, source_playlist)
+    print(f"⚠️ Source Spotify playlist failed: {prediction_id} ({error})")
 
-        jpeg_data = None
-        for quality in (90, 82, 74, 66, 58, 50, 42, 34, 26, 18, 10):
-            buffer = BytesIO()
-            cover.convert("RGB").save(
-                buffer, format="JPEG", quality=quality, optimize=True, progressive=True
-            )
-            if buffer.tell() <= 256 * 1024:
-                jpeg_data = buffer.getvalue()
-                break
-        if not jpeg_data:
-            print("⚠️ Spotify playlist cover exceeded the 256 KB limit.")
-            return
 
-        response = requests.put(
-            f"https://api.spotify.com/v1/playlists/{source_playlist['playlist_id']}/images",
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "image/jpeg",
-            },
-            data=base64.b64encode(jpeg_data),
-            timeout=30,
-        )
-        response.raise_for_status()
-        source_playlist["cover_uploaded"] = True
-        redis_client.set(
-            f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps(source_playlist)
-        )
-        print(f"✅ Spotify playlist cover uploaded: {source_playlist['playlist_id']}")
-    except (KeyError, OSError, requests.RequestException) as error:
-        print(f"⚠️ Spotify playlist cover could not be uploaded: {error}")
+def run_publish_playlist_job(payload):
+    """Worker entry point: create a finished card's playlist, then upload its cover.
 
+    Runs after the card has been delivered.  Raises on Spotify errors so
+    the queue retries with backoff; the dead-letter hook marks the
+    playlist failed.
+    """
+    prediction_id = payload["prediction_id"]
+    source_playlist = get_source_playlist(prediction_id)
+    if not source_playlist or source_playlist.get("state") == PLAYLIST_FAILED:
+        return  # カードが既に削除された、または失敗が確定している
 
-def save_public_card(prediction_id, image_url, title, card_id, owner_id, source_playlist=None):
-    """Add a completed card to the public archive once, even if it is polled again."""
+    source_playlist = create_source_playlist(
+        prediction_id, payload["card_id"], payload["user_id"], payload.get("card_url"),
+    )
+    if source_playlist is None:
+        fail_source_playlist(prediction_id, "No source tracks for this card")
+        return
+    # レコードが ready でもカードへの反映で失敗していたかもしれないので、カード側を見て決める
+    if not playlist_state_published(prediction_id, source_playlist):
+        publish_playlist_state(prediction_id, source_playlist)
+
+    if not source_playlist.get("cover_uploaded") and payload.get("image_key"):
+        card_image = Image.open(BytesIO(image_store.load_image(payload["image_key"])))
+        upload_playlist_cover(prediction_id, source_playlist, card_image, payload["user_id"])
+
+
+# カードを時系列の sorted set に追加し、保持期間を過ぎたものを1回で片付ける
+# 戻り値: [追加したか, プレイリスト保持枠から外れたID, 削除ID, 削除カードJSON, ...]
+# 消すカードはスクリプトの中で決まるので、そのカード・プレイリスト・結果のキーは KEYS で渡せず
+# ARGV の prefix から組み立てる。Redis Cluster やキーを検査するプロキシでは動かない（単一ノード前提）
+_SAVE_GALLERY_CARD_SCRIPT = """
+if not redis.call("set", KEYS[2], ARGV[2], "NX") then
+    return {0}
+end
+redis.call("zadd", KEYS[1], ARGV[3], ARGV[1])
+local retention = tonumber(ARGV[4])
+local playlist_retention = tonumber(ARGV[5])
+local result = {1, ""}
+if playlist_retention < retention then
+    result[2] = redis.call("zrevrange", KEYS[1], playlist_retention, playlist_retention)[1] or ""
+end
+for _, expired_id in ipairs(redis.call("zrevrange", KEYS[1], retention, -1)) do
+    local expired_card = redis.call("get", ARGV[6] .. expired_id)
+    table.insert(result, expired_id)
+    table.insert(result, expired_card or "")
+    redis.call("del", ARGV[6] .. expired_id, ARGV[7] .. expired_id, ARGV[8] .. expired_id)
+end
+redis.call("zremrangebyrank", KEYS[1], 0, -(retention + 1))
+return result
+"""
+
+
+def save_public_card(
+    prediction_id, image_url, title, card_id, owner_id, source_playlist=None, images=None,
+):
+    """Add a completed card to the public archive once, even if it is polled again.
+
+    Cards older than the newest GALLERY_RETENTION_ITEMS are removed with
+    their image; playlists are kept only for the newest
+    GALLERY_PLAYLIST_RETENTION_ITEMS.  The Spotify and disk work is queued
+    for the worker.
+    """
     card = {
         "prediction_id": prediction_id,
         "image_url": image_url,
+        "thumb_url": (images or {}).get("thumb", {}).get("url"),
+        "image_keys": [variant["key"] for variant in (images or {}).values()],
         "title": title,
         "card_id": card_id,
         "owner_id": owner_id,
@@ -251,47 +902,167 @@ def save_public_card(prediction_id, image_url, title, card_id, owner_id, source_
         "playlist_url": (source_playlist or {}).get("playlist_url"),
     }
     try:
-        was_added = redis_client.set(
-            f"{GALLERY_CARD_PREFIX}{prediction_id}", json.dumps(card), nx=True
+        result = redis_client.eval(
+            _SAVE_GALLERY_CARD_SCRIPT, 2, GALLERY_TIMELINE_KEY, f"{GALLERY_CARD_PREFIX}{prediction_id}",
+            prediction_id, json.dumps(card), int(time.time() * 1000),
+            GALLERY_RETENTION_ITEMS, GALLERY_PLAYLIST_RETENTION_ITEMS,
+            GALLERY_CARD_PREFIX, SOURCE_PLAYLIST_PREFIX, CARD_RESULT_PREFIX,
         )
-        if was_added:
-            redis_client.lpush(GALLERY_INDEX_KEY, prediction_id)
-            expired_ids = redis_client.lrange(GALLERY_INDEX_KEY, GALLERY_MAX_ITEMS, -1)
-            redis_client.ltrim(GALLERY_INDEX_KEY, 0, GALLERY_MAX_ITEMS - 1)
-            for expired_id in expired_ids:
+        if result and int(result[0]):
+            playlist_expired_id = result[1].decode("utf-8") if isinstance(result[1], bytes) else result[1]
+            if playlist_expired_id:
+                job_queue.enqueue(redis_client, CLEANUP_QUEUE, "expire_playlist", {
+                    "prediction_id": playlist_expired_id,
+                })
+            evicted = result[2:]
+            for expired_id, expired_card in zip(evicted[0::2], evicted[1::2]):
                 if isinstance(expired_id, bytes):
                     expired_id = expired_id.decode("utf-8")
-                expired_card = redis_client.get(f"{GALLERY_CARD_PREFIX}{expired_id}")
-                if expired_card:
-                    if isinstance(expired_card, bytes):
-                        expired_card = expired_card.decode("utf-8")
-                    remove_source_playlist(json.loads(expired_card).get("playlist_id"))
-                redis_client.delete(f"{GALLERY_CARD_PREFIX}{expired_id}")
-                redis_client.delete(f"{SOURCE_PLAYLIST_PREFIX}{expired_id}")
-                if re.fullmatch(r"[a-z0-9]+", expired_id):
-                    expired_image_path = os.path.join(
-                        "static", "generated", f"hologram_{expired_id}.png"
-                    )
-                    if os.path.isfile(expired_image_path):
-                        os.remove(expired_image_path)
-                        print(f"🗑️ Expired public gallery image removed: {expired_id}")
+                if isinstance(expired_card, bytes):
+                    expired_card = expired_card.decode("utf-8")
+                expired_card = json.loads(expired_card) if expired_card else {}
+                # 🧹 Spotify とディスクの後片付けは worker に任せる
+                job_queue.enqueue(redis_client, CLEANUP_QUEUE, "cleanup_card", {
+                    "prediction_id": expired_id,
+                    "playlist_id": expired_card.get("playlist_id"),
+                    "image_keys": expired_card.get("image_keys") or [],
+                    "owner_id": expired_card.get("owner_id"),
+                })
+            redis_client.publish(GALLERY_EVENTS_CHANNEL, prediction_id)
             print(f"✅ Public gallery card saved: {card_id}")
     except Exception as error:
         print(f"⚠️ Public gallery card could not be saved: {error}")
 
-# SpotifyOAuth を動的生成（重要）
+
+def artist_cache_keys(unique_ids):
+    return [f"{ARTIST_INFO_PREFIX}{aid}" for aid in unique_ids]
+
+
+def split_cached_artists(unique_ids, cached):
+    """Split an MGET of ``artist_cache_keys`` into ({artist_id: info}, IDs to ask Spotify for)."""
+    artists = {}
+    missing_ids = []
+    for aid, value in zip(unique_ids, cached):
+        if value:
+            artists[aid] = json.loads(value)
+        else:
+            missing_ids.append(aid)
+    return artists, missing_ids
+
+
+def artist_batches(missing_ids):
+    """Chunks of the Spotify ``artists`` API's 50-ID limit."""
+    return [
+        missing_ids[start:start + SPOTIFY_ARTISTS_BATCH_SIZE]
+        for start in range(0, len(missing_ids), SPOTIFY_ARTISTS_BATCH_SIZE)
+    ]
+
+
+def queue_artist_cache(pipe, artists, fetched):
+    """Add fetched artists to ``artists`` and queue their cache writes on a (sync or async) pipeline."""
+    for info in fetched:
+        artists[info["id"]] = info
+        pipe.setex(f"{ARTIST_INFO_PREFIX}{info['id']}", ARTIST_INFO_TTL, json.dumps(info))  # 24hキャッシュ
+
+
+def resolve_artists(sp, artist_ids):
+    """Return {artist_id: artist_info} for the given IDs.
+
+    Duplicates are resolved once: one Redis MGET for the cache, Spotify
+    ``artists`` calls in chunks of the API's 50-ID limit for the misses,
+    and one pipelined SETEX write-back.
+    """
+    unique_ids = list(dict.fromkeys(aid for aid in artist_ids if aid))
+    if not unique_ids:
+        return {}
+
+    artists, missing_ids = split_cached_artists(unique_ids, redis_client.mget(artist_cache_keys(unique_ids)))
+    fetched = []
+    for chunk in artist_batches(missing_ids):
+        print(f"🕐 Spotify APIに問い合わせ（未キャッシュ）: {len(chunk)}件")
+        try:
+            fetched.extend(info for info in sp.artists(chunk)["artists"] if info)
+        except Exception as e:
+            print("🚨 Spotify artist API batch error:", e)
+
+    if fetched:
+        pipe = redis_client.pipeline(transaction=False)
+        queue_artist_cache(pipe, artists, fetched)
+        pipe.execute()
+    elif not missing_ids:
+        print("✅ 全てキャッシュから取得")
+    return artists
+
+
+_spotify_oauth = None
+_spotify_oauth_lock = threading.Lock()
+
+
 def get_spotify_oauth():
-    """ユーザーごとに独立したSpotifyOAuthインスタンスを生成"""
-    return SpotifyOAuth(
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        redirect_uri=REDIRECT_URI,
-        scope="user-read-recently-played user-read-email playlist-modify-public ugc-image-upload"
+    """Process-wide SpotifyOAuth client.
+
+    It caches no tokens (``NoTokenCache``), so it can be shared by every
+    user; per-user tokens live in Redis through ``spotify_tokens``.
+    """
+    global _spotify_oauth
+    with _spotify_oauth_lock:
+        if _spotify_oauth is None:
+            _spotify_oauth = SpotifyOAuth(
+                client_id=CLIENT_ID,
+                client_secret=CLIENT_SECRET,
+                redirect_uri=REDIRECT_URI,
+                scope="user-read-recently-played user-read-email playlist-modify-public ugc-image-upload",
+                requests_session=http_client.session_for(urlsplit(SPOTIFY_ACCOUNTS_BASE).netloc),
+                cache_handler=spotify_tokens.NoTokenCache(),
+            )
+            # 負荷試験ではローカルのスタブに向ける（SPOTIFY_ACCOUNTS_BASE）
+            _spotify_oauth.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_BASE}/authorize"
+            _spotify_oauth.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
+        return _spotify_oauth
+
+
+def user_access_token(user_id):
+    """Return a Spotify access token for ``user_id``, refreshed ahead of expiry, or None."""
+    return spotify_tokens.get_access_token(redis_client, get_spotify_oauth(), user_id)
+
+
+def spotify_client(access_token):
+    """Spotify client that reuses the pooled, retrying api.spotify.com session."""
+    sp = Spotify(
+        auth=access_token,
+        requests_session=http_client.session_for(urlsplit(SPOTIFY_API_BASE).netloc),
+        requests_timeout=http_client.DEFAULT_TIMEOUT,
     )
+    sp.prefix = f"{SPOTIFY_API_BASE}/"
+    return sp
 
 @app.route("/")
 def home():
-    return render_template("index.html", gallery_cards=get_public_gallery())
+    page = get_gallery_page()
+    return render_template(
+        "index.html", gallery_cards=page["cards"], gallery_next_cursor=page["next_cursor"]
+    )
+
+
+@app.route("/api/gallery")
+def gallery_api():
+    """One page of the public archive, newest first; pass ``next_cursor`` back as ``cursor``."""
+    cursor = request.args.get("cursor") or None
+    if cursor and parse_gallery_cursor(cursor) is None:
+        return jsonify({"error": "Invalid cursor"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", GALLERY_PAGE_SIZE)), 1), GALLERY_PAGE_MAX)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    page = get_gallery_page(cursor, limit)
+    if page["body"] is None:
+        return jsonify({"error": "Gallery unavailable"}), 503
+    response = Response(page["body"], mimetype="application/json")
+    response.set_etag(page["etag"])
+    # ETag で毎回再検証させる（更新がなければ 304）
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 # ################# Spotify認証 #################
 @app.route("/login")
@@ -303,13 +1074,13 @@ def login():
 def callback():
     code = request.args.get("code")
     sp_oauth = get_spotify_oauth()
-    token_info = sp_oauth.get_access_token(code, as_dict=True)
+    token_info = sp_oauth.get_access_token(code, as_dict=True, check_cache=False)
     access_token = token_info.get("access_token")
     if not access_token:
         return f"Failed to obtain access token: {token_info}", 400
 
     # ✅ Spotify API でユーザー情報取得
-    sp = Spotify(auth=access_token)
+    sp = spotify_client(access_token)
     user = sp.me()
     user_id = user["id"]
 
@@ -317,15 +1088,20 @@ def callback():
         session.clear()
         return "This studio is private.", 403
 
-    # ✅ Redis-backed session に保存
+    # ✅ トークンはトークンサービス（Redis）に、セッションにはユーザーIDだけを保存
+    spotify_tokens.save_token(redis_client, user_id, token_info)
     session["user_id"] = user_id
-    session["access_token"] = access_token
-    session["refresh_token"] = token_info.get("refresh_token")
-    session["expires_at"] = token_info.get("expires_at")
 
     print(f"✅ 認証成功: {user_id}")
     return redirect(f"/generate/{user_id}")
 
+def load_session(cookie_header):
+    """Read-only view of the Flask session named in a ``Cookie`` header (used outside Flask requests)."""
+    if not cookie_header:
+        return {}
+    session_request = app.request_class.from_values(headers={"Cookie": cookie_header})
+    return app.session_interface.open_session(app, session_request) or {}
+
 # =====================
 # セッション確認API（フロントの「Start with Spotify」用）
 # =====================
@@ -336,6 +1112,263 @@ def session_check():
         return jsonify({"logged_in": True, "user_id": user_id})
     return jsonify({"logged_in": False})
 
+class CardRequestError(Exception):
+    """A generation request that cannot go ahead; ``body`` and ``status`` are the HTTP response."""
+
+    def __init__(self, body, status):
+        super().__init__(body)
+        self.body = body
+        self.status = status
+
+
+TEMPLATE_REJECTED_STATUSES = (400, 404, 422)
+
+
+def played_artist_ids(items):
+    """First artist of every play, in play order (duplicates kept for the score weighting)."""
+    return [item["track"]["artists"][0]["id"] for item in items]
+
+
+def plan_card(items, artists):
+    """Decide a card from recent plays and their artists: title, ATK, animal, prompt and source tracks.
+
+    ``artists`` is ``resolve_artists``' result for ``played_artist_ids(items)``.
+    Raises ``CardRequestError`` when there is nothing to build a card from.
+    """
+    if not items:
+        raise CardRequestError("No recent tracks found.", 404)
+
+    source_track_uris = [
+        item.get("track", {}).get("uri") for item in items
+        if item.get("track", {}).get("uri")
+    ]
+    if not source_track_uris:
+        raise CardRequestError("No playable recent tracks found.", 404)
+
+    # 🎨 ベースとなるテンプレート画像を選択
+    definition_score = 0
+    influenced_word_box = []
+    album_image_url_box = []
+    creature_name = ""
+    artist_ids = []
+    artist_info_box = []
+
+    print("\n🎵 最近再生した曲:")
+    # 🎵 アーティストIDを抽出（重複除去）
+    for item in items:
+        artist = item["track"]["artists"][0]
+        artist_ids.append(artist["id"])
+        track = item["track"]
+        genre = artist.get("genres", [])
+
+        album_image_url_box.append(track['album']['images'][0]['url'])
+        influenced_word_box.append(track['name'])
+        influenced_word_box.append(artist['name'])
+
+        print(f"{track['name']} / {artist['name']} ({', '.join(genre)})")
+
+    # 再生1回ごとにそのアーティストのジャンルを数える（これまでのスコア計算と同じ重み付け）
+    artist_info_box = [artists[aid] for aid in artist_ids if aid in artists]
+    print(f"🎨 アーティスト情報を{len(artists)}件（再生{len(artist_info_box)}件分）読み込み完了")
+
+    # ===============================
+    # 🧮 定義スコア計算
+    # ===============================
+    genre_index = get_genre_index()
+    for artist_info in artist_info_box:
+        genres = artist_info.get("genres", [])
+        for g in genres:
+            weight = genre_weight(g, genre_index)
+            definition_score += weight
+            influenced_word_box.append(g)
+            print(f"{g}: {weight}")
+        if artist_info["name"] == "The Beatles":
+            definition_score += 50
+
+    # 動物の確定（しきい値は data/animal_thresholds.yaml）
+    character_animal = classify_animal(definition_score)
+
+    #if user_id == "noel1109.marble1101":
+    #    character_animal = "dolphin"
+
+    # ✅ リサイズ・エンコード済みのテンプレートを使う（全ユーザー共通なので事前に作っておける）
+    image_data_uri = get_template_data_uri(character_animal)
+    if image_data_uri is None:
+        raise CardRequestError(f"Template not found: {template_path(character_animal)}", 404)
+
+    influenced_word = random.choice(influenced_word_box)
+    album_image_url = random.choice(album_image_url_box)
+
+    print(f"\n🏆 あなたの音楽スコア: {definition_score}")
+    print(f"動物: {character_animal}")
+    print(f"キーワード: {influenced_word}")
+    print(f"アルバム画像: {album_image_url}")
+    atk = int(Decimal(definition_score).quantize(Decimal('1e2')))
+    print(f"攻撃力: {atk}")
+    if len(influenced_word.split())<=2:
+        creature_name = f"{influenced_word} {character_animal}"
+    else:  
+        creature_name = f"The {character_animal} of {influenced_word}"
+    creature_name = creature_name.title()
+    # ✅ 正規表現で不要部分を削除
+    creature_name = re.sub(r"[\-\(\[].*?(Remaster|Live|Remix|Version).*?[\)\]]", "", creature_name, flags=re.IGNORECASE)
+    creature_name = re.sub(r"\s{2,}", " ", creature_name).strip()  # 余分なスペースを削除
+    print(f"名前: {creature_name}")
+
+    prompt = (
+        f"Legendary creature in {character_animal} of picture is a soldier or knight of alien has some weapons and from a dark and mysterious world."
+        f"It has some factor relevant to the phrase of {influenced_word}. " #Background image is {album_image_url}
+        f"It is also designed like creepy spooky monsters in SF or horror films but not cartoonish rather realistic."
+    )
+    print(prompt)
+    return {
+        "title": creature_name,
+        "atk": atk,
+        "animal": character_animal,
+        "prompt": prompt,
+        "track_uris": source_track_uris,
+        "template_data_uri": image_data_uri,
+    }
+
+
+def template_image(card, refresh=False):
+    """The template to send with a prediction: the uploaded file's URL, or the inline data URI."""
+    #chosen_img = random.choice([album_image_url, image_data_uri])
+    if not TEMPLATE_UPLOADS:
+        return card["template_data_uri"]
+    # 📤 アップロード済みテンプレートのURLを送る（数MBのbase64を毎回送らない）
+    return get_template_url(
+        redis_client, card["animal"], REPLICATE_API_BASE, REPLICATE_API_TOKEN, refresh=refresh
+    ) or card["template_data_uri"]
+
+
+def replicate_headers():
+    return {
+        "Authorization": f"Token {REPLICATE_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+
+def prediction_request(card, image):
+    """Body of the Replicate ``POST /predictions`` for a planned card."""
+    MODEL_VERSION = random.choice([
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
+        "17658fb151a7dd2fe9a0043990c24913d7b97a6b35dcd953a27a366fedc4e20a", 
+        "535fdb4d34d13e899f8a61c3172ef1698230bed3c2faa0a17708abde760a5f64",
+        "40ab9b32cc4584bc069e22027fffb97e79ed550d4e7c20ed6d5d7ef89e8f08f5",
+        "e57c2dfbc48a476779abad3b6695839ecb779c18d0ec95f16d1f677a99cb3a42",
+        "08ea3dfde168eed9cdc4956ba0e9a506f56c9f74f96c0809a3250d10a9c77986",
+        "d53918f6a274da520ba36474408999d2f91ea9c2c5afb17abef15c6c42030963",
+        "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
+        "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
+        "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
+        "15c6189d8a95836c3c296333aac9c416da4dfb0ae42650d4f10189441f29529f",
+        "15c6189d8a95836c3c296333aac9c416da4dfb0ae42650d4f10189441f29529f",
+        "bd2b772a22ecb2051cb1e08b58756fd2999781610ae618c52b5f4f76124c53d1",
+        "262c44d38a47d71dc0168728963b5549666a5be21d1a04b87675d3f682ed7267"
+
+    ])
+    print(MODEL_VERSION)
+    #MODEL_VERSION="262c44d38a47d71dc0168728963b5549666a5be21d1a04b87675d3f682ed7267"
+
+    payload = {
+        "version": MODEL_VERSION,
+        "input": {
+            "prompt": card["prompt"],
+            "image": image,
+            "strength": 0.9,
+            "num_outputs": 1,
+            "aspect_ratio": "3:4"
+        }
+    }
+    # 📮 完了通知は webhook で受け取る（ポーリングのたびに Replicate へ問い合わせない）
+    if webhooks_enabled():
+        payload["webhook"] = f"{PUBLIC_BASE_URL}/webhooks/replicate"
+        payload["webhook_events_filter"] = ["start", "completed"]
+    return payload
+
+
+def template_rejected(status_code, image, card):
+    """True when Replicate refused an uploaded template URL (expired file etc.)."""
+    return status_code in TEMPLATE_REJECTED_STATUSES and image != card["template_data_uri"]
+
+
+def store_new_prediction(prediction, user_id, card, base_url):
+    """Record a created prediction and what finishing needs; returns the /generate_api JSON."""
+    redis_client.setex(
+        f"{SOURCE_TRACKS_PREFIX}{prediction['id']}",
+        60 * 60 * 24,
+        json.dumps({"user_id": user_id, "track_uris": card["track_uris"]}),
+    )
+
+    # 🧠 タイトル・ATK など仕上げに必要な情報を保存（webhook・worker から参照）
+    redis_client.setex(
+        f"{CARD_SPEC_PREFIX}{prediction['id']}",
+        CARD_STATUS_TTL,
+        json.dumps({
+            "title": card["title"],
+            "atk": card["atk"],
+            "user_id": user_id,
+            "base_url": base_url,
+        }),
+    )
+    record_prediction(prediction)
+
+    return {
+        "prediction_id": prediction["id"],
+        "status_url": f"/result/{prediction['id']}"
+    }
+
+
+def migrate_session_token(user_id, legacy_session):
+    """Move a token left in an old-style session into the token service (pops it from the session)."""
+    if "refresh_token" not in legacy_session:
+        return
+    legacy_token = {key: legacy_session.pop(key, None) for key in ("access_token", "refresh_token", "expires_at")}
+    if legacy_token["access_token"] and not spotify_tokens.load_token(redis_client, user_id):
+        spotify_tokens.save_token(redis_client, user_id, legacy_token)
+
+
+def migrate_loaded_session_token(user_id, user_session):
+    """``migrate_session_token`` for a session from ``load_session``, which is then saved without the token."""
+    if "refresh_token" not in user_session:
+        return
+    migrate_session_token(user_id, user_session)
+    # Flask の外なのでセッションは自動で保存されない。Cookie の sid はそのままなのでレスポンスは捨ててよい
+    app.session_interface.save_session(app, user_session, app.response_class())
+
+
+def queue_finishing_backlog(pipe):
+    """Queue the reads ``finishing_retry_after`` needs on a (sync or async) pipeline."""
+    ready, inflight, delayed = job_queue.queue_keys(CARD_QUEUE)[:3]
+    pipe.llen(ready)
+    pipe.zcard(inflight)
+    pipe.zcard(delayed)  # 満杯で後回しにされたカードも待ちに数える
+    pipe.get(RENDER_SECONDS_KEY)
+
+
+def finishing_retry_after(ready, inflight, delayed, render_seconds):
+    """Seconds to tell the client to wait when too many cards await finishing, else None."""
+    backlog = int(ready) + int(inflight) + int(delayed)
+    if FINISH_BACKLOG_MAX <= 0 or backlog < FINISH_BACKLOG_MAX:
+        return None
+    return card_render.retry_after_seconds(
+        backlog - FINISH_BACKLOG_MAX + 1, render_seconds=float(render_seconds or 0)
+    )
+
+
+def finishing_busy_body(retry_after):
+    return {"status": "busy", "retry_after": retry_after}
+
+
 # AI画像生成エンドポイント
 @app.route("/generate_api/<user_id>", methods=["GET"])
 def generate_image(user_id):
@@ -346,302 +1379,59 @@ def generate_image(user_id):
         if not current_user or current_user != user_id:
             print("❌ セッション不一致: 他ユーザーアクセス検出")
             return jsonify({"status": "login_required"}), 401
-        
-        # トークン有効期限チェック
-        if time.time() > session.get("expires_at", 0):
-            sp_oauth = get_spotify_oauth()
-            refresh_token = session.get("refresh_token")
-            new_token = sp_oauth.refresh_access_token(refresh_token)
-            session["access_token"] = new_token["access_token"]
-            session["expires_at"] = new_token["expires_at"]
-        
-        access_token = session.get("access_token")
+
+        # 仕上げ待ちのカードが多すぎるときは Spotify・Replicate を呼ぶ前に断る
+        pipe = redis_client.pipeline()
+        queue_finishing_backlog(pipe)
+        retry_after = finishing_retry_after(*pipe.execute())
+        if retry_after:
+            response = jsonify(finishing_busy_body(retry_after))
+            response.headers["Retry-After"] = str(retry_after)
+            return response, 503
+
+        # 旧形式のセッションに残っているトークンをトークンサービスに移す
+        migrate_session_token(user_id, session)
+
+        # トークンは期限前に更新される（同じユーザーの同時更新はロックで1回にまとめる）
+        access_token = user_access_token(user_id)
         if not access_token:
             return jsonify({"error": "No valid access token"}), 401
 
-        sp = Spotify(auth=access_token)
+        sp = spotify_client(access_token)
         print("Spotifyからデータ取得できた")
 
         # ===============================
-        # 🟢 Spotify再生履歴のキャッシュ処理
+        # 🟢 Spotify再生履歴（前回以降の差分だけ取得して Redis に蓄積）
         # ===============================
-        cache_key = f"recently_played:{user_id}"
-        cached_data = redis_client.get(cache_key)
-
-        if cached_data:
-            recent = json.loads(cached_data)
-            print("🟢 Redisキャッシュから再生履歴を取得")
-        else:
-            print("🟠 Spotify APIから再生履歴を取得")
-            try:
-                recent = sp.current_user_recently_played(limit=50)
-                redis_client.setex(cache_key, 1800, json.dumps(recent))  
-            except Exception as e:
-                print("🚨 Spotify API error:", e)
-                return jsonify({"error": "Spotify data fetch failed"}), 500
-
-        if not recent.get("items"):
-            return "No recent tracks found.", 404
-
-        source_track_uris = [
-            item.get("track", {}).get("uri") for item in recent["items"]
-            if item.get("track", {}).get("uri")
-        ]
-        if not source_track_uris:
-            return "No playable recent tracks found.", 404
-        
-        # ✅ Redis に保存（10分キャッシュ）
-        redis_client.setex(cache_key, 1800, json.dumps(recent))
-
-        # 🎨 ベースとなるテンプレート画像を選択
-        definition_score = 0
-        influenced_word_box = []
-        album_image_url_box = []
-        creature_name = ""
-        artist_ids = []
-        artist_info_box = []
-
-        
-        print("\n🎵 最近再生した曲:")
-        # 🎵 アーティストIDを抽出（重複除去）
-        for item in recent["items"]:
-            artist = item["track"]["artists"][0]
-            artist_ids.append(artist["id"])
-            track = item["track"]
-            genre = artist.get("genres", [])
-
-            album_image_url_box.append(track['album']['images'][0]['url'])
-            influenced_word_box.append(track['name'])
-            influenced_word_box.append(artist['name'])
-
-            artist_ids = list(artist_ids)
-
-            print(f"{track['name']} / {artist['name']} ({', '.join(genre)})")
-            # ===============================
-            # 🧠 アーティスト情報を一括取得＋キャッシュ
-            # ===============================
-            artist_info_box = []
-            uncached_ids = []
-            for aid in artist_ids:
-                cached_artist = redis_client.get(f"artist_info:{aid}")
-                if cached_artist:
-                    artist_info_box.append(json.loads(cached_artist))
-                else:
-                    uncached_ids.append(aid)
-
-            if uncached_ids:
-                print(f"🕐 Spotify APIに問い合わせ（未キャッシュ）: {len(uncached_ids)}件")
-                # 一括で取得（最大50件）
-                try:
-                    batch_info = sp.artists(uncached_ids)["artists"]
-                    for info in batch_info:
-                        redis_client.setex(f"artist_info:{info['id']}", 86400, json.dumps(info))  # 24hキャッシュ
-                    artist_info_box.extend(batch_info)
-                except Exception as e:
-                    print("🚨 Spotify artist API batch error:", e)
-                    time.sleep(0.1)  # rate-limit保護
-            else:
-                print("✅ 全てキャッシュから取得")
-
-            print(f"🎨 アーティスト情報を{len(artist_info_box)}件読み込み完了")
+        try:
+            items = sync_recent_plays(redis_client, sp, user_id, HISTORY_WINDOW)
+        except Exception as e:
+            print("🚨 Spotify API error:", e)
+            return jsonify({"error": "Spotify data fetch failed"}), 500
 
         # ===============================
-        # 🧮 定義スコア計算
+        # 🧠 アーティスト情報を一括取得＋キャッシュ（ループの外で1回だけ）
         # ===============================
-        for artist_info in artist_info_box:
-            genres = artist_info.get("genres", [])
-            for g in genres:
-                definition_score += genre_weights.get(g, 0)
-                influenced_word_box.append(g)
-                print(f"{g}: {genre_weights.get(g)}")
-            if artist_info["name"] == "The Beatles":
-                definition_score += 50
-
-        # 動物の確定
-        if definition_score <= 2000:
-            character_animal = "bug"
-        elif definition_score <= 2200:
-            character_animal = "grasshopper"
-        elif definition_score <= 2400:
-            character_animal = "saury"
-        elif definition_score <= 2600:
-            character_animal = "fish"
-        elif definition_score <= 2800:
-            character_animal = "squid"
-        elif definition_score <= 3000:
-            character_animal = "crab"    
-        elif definition_score <= 3200:
-            character_animal = "lobster"
-        elif definition_score <= 3400:
-            character_animal = "octopus"
-        elif definition_score <= 3600:
-            character_animal = "parrot-fish"
-        elif definition_score <= 3800:
-            character_animal = "fish-market"
-        elif definition_score <= 4000:
-            character_animal = "frog"
-        elif definition_score <= 4200:
-            character_animal = "snake"
-        elif definition_score <= 4400:
-            character_animal = "shark"
-        elif definition_score <= 4600:
-            character_animal = "horse"
-        elif definition_score <= 4800:
-            character_animal = "baby-cicada"
-        elif definition_score <= 5000:
-            character_animal = "giraffe"
-        elif definition_score <= 5200:
-            character_animal = "dog"
-        elif definition_score <= 5400:
-            character_animal = "orangutan"
-        elif definition_score <= 5600:
-            character_animal = "lion"
-        elif definition_score <= 5800:
-            character_animal = "eel"
-        elif definition_score <= 6000:
-            character_animal = "sloth"
-        elif definition_score <= 6200:
-            character_animal = "dolphin"
-        elif definition_score <= 6400:
-            character_animal = "seal"
-        elif definition_score <= 6600:
-            character_animal = "penguin"
-        elif definition_score <= 6800:
-            character_animal = "pelican"
-        elif definition_score <= 7000:
-            character_animal = "tuna"
-        elif definition_score <= 7200:
-            character_animal = "bear"
-        elif definition_score <= 7400:
-            character_animal = "goat"
-        elif definition_score <= 7600:
-            character_animal = "dogu"
-        elif definition_score <= 7800:
-            character_animal = "crocodile"
-        elif definition_score <= 8500:
-            character_animal = "cat"
-        elif definition_score <= 9900:
-            character_animal = "T-rex"
-        elif definition_score <= 10500:
-            character_animal = "parrot"
-        elif definition_score <= 11000:
-            character_animal = "cats"
-        elif definition_score <= 11500:
-            character_animal = "toy-dog"
-        elif definition_score <= 12000:
-            character_animal = "love-cat"
-        else:
-            character_animal = "dragon"
-
-        #if user_id == "noel1109.marble1101":
-        #    character_animal = "dolphin"
-
-        base_image_path = f"animal_templates/{character_animal}.png"
-        if not os.path.exists(base_image_path):
-            return f"Template not found: {base_image_path}", 404
-        
-        influenced_word = random.choice(influenced_word_box)
-        album_image_url = random.choice(album_image_url_box)
-
-        print(f"\n🏆 あなたの音楽スコア: {definition_score}")
-        print(f"動物: {character_animal}")
-        print(f"キーワード: {influenced_word}")
-        print(f"アルバム画像: {album_image_url}")
-        atk = int(Decimal(definition_score).quantize(Decimal('1e2')))
-        print(f"攻撃力: {atk}")
-        if len(influenced_word.split())<=2:
-            creature_name = f"{influenced_word} {character_animal}"
-        else:  
-            creature_name = f"The {character_animal} of {influenced_word}"
-        creature_name = creature_name.title()
-        # ✅ 正規表現で不要部分を削除
-        creature_name = re.sub(r"[\-\(\[].*?(Remaster|Live|Remix|Version).*?[\)\]]", "", creature_name, flags=re.IGNORECASE)
-        creature_name = re.sub(r"\s{2,}", " ", creature_name).strip()  # 余分なスペースを削除
-        print(f"名前: {creature_name}")
-
-        # 3:4 比率にリサイズ（幅768, 高さ1024など）
-        img = Image.open(base_image_path).resize((768, 1024))
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        image_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        image_data_uri = f"data:image/png;base64,{image_b64}"
-
-        prompt = (
-            f"Legendary creature in {character_animal} of picture is a soldier or knight of alien has some weapons and from a dark and mysterious world."
-            f"It has some factor relevant to the phrase of {influenced_word}. " #Background image is {album_image_url}
-            f"It is also designed like creepy spooky monsters in SF or horror films but not cartoonish rather realistic."
-        )
-        print(prompt)
-
-        headers = {
-            "Authorization": f"Token {REPLICATE_API_TOKEN}",
-            "Content-Type": "application/json",
-        }
-
-        MODEL_VERSION = random.choice([
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "294de709b06655e61bb0149ec61ef8b5d3ca030517528ac34f8252b18b09b7ad",
-            "17658fb151a7dd2fe9a0043990c24913d7b97a6b35dcd953a27a366fedc4e20a", 
-            "535fdb4d34d13e899f8a61c3172ef1698230bed3c2faa0a17708abde760a5f64",
-            "40ab9b32cc4584bc069e22027fffb97e79ed550d4e7c20ed6d5d7ef89e8f08f5",
-            "e57c2dfbc48a476779abad3b6695839ecb779c18d0ec95f16d1f677a99cb3a42",
-            "08ea3dfde168eed9cdc4956ba0e9a506f56c9f74f96c0809a3250d10a9c77986",
-            "d53918f6a274da520ba36474408999d2f91ea9c2c5afb17abef15c6c42030963",
-            "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
-            "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
-            "426affa4cca9beb69b34c92c54133196902a4bf72dba90718f0de3124418eedb",
-            "15c6189d8a95836c3c296333aac9c416da4dfb0ae42650d4f10189441f29529f",
-            "15c6189d8a95836c3c296333aac9c416da4dfb0ae42650d4f10189441f29529f",
-            "bd2b772a22ecb2051cb1e08b58756fd2999781610ae618c52b5f4f76124c53d1",
-            "262c44d38a47d71dc0168728963b5549666a5be21d1a04b87675d3f682ed7267"
-
-        ])
-        print(MODEL_VERSION)
-        #MODEL_VERSION="262c44d38a47d71dc0168728963b5549666a5be21d1a04b87675d3f682ed7267"
-
-        
-        #chosen_img = random.choice([album_image_url, image_data_uri])
-        chosen_img = image_data_uri
-
-        payload = {
-            "version": MODEL_VERSION,
-            "input": {
-                "prompt": prompt,
-                "image": chosen_img,
-                "strength": 0.9,
-                "num_outputs": 1,
-                "aspect_ratio": "3:4"
-            }
-        }
+        artists = resolve_artists(sp, played_artist_ids(items))
+        card = plan_card(items, artists)
 
         # ✅ 非同期でpredictionを作成
-        res = requests.post("https://api.replicate.com/v1/predictions", headers=headers, json=payload, timeout=120)
+        image = template_image(card)
+        payload = prediction_request(card, image)
+        res = http_client.post(f"{REPLICATE_API_BASE}/predictions", headers=replicate_headers(), json=payload, timeout=120)
+        if template_rejected(res.status_code, image, card):
+            # ファイルの期限切れなどでURLが使えなかった場合は一度だけ再アップロードしてやり直す
+            print(f"⚠️ Template URL rejected ({res.status_code}), re-uploading: {card['animal']}")
+            payload["input"]["image"] = template_image(card, refresh=True)
+            res = http_client.post(f"{REPLICATE_API_BASE}/predictions", headers=replicate_headers(), json=payload, timeout=120)
         if res.status_code != 201:
             return f"Image generation failed: {res.text}", 500
 
-        prediction = res.json()
-
-        redis_client.setex(
-            f"{SOURCE_TRACKS_PREFIX}{prediction['id']}",
-            60 * 60 * 24,
-            json.dumps({"user_id": user_id, "track_uris": source_track_uris}),
-        )
-
-        # 🧠 creature_name をセッションに保存（後でタイトルに使う）
-        session["creature_name"] = creature_name
-        session["atk"] = atk
-
-        return jsonify({
-            "prediction_id": prediction["id"],
-            "status_url": f"/result/{prediction["id"]}"
-        })
+        return jsonify(store_new_prediction(
+            res.json(), user_id, card, PUBLIC_BASE_URL or request.host_url.rstrip("/")
+        ))
+    except CardRequestError as error:
+        return error.body, error.status
     except Exception as e:
         print("🚨 /generate_api エラー発生:", e)
         import traceback
@@ -659,260 +1449,253 @@ def generate_page(user_id):
 # =====================
 @app.route("/result/<prediction_id>", methods=["GET"])
 def get_result(prediction_id):
+    access_error = card_access_error(prediction_id)
+    if access_error:
+        return access_error
 
-    current_user = session.get("user_id")
-    if not current_user:
-        return jsonify({"status": "login_required"}), 401
+    payload = card_status_payload(prediction_id)
+    if payload is None:
+        return "Failed to fetch prediction.", 500
+    return jsonify(payload)
 
-    source = redis_client.get(f"{SOURCE_TRACKS_PREFIX}{prediction_id}")
-    if source:
-        if isinstance(source, bytes):
-            source = source.decode("utf-8")
-        if json.loads(source).get("user_id") != current_user:
-            return jsonify({"status": "forbidden"}), 403
 
-    headers = {"Authorization": f"Token {REPLICATE_API_TOKEN}"}
-    res = requests.get(f"https://api.replicate.com/v1/predictions/{prediction_id}", headers=headers)
-    if res.status_code != 200:
-        return f"Failed to fetch prediction: {res.text}", 500
+def status_refresh_seconds():
+    # webhook があれば pub/sub だけで足りる。無ければ数秒ごとに Replicate と突き合わせる
+    return STATUS_KEEPALIVE_SECONDS if webhooks_enabled() else 3
 
-    data = res.json()
-    
-    if data["status"] != "succeeded":
-        return jsonify({"status": data["status"], "image_url": None})
-    
-    # ✅ 生成された画像URLを取得
-    image_url = data["output"][0]
-    response = requests.get(image_url)
-    img = Image.open(BytesIO(response.content)).convert("RGB")
-    img = img.convert("RGBA")  # RGBAに戻す（透明合成OKにする）
-
-    # =============================
-    # ✨ ホログラム風エフェクト生成処理
-    # =============================
-    width, height = img.size
-
-    # グラデーションレイヤー（虹色の光）
-    gradient = Image.new("RGBA", img.size)
-    for x in range(width):
-        r = int(128 + 127 * np.sin(x / 20.0))
-        g = int(128 + 127 * np.sin(x / 25.0 + 2))
-        b = int(128 + 127 * np.sin(x / 30.0 + 4))
-        for y in range(height):
-            gradient.putpixel((x, y), (r, g, b, 40))
-
-    # ノイズレイヤー
-    noise = Image.effect_noise(img.size, 64).convert("L")
-    noise = ImageEnhance.Contrast(noise).enhance(2.0)
-    noise_colored = Image.merge("RGBA", (noise, noise, noise, noise))
-    noise_colored.putalpha(40)
-
-    # ✨ エフェクト合成
-    holo = Image.alpha_composite(img, gradient)
-    holo = Image.alpha_composite(holo, noise_colored)
-    holo = holo.filter(ImageFilter.SMOOTH_MORE)
-    holo = ImageEnhance.Brightness(holo).enhance(1.05)
-    holo = ImageEnhance.Contrast(holo).enhance(1.1)
-    # ✨ グリッター効果を全体に追加
-    if random.random() < 0.01:
-        holo = add_glitter_effect(holo, glitter_density=0.009, blur=0.3, alpha=225)
-        print("✨ グリッターを付与しました！（10% 確率）")
-
-    # =============================
-    # 🏷️ タイトル・ユーザー名・カードID描画
-    # =============================
-    draw = ImageDraw.Draw(holo)
 
-    # ✅ generate_api で作成した creature_name をそのままタイトルとして使用
-    ai_title = session.get("creature_name", "Unknown Creature")
-    atk = session.get("atk", "0")
-    user_name = session.get("user_id", "UnknownUser")
-    card_id = f"#{prediction_id[:8].upper()}"
+def _subscribe_card_events(prediction_id):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"{CARD_EVENTS_PREFIX}{prediction_id}")
+    return pubsub
 
-    try:
-        font_title = ImageFont.truetype("static/fonts/SuperBread-ywdRV.ttf", 50)
-        font_info = ImageFont.truetype("static/fonts/Caprasimo-Regular.ttf", 10)
-    except:
-        font_title = ImageFont.load_default()
-        font_info = ImageFont.load_default()
-
-    # 🪄 タイトルを別レイヤーで生成
-    title_layer = Image.new("RGBA", holo.size, (0, 0, 0, 0))
-    title_draw = ImageDraw.Draw(title_layer)
-
-    title_bbox = title_draw.textbbox((0, 0), ai_title, font=font_title)
-    tw = title_bbox[2] - title_bbox[0]
-    th = title_bbox[3] - title_bbox[1]
-    x_pos = (width - tw) / 2
-    y_pos = 5
-
-    # 🌈 虹色グラデーション文字描画
-    gradient_colors = [
-        (255, 0, 0),     # 赤
-        (255, 127, 70),   # オレンジ
-        (200, 200, 70),   # 黄
-        (100, 230, 70),     # 緑
-        (0, 0, 255),     # 青
-        (75, 0, 130),    # 藍
-        (148, 0, 211)    # 紫
-    ]
 
-    # アウトラインの太さ（調整可能）
-    outline_width = 4
-    outline_color = (255, 255, 255, 255)  # 白
-    shadow_offset = (6, 6)  # シャドウのずらし量
-    shadow_color = (0, 0, 0, 180)  # 半透明の黒い影
-
-    # 描画位置を最初に戻す
-    x_pos = (holo.width - tw) / 2
-    y_pos = 5
-
-    # 各文字に色をつける
-    for i, char in enumerate(ai_title):
-        color = gradient_colors[i % len(gradient_colors)]
-        # --- シャドウ ---
-        title_draw.text(
-            (x_pos + shadow_offset[0], y_pos + shadow_offset[1]),
-            char,
-            font=font_title,
-            fill=shadow_color
-        )
+def card_payload_settled(payload):
+    """True once a /result payload can no longer change: final status and no pending playlist."""
+    return (
+        payload["status"] in FINAL_CARD_STATUSES
+        and payload.get("playlist_status") != PLAYLIST_PENDING
+    )
 
-        for dx in range(-outline_width, outline_width + 1):
-            for dy in range(-outline_width, outline_width + 1):
-                if dx**2 + dy**2 <= outline_width**2:  # 円形に近い外枠
-                    title_draw.text(
-                        (x_pos + dx, y_pos + dy),
-                        char,
-                        font=font_title,
-                        fill=outline_color
-                    )
-        # --- 本体の文字を描画 ---
-        title_draw.text((x_pos, y_pos), char, font=font_title, fill=color + (255,))
-        # 次の文字の横位置を取得
-        char_width = title_draw.textbbox((0,0), char, font=font_title)[2] - title_draw.textbbox((0,0), char, font=font_title)[0]
-        x_pos += char_width
-
-    # 🎛 タイトル専用フィルターを適用
-    filtered_title = title_layer.copy()
-    filtered_title = filtered_title.filter(ImageFilter.SMOOTH_MORE)
-    filtered_title = ImageEnhance.Brightness(filtered_title).enhance(0.9)
-    filtered_title = ImageEnhance.Contrast(filtered_title).enhance(0.9)
-    
-    # 💫 glowを生成
-    glow = filtered_title.filter(ImageFilter.GaussianBlur(6))
-    glow = ImageEnhance.Brightness(glow).enhance(1.6)
-
-    # ✅ 背景（holo）には一切影響を与えず、ここで初めて合成
-    final_image = holo.copy()
-    final_image = Image.alpha_composite(final_image, glow)
-    final_image = Image.alpha_composite(final_image, filtered_title)
-
-    # -------------------------
-    # ATKレイヤー（タイトルと同様の処理）を作成して合成
-    # -------------------------
-    atk_text = f"ATK: {atk}"
+
+def long_poll_timeout(raw):
+    """Seconds a /wait request may hold, from its ?timeout= (at most LONG_POLL_MAX_SECONDS)."""
     try:
-        font_atk = ImageFont.truetype("static/fonts/Caprasimo-Regular.ttf", 44)
-    except Exception:
-        font_atk = ImageFont.load_default()
-
-    atk_layer = Image.new("RGBA", holo.size, (0,0,0,0))
-    atk_draw = ImageDraw.Draw(atk_layer)
-    atk_bbox = atk_draw.textbbox((0,0), atk_text, font=font_atk)
-    atk_w = atk_bbox[2] - atk_bbox[0]
-    atk_h = atk_bbox[3] - atk_bbox[1]
-
-    # 位置：カードID の上に来るように調整（マージンで調整可）
-    margin = 40
-    x_atk = width - atk_w - margin
-    y_atk = height - atk_h - margin - 30  # IDの上に配置（60px 上）
-
-    # 描画（シャドウ・白枠・虹色）
-    x_write = x_atk
-    for i, char in enumerate(atk_text):
-        color = gradient_colors[i % len(gradient_colors)]
-        # shadow
-        atk_draw.text((x_write + shadow_offset[0], y_atk + shadow_offset[1]), char, font=font_atk, fill=shadow_color)
-        # outline
-        for dx in range(-outline_width, outline_width + 1):
-            for dy in range(-outline_width, outline_width + 1):
-                if dx*dx + dy*dy <= outline_width*outline_width:
-                    atk_draw.text((x_write + dx, y_atk + dy), char, font=font_atk, fill=outline_color)
-        # main
-        atk_draw.text((x_write, y_atk), char, font=font_atk, fill=color + (255,))
-        cw = atk_draw.textbbox((0,0), char, font=font_atk)[2] - atk_draw.textbbox((0,0), char, font=font_atk)[0]
-        x_write += cw
-
-    # フィルタ・alpha・glow をタイトルと揃える
-    filtered_atk = atk_layer.copy()
-    filtered_atk = filtered_atk.filter(ImageFilter.SMOOTH_MORE)
-    filtered_atk = ImageEnhance.Brightness(filtered_atk).enhance(0.95)
-    filtered_atk = ImageEnhance.Contrast(filtered_atk).enhance(1.05)
-
-    atk_glow = filtered_atk.filter(ImageFilter.GaussianBlur(6))
-    atk_glow = ImageEnhance.Brightness(atk_glow).enhance(1.6)
-
-    # 合成
-    final_image = Image.alpha_composite(final_image, atk_glow)
-    final_image = Image.alpha_composite(final_image, filtered_atk)
-
-
-    # =============================
-    # 🔠 カードIDを右下に寄せて描画
-    # =============================
-    draw_final = ImageDraw.Draw(final_image)
-    info_text = f"{card_id}"
-    info_bbox = draw_final.textbbox((0, 0), info_text, font=font_info)
-    iw = info_bbox[2] - info_bbox[0]
-    ih = info_bbox[3] - info_bbox[1]
-    draw_final.text(
-        (final_image.width - iw - 40, final_image.height - ih - 20),
-        info_text,
-        font=font_info,
-        fill=(255, 255, 255, 230)
+        return min(float(raw), LONG_POLL_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return LONG_POLL_MAX_SECONDS
+
+
+def long_poll_waiting(payload, last_status, last_playlist_status, deadline):
+    """True while a /wait request should hold: the client already has this payload and it can still change."""
+    return (
+        payload is not None
+        and payload["status"] == last_status
+        and payload.get("playlist_status", "") == last_playlist_status
+        and not card_payload_settled(payload)
+        and time.time() < deadline
     )
 
-    # =============================
-    # 保存処理
-    # =============================
-    output_path = f"static/generated/hologram_{prediction_id}.png"
-    os.makedirs("static/generated", exist_ok=True)
-    final_image.save(output_path)
-    print(f"✅ タイトル付きホログラム画像を生成: {output_path}")
 
-    base_url = request.host_url.rstrip("/")
-    full_image_url = f"{base_url}/{output_path}"
+STATUS_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+STATUS_STREAM_KEEPALIVE = ": keepalive\n\n"
+
+
+def status_event(payload):
+    return f"event: status\ndata: {json.dumps(payload)}\n\n"
+
+
+def stream_start_payload(payload):
+    """First payload of an /events stream (a card not known yet is starting)."""
+    return payload or {"status": "starting", "image_url": None}
+
+
+def stream_open(payload, deadline):
+    return not card_payload_settled(payload) and time.time() < deadline
+
+
+def refreshed_stream_payload(payload, refreshed):
+    """Payload to send after re-reading the state with no event, or None to send a keepalive."""
+    if not refreshed or refreshed == payload:
+        return None
+    return refreshed
+
+
+@app.route("/result/<prediction_id>/events", methods=["GET"])
+def result_events(prediction_id):
+    """Server-Sent Events stream of status transitions.
+
+    Ends on failed, or on succeeded once the card's playlist is ready or failed.
+    """
+    access_error = card_access_error(prediction_id)
+    if access_error:
+        return access_error
+
+    def stream():
+        # 現在の状態を読む前に購読して、その間の更新を取りこぼさない
+        pubsub = _subscribe_card_events(prediction_id)
+        try:
+            payload = stream_start_payload(card_status_payload(prediction_id))
+            yield status_event(payload)
+            deadline = time.time() + STATUS_STREAM_SECONDS
+            while stream_open(payload, deadline):
+                message = pubsub.get_message(timeout=status_refresh_seconds())
+                if message:
+                    payload = json.loads(message["data"])
+                else:
+                    refreshed = refreshed_stream_payload(payload, card_status_payload(prediction_id))
+                    if refreshed is None:
+                        yield STATUS_STREAM_KEEPALIVE
+                        continue
+                    payload = refreshed
+                yield status_event(payload)
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype="text/event-stream", headers=STATUS_STREAM_HEADERS)
+
+
+@app.route("/result/<prediction_id>/wait", methods=["GET"])
+def result_wait(prediction_id):
+    """Long-poll fallback: return as soon as the status differs from ?status= (or the playlist state from ?playlist=)."""
+    access_error = card_access_error(prediction_id)
+    if access_error:
+        return access_error
+
+    last_status = request.args.get("status", "")
+    last_playlist_status = request.args.get("playlist", "")
+    deadline = time.time() + long_poll_timeout(request.args.get("timeout"))
+
+    pubsub = _subscribe_card_events(prediction_id)
+    try:
+        payload = card_status_payload(prediction_id)
+        while long_poll_waiting(payload, last_status, last_playlist_status, deadline):
+            remaining = deadline - time.time()
+            message = pubsub.get_message(timeout=min(remaining, status_refresh_seconds()))
+            payload = json.loads(message["data"]) if message else card_status_payload(prediction_id)
+    finally:
+        pubsub.close()
+
+    if payload is None:
+        return "Failed to fetch prediction.", 500
+    return jsonify(payload)
+
+
+# =====================
+# Replicate webhook
+# =====================
+@app.route("/webhooks/replicate", methods=["POST"])
+def replicate_webhook():
+    body = request.get_data()
+    if not verify_replicate_webhook(request.headers, body):
+        return jsonify({"status": "invalid_signature"}), 401
+    try:
+        prediction = json.loads(body)
+    except ValueError:
+        return jsonify({"status": "invalid_payload"}), 400
+    if not isinstance(prediction, dict) or not prediction.get("id"):
+        return jsonify({"status": "invalid_payload"}), 400
+
+    # 同じ webhook-id は署名の有効期間（前後 WEBHOOK_TOLERANCE_SECONDS）の間は1回しか適用しない
+    seen_key = f"{WEBHOOK_SEEN_PREFIX}{request.headers['webhook-id']}"
+    if redis_client.exists(seen_key):
+        print(f"⚠️ Replicate webhook replayed, ignored: {request.headers['webhook-id']}")
+        return jsonify({"status": "duplicate"})
+
+    state = record_prediction(prediction)
+    # 記録できてから覚える（途中で失敗した配信は Replicate の再送で処理し直せる）
+    redis_client.set(seen_key, 1, ex=2 * WEBHOOK_TOLERANCE_SECONDS)
+    print(f"📮 Replicate webhook: {prediction['id']} {state['status']}")
+    return jsonify({"status": "ok"})
+
+
+def finish_card(prediction_id, image_url, spec):
+    """Render, save and publish a succeeded prediction, returning its result record.
+
+    ``spec`` carries what the request used to provide: title, atk,
+    user_id and base_url.  Spotify tokens are looked up per user when
+    the playlist job runs, so none are stored with the card.  The image
+    itself is finished on the ``card_render`` process pool.
+    """
+    # ✅ generate_api で作成した creature_name をそのままタイトルとして使用
+    ai_title = spec.get("title") or "Unknown Creature"
+    user_name = spec.get("user_id") or "UnknownUser"
+    card_id = f"#{prediction_id[:8].upper()}"
+
+    # ✨ ホログラム・グリッター・タイトル・ATK・カードID・WebP 化はプロセスプールで（card_render.py）
+    # 枠はダウンロードの前に確保する。満杯なら RenderQueueFull で、ジョブは Retry-After の秒数後にやり直す
+    with card_render.reserved_slot():
+        # ✅ 生成された画像URLを取得
+        response = http_client.get(image_url, timeout=(5, 60))
+        response.raise_for_status()
+        encoded = card_render.render_in_pool(response.content, {
+            "title": ai_title,
+            "atk": spec.get("atk", "0"),
+            "card_id": card_id,
+            "seed": prediction_id,
+        })
+    redis_client.set(RENDER_SECONDS_KEY, card_render.average_seconds(), ex=RENDER_SECONDS_TTL)
+
+    # 保存処理（WebP のフルサイズ・サムネイルを内容ハッシュのキーで保存）
+    images = image_store.store_variants(encoded, spec.get("base_url") or PUBLIC_BASE_URL)
+    full_image_url = images["full"]["url"]
+    print(f"✅ タイトル付きホログラム画像を保存: {full_image_url}")
 
-    source_playlist = create_source_playlist(prediction_id, card_id)
-    upload_playlist_cover(prediction_id, source_playlist, output_path)
+    # 🎧 プレイリスト作成とカバー画像は、カードを返した後に playlists キューで行う
+    redis_client.set(
+        f"{SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps({"state": PLAYLIST_PENDING}), nx=True
+    )
     save_public_card(
-        prediction_id, full_image_url, ai_title, card_id, user_name, source_playlist
+        prediction_id, full_image_url, ai_title, card_id, user_name, images=images,
     )
 
-    return jsonify({
+    finished_card = {
         "status": "succeeded",
         "image_url": full_image_url,
+        "thumb_url": images["thumb"]["url"],
         "title": ai_title,
         "card_id": card_id,
-        "playlist_url": (source_playlist or {}).get("playlist_url"),
+        "playlist_url": None,
+        "playlist_status": PLAYLIST_PENDING,
         "user": user_name
+    }
+    save_finished_card(prediction_id, finished_card)
+    job_queue.enqueue(redis_client, PLAYLIST_QUEUE, "publish_playlist", {
+        "prediction_id": prediction_id,
+        "card_id": card_id,
+        "user_id": user_name,
+        "card_url": full_image_url,
+        "image_key": images["full"]["key"],
     })
+    return finished_card
 
 # =====================
 # PWA用ファイル・静的配信
 # =====================
+# ハッシュ付きファイルは immutable、それ以外は strong ETag で再検証（static_assets.py）
 @app.route("/manifest.json")
 def manifest():
-    return send_from_directory("static", "manifest.json")
+    return static_assets.send_static("manifest.json")
 
 @app.route("/serviceWorker.js")
 def service_worker():
-    return send_from_directory("static", "serviceWorker.js")
+    return static_assets.send_service_worker()
 
 @app.route("/static/<path:filename>")
 def serve_static(filename):
-    return send_from_directory("static", filename)
+    return static_assets.send_static(filename)
+
+# local バックエンドのカード画像。IMAGE_STORE_DIR が static/ の外でも配信できるよう専用のルートで返す
+@app.route(f"/{image_store.IMAGE_KEY_PREFIX}<path:filename>")
+def serve_card_image(filename):
+    response = send_from_directory(
+        os.path.abspath(image_store.IMAGE_STORE_DIR), filename,
+        etag=os.path.splitext(os.path.basename(filename))[0],  # 名前が内容のハッシュ
+        max_age=static_assets.IMMUTABLE_MAX_AGE,
+        conditional=True,
+    )
+    response.cache_control.immutable = True
+    return response
 
 # =====================
 # Render用 Health Check
@@ -922,6 +1705,15 @@ def health_check():
     return jsonify({"status": "ok"}), 200
 
 
+@app.route("/metrics/http")
+def http_metrics():
+    """Per-endpoint latency of outbound Spotify / Replicate calls in this worker (studio owner only)."""
+    # OWNER_SPOTIFY_ID が無いと持ち主を決められないので誰にも見せない
+    if not OWNER_SPOTIFY_ID or session.get("user_id") != OWNER_SPOTIFY_ID:
+        return "This studio is private.", 403
+    return jsonify(http_client.metrics_snapshot())
+
+
 
 # =====================
 # サーバー起動
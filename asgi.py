@@ -0,0 +1,382 @@
+"""ASGI entry point with async handlers for the upstream-bound endpoints.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+``/generate_api`` and ``/result`` spend almost all of their time waiting on
+Spotify, Replicate and Redis.  Under gunicorn every waiting request holds
+one of the 2 x 8 threads, so a few slow generations and long polls fill
+the server.  Here those routes are coroutines:
+
+* Spotify and Replicate are called through one pooled ``httpx.AsyncClient``
+  (``ASGI_HTTP_CONNECTIONS``) with ``http_client``'s timeouts and retry
+  policy, and their latency is recorded in the same ``/metrics/http``;
+* Redis goes through a ``redis.asyncio`` pool (``ASGI_REDIS_CONNECTIONS``),
+  and ``/wait`` and ``/events`` listen on one shared pattern subscription
+  instead of a connection per waiting client;
+* blocking code shared with the Flask app (session decoding, token
+  refresh, scoring and template encoding/upload, recording the
+  prediction) runs on a bounded thread pool (``ASGI_EXECUTOR_THREADS``).
+
+Every other route (pages, login, gallery, webhook, static files) is the
+unchanged Flask app, mounted through ``a2wsgi`` on its own thread pool
+(``ASGI_WSGI_THREADS``).  Both deployments share Redis, so they can run
+side by side; ``SESSION_COOKIE_NAME`` must be fixed for the session to be
+readable here.  ``scripts/load_test.py`` compares the two against local
+Spotify / Replicate stubs.
+"""
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+
+import httpx
+import redis.asyncio as aioredis
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as web
+import http_client
+import spotify_tokens
+from listening_history import sync_recent_plays_async
+
+ASGI_HTTP_CONNECTIONS = int(os.getenv("ASGI_HTTP_CONNECTIONS", "100"))
+ASGI_REDIS_CONNECTIONS = int(os.getenv("ASGI_REDIS_CONNECTIONS", "64"))
+ASGI_EXECUTOR_THREADS = int(os.getenv("ASGI_EXECUTOR_THREADS", "16"))
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+REDIS_POOL_TIMEOUT = 10  # プールが空くのを待つ秒数
+LISTENER_RETRY_SECONDS = 1
+
+_http = None
+_redis = None
+_executor = None
+_listener = None
+_card_waiters = {}  # prediction_id -> そのカードを待っている asyncio.Queue の集合
+
+
+async def run_sync(func, *args):
+    """Run blocking code on the bounded executor."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(func, *args))
+
+
+async def send(method, url, **kwargs):
+    """``http_client.request`` on the async pool.
+
+    Idempotent methods are retried on ``RETRY_STATUSES`` and transport
+    errors, POST only on 429 and on connection errors (before the request
+    can have reached the server).
+    """
+    retry_statuses = (429,) if method == "POST" else http_client.RETRY_STATUSES
+    retry_errors = httpx.ConnectError if method == "POST" else httpx.TransportError
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.perf_counter()
+        try:
+            response = await _http.request(method, url, **kwargs)
+        except retry_errors:
+            http_client.record(method, url, time.perf_counter() - started)
+            if attempt > http_client.RETRY_TOTAL:
+                raise
+            await asyncio.sleep(http_client.backoff_seconds(attempt))
+            continue
+        except httpx.HTTPError:
+            http_client.record(method, url, time.perf_counter() - started)
+            raise
+        http_client.record(method, url, time.perf_counter() - started, response.status_code)
+        if response.status_code not in retry_statuses or attempt > http_client.RETRY_TOTAL:
+            return response
+        await asyncio.sleep(http_client.backoff_seconds(attempt, response.headers.get("Retry-After")))
+
+
+async def spotify_get(path, access_token, params=None):
+    response = await send(
+        "GET", f"{web.SPOTIFY_API_BASE}{path}",
+        headers={"Authorization": f"Bearer {access_token}"},
+        params=params,
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def user_access_token(user_id):
+    """Stored token when it is fresh; otherwise the token service refreshes it on the executor."""
+    token = web.decode_json(await _redis.get(spotify_tokens.token_key(user_id)))
+    if spotify_tokens.is_fresh(token, spotify_tokens.REFRESH_MARGIN_SECONDS):
+        return token["access_token"]
+    return await run_sync(web.user_access_token, user_id)
+
+
+async def resolve_artists(access_token, artist_ids):
+    """``app.resolve_artists`` with async Redis and the Spotify batches sent concurrently."""
+    unique_ids = list(dict.fromkeys(aid for aid in artist_ids if aid))
+    if not unique_ids:
+        return {}
+
+    artists, missing_ids = web.split_cached_artists(
+        unique_ids, await _redis.mget(web.artist_cache_keys(unique_ids))
+    )
+    pages = await asyncio.gather(
+        *(spotify_get("/artists", access_token, {"ids": ",".join(chunk)}) for chunk in web.artist_batches(missing_ids)),
+        return_exceptions=True,
+    )
+    fetched = []
+    for page in pages:
+        if isinstance(page, Exception):
+            print("🚨 Spotify artist API batch error:", page)
+        else:
+            fetched.extend(info for info in page["artists"] if info)
+
+    if fetched:
+        pipe = _redis.pipeline(transaction=False)
+        web.queue_artist_cache(pipe, artists, fetched)
+        await pipe.execute()
+    return artists
+
+
+async def create_prediction(payload):
+    return await send(
+        "POST", f"{web.REPLICATE_API_BASE}/predictions",
+        headers=web.replicate_headers(), json=payload, timeout=120,
+    )
+
+
+async def generate_api(request):
+    user_id = request.path_params["user_id"]
+    try:
+        user_session = await run_sync(web.load_session, request.headers.get("cookie"))
+        if user_session.get("user_id") != user_id:
+            return JSONResponse({"status": "login_required"}, status_code=401)
+
+        pipe = _redis.pipeline(transaction=False)
+        web.queue_finishing_backlog(pipe)
+        retry_after = web.finishing_retry_after(*await pipe.execute())
+        if retry_after:
+            return JSONResponse(
+                web.finishing_busy_body(retry_after), status_code=503,
+                headers={"Retry-After": str(retry_after)},
+            )
+        if "refresh_token" in user_session:
+            await run_sync(web.migrate_loaded_session_token, user_id, user_session)
+
+        access_token = await user_access_token(user_id)
+        if not access_token:
+            return JSONResponse({"error": "No valid access token"}, status_code=401)
+
+        async def fetch_recent(limit, after=None):
+            params = {"limit": limit} if after is None else {"limit": limit, "after": after}
+            return await spotify_get("/me/player/recently-played", access_token, params)
+
+        try:
+            items = await sync_recent_plays_async(_redis, fetch_recent, user_id, web.HISTORY_WINDOW)
+        except Exception as e:
+            print("🚨 Spotify API error:", e)
+            return JSONResponse({"error": "Spotify data fetch failed"}, status_code=500)
+
+        artists = await resolve_artists(access_token, web.played_artist_ids(items))
+        # スコア計算・テンプレートのエンコードは CPU を使うので executor で
+        card = await run_sync(web.plan_card, items, artists)
+
+        image = await run_sync(web.template_image, card)
+        payload = web.prediction_request(card, image)
+        res = await create_prediction(payload)
+        if web.template_rejected(res.status_code, image, card):
+            print(f"⚠️ Template URL rejected ({res.status_code}), re-uploading: {card['animal']}")
+            payload["input"]["image"] = await run_sync(partial(web.template_image, card, refresh=True))
+            res = await create_prediction(payload)
+        if res.status_code != 201:
+            return PlainTextResponse(f"Image generation failed: {res.text}", status_code=500)
+
+        base_url = web.PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+        return JSONResponse(await run_sync(web.store_new_prediction, res.json(), user_id, card, base_url))
+    except web.CardRequestError as error:
+        return PlainTextResponse(error.body, status_code=error.status)
+    except Exception as e:
+        print("🚨 /generate_api エラー発生:", e)
+        traceback.print_exc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def access_error(request, prediction_id):
+    """``app.card_access_error`` for the async routes: a response, or None if the user owns the card."""
+    user_session = await run_sync(web.load_session, request.headers.get("cookie"))
+    current_user = user_session.get("user_id")
+    values = await _redis.mget(web.card_owner_keys(prediction_id)) if current_user else []
+    error = web.card_access_status(current_user, values)
+    if error:
+        return JSONResponse({"status": error}, status_code=web.ACCESS_ERROR_STATUS_CODES[error])
+    return None
+
+
+async def reconcile_prediction(prediction_id):
+    try:
+        res = await send(
+            "GET", web.prediction_url(prediction_id), headers=web.replicate_read_headers(), timeout=20,
+        )
+    except httpx.HTTPError as error:
+        print(f"⚠️ Prediction could not be fetched: {error}")
+        return None
+    return await run_sync(web.record_fetched_prediction, res)
+
+
+async def card_status_payload(prediction_id):
+    """``app.card_status_payload`` with the three records read in one MGET."""
+    values = await _redis.mget(web.card_state_keys(prediction_id))
+    finished_card, card_status, state = (web.decode_json(value) for value in values)
+    if not finished_card and not card_status and web.prediction_needs_reconcile(state):
+        state = await reconcile_prediction(prediction_id) or state
+    return web.build_status_payload(finished_card, card_status, state)
+
+
+async def _listen_card_events():
+    """Fan card events out to the waiting requests of this process over one subscription."""
+    prefix = web.CARD_EVENTS_PREFIX
+    while True:
+        pubsub = _redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.psubscribe(f"{prefix}*")
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode("utf-8")
+                for queue in _card_waiters.get(channel[len(prefix):], ()):
+                    queue.put_nowait(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # 待っているリクエストは status_refresh_seconds ごとに状態を読み直すので、その間に再接続する
+            print(f"⚠️ Card event listener disconnected: {error}")
+            await asyncio.sleep(LISTENER_RETRY_SECONDS)
+        finally:
+            await pubsub.aclose()
+
+
+@contextmanager
+def card_events(prediction_id):
+    """Queue of the card's events; open it before reading the state so no update is missed."""
+    queue = asyncio.Queue()
+    _card_waiters.setdefault(prediction_id, set()).add(queue)
+    try:
+        yield queue
+    finally:
+        waiters = _card_waiters.get(prediction_id)
+        waiters.discard(queue)
+        if not waiters:
+            del _card_waiters[prediction_id]
+
+
+async def next_event(queue, timeout):
+    try:
+        return json.loads(await asyncio.wait_for(queue.get(), max(timeout, 0)))
+    except asyncio.TimeoutError:
+        return None
+
+
+async def result(request):
+    prediction_id = request.path_params["prediction_id"]
+    error = await access_error(request, prediction_id)
+    if error:
+        return error
+    payload = await card_status_payload(prediction_id)
+    if payload is None:
+        return PlainTextResponse("Failed to fetch prediction.", status_code=500)
+    return JSONResponse(payload)
+
+
+async def result_wait(request):
+    """Long-poll fallback, as ``app.result_wait``."""
+    prediction_id = request.path_params["prediction_id"]
+    error = await access_error(request, prediction_id)
+    if error:
+        return error
+
+    last_status = request.query_params.get("status", "")
+    last_playlist_status = request.query_params.get("playlist", "")
+    deadline = time.time() + web.long_poll_timeout(request.query_params.get("timeout"))
+
+    with card_events(prediction_id) as events:
+        payload = await card_status_payload(prediction_id)
+        while web.long_poll_waiting(payload, last_status, last_playlist_status, deadline):
+            remaining = deadline - time.time()
+            payload = (
+                await next_event(events, min(remaining, web.status_refresh_seconds()))
+                or await card_status_payload(prediction_id)
+            )
+
+    if payload is None:
+        return PlainTextResponse("Failed to fetch prediction.", status_code=500)
+    return JSONResponse(payload)
+
+
+async def result_events(request):
+    """Server-Sent Events stream, as ``app.result_events``."""
+    prediction_id = request.path_params["prediction_id"]
+    error = await access_error(request, prediction_id)
+    if error:
+        return error
+
+    async def stream():
+        with card_events(prediction_id) as events:
+            payload = web.stream_start_payload(await card_status_payload(prediction_id))
+            yield web.status_event(payload)
+            deadline = time.time() + web.STATUS_STREAM_SECONDS
+            while web.stream_open(payload, deadline):
+                message = await next_event(events, web.status_refresh_seconds())
+                if message:
+                    payload = message
+                else:
+                    refreshed = web.refreshed_stream_payload(payload, await card_status_payload(prediction_id))
+                    if refreshed is None:
+                        yield web.STATUS_STREAM_KEEPALIVE
+                        continue
+                    payload = refreshed
+                yield web.status_event(payload)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=web.STATUS_STREAM_HEADERS)
+
+
+@asynccontextmanager
+async def lifespan(_):
+    global _http, _redis, _executor, _listener
+    connect_timeout, read_timeout = http_client.DEFAULT_TIMEOUT
+    _http = httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(max_connections=ASGI_HTTP_CONNECTIONS, max_keepalive_connections=ASGI_HTTP_CONNECTIONS),
+    )
+    _redis = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+        os.getenv("REDIS_URL"), max_connections=ASGI_REDIS_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+    ))
+    _executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_THREADS, thread_name_prefix="asgi-sync")
+    _listener = asyncio.create_task(_listen_card_events())
+    print(f"✅ ASGI app started: {ASGI_EXECUTOR_THREADS} executor threads, {ASGI_HTTP_CONNECTIONS} HTTP connections")
+    try:
+        yield
+    finally:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        await _http.aclose()
+        await _redis.aclose()
+        _executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route("/generate_api/{user_id}", generate_api),
+        Route("/result/{prediction_id}", result),
+        Route("/result/{prediction_id}/wait", result_wait),
+        Route("/result/{prediction_id}/events", result_events),
+        # それ以外は Flask アプリをそのまま使う
+        Mount("/", app=WSGIMiddleware(web.app, workers=ASGI_WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
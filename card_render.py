@@ -0,0 +1,253 @@
+"""Card finishing as a pure function, run on a bounded process pool.
+
+``render(image_bytes, spec)`` takes the image Replicate generated and a
+small spec (``title``, ``atk``, ``card_id``, ``seed``) and returns the
+encoded ``image_store`` variants as ``{variant: WebP bytes}``: hologram,
+glitter, title, ATK, card ID and the WebP encodes all happen here, so
+nothing but bytes crosses the process boundary and the caller only hashes
+and stores the result.  The glitter roll is drawn from ``seed`` (the
+prediction id), so a retried card comes out the same; the hologram uses
+the per-size cached layers of ``hologram``.
+
+The finishing steps are CPU-bound and hold the GIL for most of their run,
+so threads in one worker process mostly take turns.  ``submit`` runs them
+on a ``ProcessPoolExecutor`` with ``RENDER_PROCESSES`` processes (one per
+core by default) behind a bounded queue of ``RENDER_QUEUE_SIZE`` renders,
+counting the running ones.  When it is full ``RenderQueueFull`` is raised
+at once, carrying a ``retry_after`` estimated from the recent render
+times, instead of piling up work that would only finish after the caller
+gave up.  The processes are started with ``spawn`` rather than forked,
+since the worker's other threads hold Redis connections and locks; a
+spawned process imports the main script again, so ``worker.py`` keeps
+``app`` out of its top-level imports.
+"""
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from hologram import apply_hologram_effect
+from image_store import encode_card_variants
+from text_render import draw_glowing_text, get_font, text_size
+
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES") or os.cpu_count() or 1)
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE") or 2 * RENDER_PROCESSES)  # 実行中を含む
+RENDER_TIMEOUT_SECONDS = int(os.getenv("RENDER_TIMEOUT_SECONDS", "120"))
+TITLE_FONT_PATH = "static/fonts/SuperBread-ywdRV.ttf"
+INFO_FONT_PATH = "static/fonts/Caprasimo-Regular.ttf"
+GLITTER_CHANCE = 0.01
+RENDER_SECONDS_DEFAULT = 1.0  # まだ1枚も描いていないときの見積もり
+RENDER_SECONDS_SMOOTHING = 0.2
+RETRY_AFTER_MAX_SECONDS = 60
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(RENDER_QUEUE_SIZE)
+_held = threading.local()  # reserved_slot で確保した枠をこのスレッドの submit が使う
+_waiting = 0
+_average_seconds = RENDER_SECONDS_DEFAULT
+
+
+class RenderQueueFull(RuntimeError):
+    """Every render slot is taken; try again after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Render queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def add_glitter_effect(base_image, glitter_density=0.009, blur=0.9, alpha=225, rng=random):
+    """画像全体にグリッターを重ねる"""
+    width, height = base_image.size
+    glitter_layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(glitter_layer)
+
+    num_glitters = int(width * height * glitter_density)
+
+    for _ in range(num_glitters):
+        x = rng.randint(0, width - 1)
+        y = rng.randint(0, height - 1)
+        size = rng.choice([6, 5, 2, 3])
+        color = rng.choice([
+            (255, 255, 255, rng.randint(150, 220)),  # 白
+            (255, 215, 0, rng.randint(130, 200)),    # 金
+            (173, 216, 230, rng.randint(120, 180)),  # 水色
+            (255, 182, 193, rng.randint(120, 180)),  # ピンク
+        ])
+        draw.ellipse((x, y, x + size, y + size), fill=color)
+
+    glitter_layer = glitter_layer.filter(ImageFilter.GaussianBlur(blur))
+    combined = Image.alpha_composite(base_image.convert("RGBA"), glitter_layer)
+    return combined
+
+
+def render_card(image_bytes, spec):
+    """Return the finished card for ``spec`` as an RGBA image."""
+    img = Image.open(BytesIO(image_bytes)).convert("RGBA")
+    width, height = img.size
+    rng = random.Random(spec.get("seed"))
+
+    # グラデーション・ノイズ・合成・明るさ・コントラストを NumPy で一括処理
+    holo = apply_hologram_effect(img)
+    # ✨ グリッター効果を全体に追加
+    if rng.random() < GLITTER_CHANCE:
+        holo = add_glitter_effect(holo, glitter_density=0.009, blur=0.3, alpha=225, rng=rng)
+        print("✨ グリッターを付与しました！（1% 確率）")
+
+    title = spec.get("title") or "Unknown Creature"
+    final_image = holo.copy()
+
+    # 🪄 タイトル：文字の範囲だけのレイヤーでフィルター・glow を適用して合成
+    tw, th = text_size(title, TITLE_FONT_PATH, 50)
+    draw_glowing_text(
+        final_image, ((width - tw) / 2, 5), title, TITLE_FONT_PATH, 50,
+        brightness=0.9, contrast=0.9,
+    )
+
+    # ATK はカードID の上（右下からマージン 40px、さらに 30px 上）
+    atk_text = f"ATK: {spec.get('atk', '0')}"
+    atk_w, atk_h = text_size(atk_text, INFO_FONT_PATH, 44)
+    margin = 40
+    draw_glowing_text(
+        final_image, (width - atk_w - margin, height - atk_h - margin - 30), atk_text, INFO_FONT_PATH, 44,
+        brightness=0.95, contrast=1.05,
+    )
+
+    # 🔠 カードIDを右下に寄せて描画
+    font_info = get_font(INFO_FONT_PATH, 10)
+    draw_final = ImageDraw.Draw(final_image)
+    info_text = spec.get("card_id") or ""
+    info_bbox = draw_final.textbbox((0, 0), info_text, font=font_info)
+    iw = info_bbox[2] - info_bbox[0]
+    ih = info_bbox[3] - info_bbox[1]
+    draw_final.text(
+        (final_image.width - iw - 40, final_image.height - ih - 20),
+        info_text,
+        font=font_info,
+        fill=(255, 255, 255, 230)
+    )
+    return final_image
+
+
+def render(image_bytes, spec):
+    """Finish a generated image; returns ``{variant: WebP bytes}`` for ``image_store``."""
+    return encode_card_variants(render_card(image_bytes, spec))
+
+
+def _timed_render(image_bytes, spec):
+    started = time.perf_counter()
+    encoded = render(image_bytes, spec)
+    return encoded, time.perf_counter() - started
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _reset_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def average_seconds():
+    """Recent average time of one render in a pool process."""
+    return _average_seconds
+
+
+def retry_after_seconds(waiting, processes=RENDER_PROCESSES, render_seconds=None):
+    """Seconds until ``waiting`` queued renders have gone through ``processes`` processes."""
+    render_seconds = render_seconds or _average_seconds
+    seconds = math.ceil(max(waiting, 1) * render_seconds / max(processes, 1))
+    return min(max(seconds, 1), RETRY_AFTER_MAX_SECONDS)
+
+
+def _finished(future):
+    global _waiting, _average_seconds
+    with _pool_lock:
+        _waiting -= 1
+        if not future.cancelled() and future.exception() is None:
+            elapsed = future.result()[1]
+            _average_seconds += (elapsed - _average_seconds) * RENDER_SECONDS_SMOOTHING
+    _slots.release()
+
+
+@contextmanager
+def reserved_slot():
+    """Hold a render slot for the calling thread; raises ``RenderQueueFull`` when every slot is taken.
+
+    A ``submit`` in the same thread uses the held slot instead of taking
+    another, so a job can take its slot before it claims work or downloads
+    the image.  Nested reservations share the outer one, and a slot no
+    render used is given back on exit.
+    """
+    if has_reserved_slot():
+        yield
+        return
+    if not _slots.acquire(blocking=False):
+        raise RenderQueueFull(retry_after_seconds(_waiting))
+    _held.slot = True
+    try:
+        yield
+    finally:
+        if _held.slot:
+            _held.slot = False
+            _slots.release()
+
+
+def has_reserved_slot():
+    return getattr(_held, "slot", False)
+
+
+def submit(image_bytes, spec):
+    """Queue a render; returns a future of ``(encoded variants, seconds)``.
+
+    Raises ``RenderQueueFull`` without waiting when ``RENDER_QUEUE_SIZE``
+    renders are already queued or running and the thread holds no
+    ``reserved_slot``.
+    """
+    global _waiting
+    if has_reserved_slot():
+        _held.slot = False  # 以後は _finished が返す
+    elif not _slots.acquire(blocking=False):
+        raise RenderQueueFull(retry_after_seconds(_waiting))
+    pool = _get_pool()
+    try:
+        future = pool.submit(_timed_render, image_bytes, spec)
+    except BrokenProcessPool:
+        _slots.release()
+        _reset_pool(pool)
+        raise
+    with _pool_lock:
+        _waiting += 1
+    future.add_done_callback(_finished)
+    return future
+
+
+def render_in_pool(image_bytes, spec, timeout=RENDER_TIMEOUT_SECONDS):
+    """``render`` on the process pool; raises ``RenderQueueFull`` when it is busy."""
+    pool = _get_pool()
+    try:
+        encoded, _ = submit(image_bytes, spec).result(timeout)
+    except BrokenProcessPool:
+        # プロセスが落ちた（メモリ不足など）プールは作り直す。ジョブはリトライされる
+        print("⚠️ Render pool broke, restarting it")
+        _reset_pool(pool)
+        raise
+    return encoded
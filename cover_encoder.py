@@ -0,0 +1,135 @@
+"""Square JPEG playlist covers built from finished cards.
+
+``upload_playlist_cover`` used to composite the card onto a full-size
+canvas (two glow ellipses plus a ``GaussianBlur(canvas_size // 12)``
+every time) and then re-encode it at up to 11 descending qualities until
+it fit Spotify's 256 KB limit.
+
+Here the card is first shrunk to ``COVER_SIZE`` (640x640, the largest
+size Spotify displays), the glow background is built once per size and
+kept in an LRU, and the quality is searched instead of stepped:
+
+* the top quality is tried first, which is usually enough at 640 px;
+* otherwise the next quality is predicted from a size-vs-quality curve
+  (``SIZE_RATIOS``, measured on sample cards) scaled to the sizes already
+  seen, so the exact answer is usually found in two or three more
+  encodes; after ``MODEL_PROBES`` guesses the search falls back to
+  bisecting the remaining bracket.
+
+Spotify's limit applies to the base64 payload, so sizes are compared
+after base64 expansion.  ``scripts/bench_cover.py`` compares this with
+the old loop on sample cards.
+"""
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFilter
+
+COVER_SIZE = 640
+COVER_MAX_PAYLOAD = 256 * 1024  # base64 後のサイズ
+QUALITY_MIN = 10
+QUALITY_MAX = 90
+BACKGROUND_COLOR = (7, 17, 13, 255)
+# 品質 q の JPEG サイズ / 品質 90 のサイズ（640px のサンプルカードの平均。scripts/bench_cover.py）
+SIZE_RATIO_QUALITIES = (10, 20, 30, 40, 50, 60, 70, 80, 90)
+SIZE_RATIOS = (0.126, 0.213, 0.289, 0.354, 0.413, 0.476, 0.568, 0.706, 1.0)
+MODEL_PROBES = 3  # 予測で選ぶ回数。それ以降は二分探索
+
+
+def base64_size(byte_count):
+    return 4 * ((byte_count + 2) // 3)
+
+
+@lru_cache(maxsize=4)
+def glow_background(size):
+    """Return the site-themed RGBA background for a ``size`` x ``size`` cover (cached)."""
+    cover = Image.new("RGBA", (size, size), BACKGROUND_COLOR)
+    glow_layer = Image.new("RGBA", cover.size, (0, 0, 0, 0))
+    glow_draw = ImageDraw.Draw(glow_layer)
+    glow_draw.ellipse(
+        (-size * 0.7, -size * 0.7, size * 0.45, size * 0.45),
+        fill=(128, 207, 100, 74),
+    )
+    glow_draw.ellipse(
+        (size * 0.55, size * 0.6, size * 1.45, size * 1.5),
+        fill=(22, 77, 60, 115),
+    )
+    return Image.alpha_composite(cover, glow_layer.filter(ImageFilter.GaussianBlur(size // 12)))
+
+
+def build_cover(card_image, size=COVER_SIZE):
+    """Center the card on the glow background, scaled to fit a ``size`` square; returns RGB."""
+    card_image = card_image.convert("RGBA")
+    scale = size / max(card_image.size)
+    if scale < 1:
+        card_image = card_image.resize(
+            (max(1, round(card_image.width * scale)), max(1, round(card_image.height * scale))),
+            Image.LANCZOS,
+        )
+    else:
+        size = max(card_image.size)  # 小さいカードは拡大しない
+    cover = glow_background(size).copy()  # キャッシュを書き換えないようにコピーへ合成
+    cover.alpha_composite(
+        card_image, ((size - card_image.width) // 2, (size - card_image.height) // 2)
+    )
+    return cover.convert("RGB")
+
+
+def encode_jpeg(image, quality):
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def predicted_ratio(quality):
+    """Predicted JPEG size at ``quality`` relative to the size at 90."""
+    if quality <= SIZE_RATIO_QUALITIES[0]:
+        return SIZE_RATIOS[0]
+    for index, upper in enumerate(SIZE_RATIO_QUALITIES[1:], start=1):
+        if quality <= upper:
+            lower = SIZE_RATIO_QUALITIES[index - 1]
+            weight = (quality - lower) / (upper - lower)
+            return SIZE_RATIOS[index - 1] + (SIZE_RATIOS[index] - SIZE_RATIOS[index - 1]) * weight
+    return SIZE_RATIOS[-1]
+
+
+def predict_quality(max_payload, probe_quality, probe_size, low, high):
+    """Highest quality in (low, high) predicted to fit, with the curve scaled to a measured probe."""
+    scale = probe_size / predicted_ratio(probe_quality)
+    for quality in range(high - 1, low, -1):
+        if predicted_ratio(quality) * scale <= max_payload:
+            return quality
+    return low + 1
+
+
+def encode_within(image, max_payload=COVER_MAX_PAYLOAD, quality_min=QUALITY_MIN, quality_max=QUALITY_MAX):
+    """Return (jpeg bytes, quality) at the highest quality that fits, or (None, None)."""
+    data = encode_jpeg(image, quality_max)
+    size = base64_size(len(data))
+    if size <= max_payload:
+        return data, quality_max
+
+    probes = {quality_max: size}
+    best = None
+    low, high = quality_min - 1, quality_max  # low までは収まる（未確認なら quality_min - 1）、high は収まらない
+    while high - low > 1:
+        if len(probes) <= MODEL_PROBES:
+            # 上限に一番近いサイズだった品質を基準に予測する
+            probe = min(probes, key=lambda quality: abs(probes[quality] - max_payload))
+            quality = predict_quality(max_payload, probe, probes[probe], low, high)
+        else:
+            quality = (low + high) // 2  # 予測が外れ続けても二分探索で終わる
+        data = encode_jpeg(image, quality)
+        size = probes[quality] = base64_size(len(data))
+        if size <= max_payload:
+            low, best = quality, data
+        else:
+            high = quality
+    if best is None:
+        return None, None
+    return best, low
+
+
+def encode_cover(card_image, size=COVER_SIZE, max_payload=COVER_MAX_PAYLOAD):
+    """Build the cover for ``card_image`` and return (jpeg bytes, quality), or (None, None)."""
+    return encode_within(build_cover(card_image, size), max_payload)
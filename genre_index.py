@@ -0,0 +1,159 @@
+"""Resolve Spotify genre strings to weights from ``data/genre_weights.yaml``.
+
+Spotify reports thousands of sub-genres ("japanese indie rock", "j-pop",
+"r&b") while the weight file lists a few hundred base genres, so an exact
+``dict.get`` scored most of them 0.  Genres and weight keys are both
+normalized to space-separated tokens (lower case, accents stripped,
+``&`` read as "n", punctuation as a space) and the keys are compiled into
+a token trie once per load.
+
+A genre is scanned in one pass over its tokens and takes the weight of
+the most specific key it contains: the longest matching phrase, and of
+equally long ones the rightmost, because English genre names put the
+head noun last ("japanese indie rock" -> "indie rock").  A genre that is
+spelled exactly like a key is looked up directly first, so every existing
+key keeps its own weight even when two keys normalize alike.
+
+Results are memoized per (file version, genre).  The file's mtime is
+checked by ``get_genre_index``, so edited weights are picked up without
+restarting workers.
+"""
+import os
+import re
+import threading
+import unicodedata
+from collections import namedtuple
+from functools import lru_cache
+
+import yaml
+
+GENRE_WEIGHTS_PATH = os.getenv("GENRE_WEIGHTS_PATH", "data/genre_weights.yaml")
+GENRE_CACHE_SIZE = 8192
+
+GenreIndex = namedtuple("GenreIndex", ["exact", "trie", "weights", "mtime_ns"])
+
+_WEIGHT = object()  # trie ノードに重みを入れるキー（トークンと衝突しない）
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+_indexes = {}  # mtime_ns -> GenreIndex（メモ化関数から参照する）
+_current = None
+_rejected_mtime_ns = None  # 読み込みに失敗した版は更新されるまで読み直さない
+_index_lock = threading.Lock()
+
+
+def normalize_genre(genre):
+    """Return ``genre`` as lower-case ASCII tokens separated by single spaces."""
+    text = unicodedata.normalize("NFKD", str(genre)).encode("ascii", "ignore").decode("ascii")
+    text = text.lower().replace("&", " n ")
+    return _NON_WORD.sub(" ", text).strip()
+
+
+def build_trie(weights):
+    """Compile {phrase: weight} into a nested token trie."""
+    trie = {}
+    for phrase, weight in weights.items():
+        node = trie
+        for token in phrase.split():
+            node = node.setdefault(token, {})
+        node[_WEIGHT] = weight
+    return trie
+
+
+def load_genre_index(path=GENRE_WEIGHTS_PATH):
+    """Read the weight file and compile it; in the trie, keys that normalize alike keep the first weight."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    with open(path, "r", encoding="utf-8") as f:
+        raw = yaml.safe_load(f) or {}
+
+    weights = {}
+    for genre, weight in raw.items():
+        phrase = normalize_genre(genre)
+        if not phrase:
+            continue
+        weights.setdefault(phrase, weight or 0)
+    exact = {str(genre): weight or 0 for genre, weight in raw.items()}
+    return GenreIndex(exact, build_trie(weights), weights, mtime_ns)
+
+
+def get_genre_index(path=GENRE_WEIGHTS_PATH):
+    """Return the compiled index, rebuilding it when the file has changed."""
+    global _current, _rejected_mtime_ns
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError as error:
+        if _current is None:
+            print(f"⚠️ genre_weights.yaml の読み込みに失敗: {error}")
+            _current = GenreIndex({}, {}, {}, None)
+            _indexes[None] = _current
+        return _current
+
+    current = _current
+    if current is not None and mtime_ns in (current.mtime_ns, _rejected_mtime_ns):
+        return current
+    with _index_lock:
+        if _current is not None and mtime_ns in (_current.mtime_ns, _rejected_mtime_ns):
+            return _current
+        try:
+            index = load_genre_index(path)
+        except (OSError, ValueError, AttributeError, yaml.YAMLError) as error:
+            print(f"⚠️ genre_weights.yaml の読み込みに失敗: {error}")
+            _rejected_mtime_ns = mtime_ns
+            if _current is None:
+                _current = GenreIndex({}, {}, {}, None)
+                _indexes[None] = _current
+            return _current
+        # 古い版はメモ化済みの結果ごと使われなくなる
+        _indexes.clear()
+        _cached_weight.cache_clear()
+        _indexes[index.mtime_ns] = index
+        _current = index
+        print(f"✅ Genre index compiled: {len(index.weights)} genres")
+        return index
+
+
+def match_genre(trie, genre):
+    """Return (phrase, weight) of the most specific key inside ``genre``, or (None, 0)."""
+    tokens = normalize_genre(genre).split()
+    best = None  # (token 数, 終了位置, 開始位置, weight)
+    for start in range(len(tokens)):
+        node = trie
+        for end in range(start, len(tokens)):
+            node = node.get(tokens[end])
+            if node is None:
+                break
+            if _WEIGHT in node:
+                candidate = (end - start + 1, end, start, node[_WEIGHT])
+                if best is None or candidate[:2] > best[:2]:
+                    best = candidate
+    if best is None:
+        return None, 0
+    length, end, start, weight = best
+    return " ".join(tokens[start:end + 1]), weight
+
+
+def resolve_weight(index, genre):
+    """Exact key first, then the most specific key contained in ``genre``."""
+    if genre in index.exact:
+        return index.exact[genre]
+    return match_genre(index.trie, genre)[1]
+
+
+@lru_cache(maxsize=GENRE_CACHE_SIZE)
+def _cached_weight(mtime_ns, genre):
+    index = _indexes.get(mtime_ns)
+    return resolve_weight(index, genre) if index else 0
+
+
+def genre_weight(genre, index=None):
+    """Return the weight of one Spotify genre string."""
+    index = index or get_genre_index()
+    if _indexes.get(index.mtime_ns) is not index:
+        # get_genre_index 以外で作った索引はメモ化しない
+        return resolve_weight(index, genre)
+    return _cached_weight(index.mtime_ns, genre)
+
+
+def score_genres(genres, index=None):
+    """Return the summed weight of ``genres``."""
+    index = index or get_genre_index()
+    return sum(genre_weight(genre, index) for genre in genres)
@@ -0,0 +1,144 @@
+"""Shared outbound HTTP layer for Spotify, Replicate and image downloads.
+
+One pooled ``requests.Session`` per host keeps TCP/TLS connections alive
+between calls.  Every request gets a bounded timeout, transient failures
+are retried with exponential backoff (honouring ``Retry-After``), and the
+latency of each endpoint is recorded in-process for ``/metrics/http``.
+
+POST is not idempotent here (it creates predictions and playlists), so it
+is only retried on 429 and on connection errors, never after the request
+may have reached the server.
+"""
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) 秒
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_MAXSIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class _Retry(Retry):
+    """Retry idempotent methods on RETRY_STATUSES, POST only on 429."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == "POST":
+            return bool(self.total) and status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def _endpoint(method, url):
+    """Collapse IDs in the path so metrics group by endpoint, not by resource."""
+    parts = urlsplit(url)
+    segments = [
+        ":id" if re.fullmatch(r"[A-Za-z0-9_\-.]{16,}|\d+", segment) else segment
+        for segment in parts.path.split("/")
+    ]
+    return f"{method.upper()} {parts.netloc}{'/'.join(segments)}"
+
+
+def record(method, url, elapsed, status=None):
+    """Add one call to the ``/metrics/http`` stats (status None = no response)."""
+    key = _endpoint(method, url)
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            key, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "statuses": {}}
+        )
+        stats["count"] += 1
+        stats["total_ms"] += elapsed * 1000
+        stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+        if status is None or status >= 400:
+            stats["errors"] += 1
+        if status is not None:
+            stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+
+
+def _record_response(response, *args, **kwargs):
+    record(response.request.method, response.request.url, response.elapsed.total_seconds(), response.status_code)
+
+
+def backoff_seconds(attempt, retry_after=None):
+    """Delay before retry ``attempt`` (1-based): ``Retry-After`` seconds if given, else exponential."""
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return RETRY_BACKOFF_FACTOR * (2 ** (attempt - 1))
+
+
+def session_for(host):
+    """Return the pooled session for ``host``, creating it on first use."""
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            retry = _Retry(
+                total=RETRY_TOTAL,
+                backoff_factor=RETRY_BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # spotipy などセッションを直接使う呼び出しもレイテンシを記録する
+            session.hooks["response"].append(_record_response)
+            _sessions[host] = session
+        return session
+
+
+def request(method, url, **kwargs):
+    """Send a request through the host's pooled session with a default timeout."""
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    started = time.perf_counter()
+    try:
+        return session_for(urlsplit(url).netloc).request(method, url, **kwargs)
+    except requests.RequestException:
+        record(method, url, time.perf_counter() - started)
+        raise
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+
+def metrics_snapshot():
+    """Return per-endpoint call counts, error counts and latency (ms)."""
+    with _metrics_lock:
+        return {
+            key: {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_ms"] / stats["count"], 1),
+                "max_ms": round(stats["max_ms"], 1),
+                "statuses": dict(stats["statuses"]),
+            }
+            for key, stats in _metrics.items()
+        }
@@ -0,0 +1,179 @@
+"""Content-addressed storage for finished card images.
+
+Every card is encoded once, at write time, into the variants listed in
+``VARIANTS`` (a full-size WebP and a gallery thumbnail).  Each variant is
+stored under ``cards/<sha256 of its bytes>.<ext>``, so a key never
+changes meaning and can be served with an immutable cache header.
+
+Backends are plain function tables picked with ``IMAGE_STORE``:
+
+* ``local`` (default): files under ``IMAGE_STORE_DIR`` (``static/cards``),
+  served by the app's ``/cards/`` route wherever the directory is.  Only
+  one instance can see them.
+* ``s3``: any S3-compatible bucket (AWS, MinIO, R2...).  ``boto3`` is
+  imported on first use, so it is only needed when this backend is on.
+  URLs are built from ``S3_PUBLIC_BASE_URL``.
+
+``scripts/s3_stub.py`` is a small local S3 stand-in for trying the s3
+backend without a real bucket.
+
+Pillow 10.4 has no AVIF encoder, so every variant is WebP.
+"""
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+IMAGE_STORE = os.getenv("IMAGE_STORE", "local").lower()
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "static/cards")
+IMAGE_KEY_PREFIX = "cards/"
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # MinIO などを使う場合
+S3_REGION = os.getenv("S3_REGION")
+S3_PUBLIC_BASE_URL = (os.getenv("S3_PUBLIC_BASE_URL") or "").rstrip("/")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# variant -> (最大幅 or None, WebP 品質)
+VARIANTS = {
+    "full": (None, 90),
+    "thumb": (360, 80),
+}
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
+
+def encode_variant(img, max_width, quality):
+    """Return WebP bytes of ``img``, shrunk to ``max_width`` if it is wider."""
+    if max_width and img.width > max_width:
+        img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def content_key(data, ext="webp"):
+    return f"{IMAGE_KEY_PREFIX}{hashlib.sha256(data).hexdigest()}.{ext}"
+
+
+# =====================
+# local backend
+# =====================
+def _local_path(key):
+    return os.path.join(IMAGE_STORE_DIR, key[len(IMAGE_KEY_PREFIX):])
+
+
+def local_put(key, data, content_type):
+    path = _local_path(key)
+    if os.path.exists(path):
+        return  # 同じ内容は同じキーなので書き直さない
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def local_get(key):
+    with open(_local_path(key), "rb") as f:
+        return f.read()
+
+
+def local_delete(key):
+    try:
+        os.remove(_local_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def local_url(key, base_url=""):
+    return f"{base_url}/{key}"  # app.py の /cards/ ルートが IMAGE_STORE_DIR から返す
+
+
+# =====================
+# s3 backend
+# =====================
+def _s3():
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            import boto3  # IMAGE_STORE=s3 のときだけ必要
+
+            _s3_client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+        return _s3_client
+
+
+def s3_put(key, data, content_type):
+    _s3().put_object(
+        Bucket=S3_BUCKET, Key=key, Body=data,
+        ContentType=content_type, CacheControl=IMMUTABLE_CACHE_CONTROL,
+    )
+
+
+def s3_get(key):
+    return _s3().get_object(Bucket=S3_BUCKET, Key=key)["Body"].read()
+
+
+def s3_delete(key):
+    _s3().delete_object(Bucket=S3_BUCKET, Key=key)
+
+
+def s3_url(key, base_url=""):
+    return f"{S3_PUBLIC_BASE_URL}/{key}"
+
+
+BACKENDS = {
+    "local": (local_put, local_get, local_delete, local_url),
+    "s3": (s3_put, s3_get, s3_delete, s3_url),
+}
+
+
+def _backend():
+    try:
+        return BACKENDS[IMAGE_STORE]
+    except KeyError:
+        raise ValueError(f"Unknown IMAGE_STORE: {IMAGE_STORE}")
+
+
+def encode_card_variants(img):
+    """Encode every variant of a finished card; returns {variant: WebP bytes}."""
+    img = img.convert("RGB")  # カードは不透明なのでアルファは持たない
+    return {
+        variant: encode_variant(img, max_width, quality)
+        for variant, (max_width, quality) in VARIANTS.items()
+    }
+
+
+def store_variants(encoded, base_url=""):
+    """Store already encoded variants; returns {variant: {"key", "url"}}.
+
+    ``base_url`` is the app's public URL, used by the local backend.
+    """
+    put, _, _, url = _backend()
+    stored = {}
+    for variant, data in encoded.items():
+        key = content_key(data)
+        put(key, data, "image/webp")
+        stored[variant] = {"key": key, "url": url(key, base_url)}
+    return stored
+
+
+def store_card_image(img, base_url=""):
+    """Encode and store every variant of ``img``; returns {variant: {"key", "url"}}."""
+    return store_variants(encode_card_variants(img), base_url)
+
+
+def load_image(key):
+    """Return the stored bytes of one variant."""
+    _, get, _, _ = _backend()
+    return get(key)
+
+
+def delete_images(keys):
+    """Delete stored variants; missing keys are ignored."""
+    _, _, delete, _ = _backend()
+    for key in keys:
+        if key and key.startswith(IMAGE_KEY_PREFIX):
+            delete(key)
@@ -0,0 +1,135 @@
+"""Small Redis-backed job queue for work that should not run in a request.
+
+Jobs are JSON blobs pushed onto ``music_monster:queue:<name>``.  A worker
+claims one with a Lua script that moves it into an in-flight sorted set
+scored by its lease deadline, so jobs held by a crashed worker become
+visible again once the lease runs out.  Failed jobs are retried with
+exponential backoff through a delayed sorted set and are moved to a
+dead-letter list after ``max_attempts``.
+
+Every function takes the Redis connection explicitly so the queue works
+the same against a local Redis, the production one or fakeredis.
+"""
+import json
+import random
+import time
+import uuid
+
+QUEUE_PREFIX = "music_monster:queue:"
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 2
+BACKOFF_MAX_SECONDS = 300
+
+_CLAIM_SCRIPT = """
+local now = tonumber(ARGV[1])
+for _, job in ipairs(redis.call("zrangebyscore", KEYS[3], "-inf", now, "LIMIT", 0, 100)) do
+    redis.call("zrem", KEYS[3], job)
+    redis.call("lpush", KEYS[1], job)
+end
+for _, job in ipairs(redis.call("zrangebyscore", KEYS[2], "-inf", now, "LIMIT", 0, 100)) do
+    redis.call("zrem", KEYS[2], job)
+    redis.call("rpush", KEYS[1], job)
+end
+local max_inflight = tonumber(ARGV[3])
+if max_inflight > 0 and redis.call("zcard", KEYS[2]) >= max_inflight then
+    return false
+end
+local job = redis.call("rpop", KEYS[1])
+if job then
+    redis.call("zadd", KEYS[2], now + tonumber(ARGV[2]), job)
+end
+return job
+"""
+
+
+def queue_keys(queue):
+    """Return the (ready, inflight, delayed, dead) keys of one queue."""
+    base = f"{QUEUE_PREFIX}{queue}"
+    return base, f"{base}:inflight", f"{base}:delayed", f"{base}:dead"
+
+
+def enqueue(conn, queue, job_type, payload, max_attempts=DEFAULT_MAX_ATTEMPTS, delay=0):
+    """Add a job and return it; ``delay`` seconds postpones its first run."""
+    job = {
+        "id": uuid.uuid4().hex,
+        "type": job_type,
+        "payload": payload,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "enqueued_at": time.time(),
+    }
+    ready, _, delayed, _ = queue_keys(queue)
+    if delay > 0:
+        conn.zadd(delayed, {json.dumps(job): time.time() + delay})
+    else:
+        conn.lpush(ready, json.dumps(job))
+    return job
+
+
+def claim(conn, queue, lease_seconds=DEFAULT_LEASE_SECONDS, max_inflight=0):
+    """Claim the oldest ready job as (raw, job), or None.
+
+    Due retries and expired leases are promoted first.  When
+    ``max_inflight`` is positive no job is handed out while that many jobs
+    are already running across all workers.
+    """
+    raw = conn.eval(
+        _CLAIM_SCRIPT, 3, *queue_keys(queue)[:3], time.time(), lease_seconds, max_inflight
+    )
+    if not raw:
+        return None
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    return raw, json.loads(raw)
+
+
+def complete(conn, queue, raw):
+    """Drop a finished job from the in-flight set."""
+    conn.zrem(queue_keys(queue)[1], raw)
+
+
+def backoff_seconds(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts."""
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def fail(conn, queue, raw, job, error, retry_after=None):
+    """Schedule a retry, or dead-letter the job once it is out of attempts.
+
+    Returns True when the job was dead-lettered.
+    """
+    _, inflight, delayed, dead = queue_keys(queue)
+    job = dict(job, attempts=job.get("attempts", 0) + 1, last_error=str(error)[:500])
+    is_dead = job["attempts"] >= job.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+    pipe = conn.pipeline()
+    pipe.zrem(inflight, raw)
+    if is_dead:
+        pipe.lpush(dead, json.dumps(dict(job, failed_at=time.time())))
+    else:
+        delay = retry_after if retry_after is not None else backoff_seconds(job["attempts"])
+        pipe.zadd(delayed, {json.dumps(job): time.time() + delay})
+    pipe.execute()
+    return is_dead
+
+
+def defer(conn, queue, raw, delay):
+    """Put a claimed job back to run after ``delay`` seconds without counting an attempt."""
+    _, inflight, delayed, _ = queue_keys(queue)
+    pipe = conn.pipeline()
+    pipe.zrem(inflight, raw)
+    pipe.zadd(delayed, {raw: time.time() + delay})
+    pipe.execute()
+
+
+def stats(conn, queue):
+    """Return the number of ready, in-flight, delayed and dead jobs."""
+    ready, inflight, delayed, dead = queue_keys(queue)
+    pipe = conn.pipeline()
+    pipe.llen(ready)
+    pipe.zcard(inflight)
+    pipe.zcard(delayed)
+    pipe.llen(dead)
+    counts = pipe.execute()
+    return dict(zip(("ready", "inflight", "delayed", "dead"), counts))
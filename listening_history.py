@@ -0,0 +1,157 @@
+"""Per-user listening history ingested incrementally from Spotify.
+
+Plays are kept in a Redis sorted set ``music_monster:history:<user_id>``
+scored by ``played_at`` (ms since the epoch, Spotify's cursor unit).  Each
+sync asks Spotify only for plays after the newest stored one
+(``current_user_recently_played(after=...)``), so a repeat generation
+costs one small delta call instead of re-downloading 50 items, and the
+window used for scoring can be longer than Spotify's 50-item page.
+
+Only the fields the card pipeline reads are stored.  Every function takes
+the Redis connection explicitly, like ``job_queue``;
+``sync_recent_plays_async`` is the same sync for the ASGI app (``asgi.py``).
+"""
+import json
+import os
+from datetime import datetime
+
+HISTORY_PREFIX = "music_monster:history:"
+HISTORY_MAX_ITEMS = int(os.getenv("HISTORY_MAX_ITEMS", "500"))
+HISTORY_TTL = 60 * 60 * 24 * 30
+SPOTIFY_PAGE_SIZE = 50  # recently-played は1回50件まで
+
+
+def history_key(user_id):
+    return f"{HISTORY_PREFIX}{user_id}"
+
+
+def played_at_ms(played_at):
+    """Convert Spotify's ``2024-01-01T12:34:56.789Z`` to ms since the epoch."""
+    return int(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def compact_item(item):
+    """Keep only what generate_image reads from a recently-played item."""
+    track = item.get("track") or {}
+    images = (track.get("album") or {}).get("images") or []
+    return {
+        "played_at": item["played_at"],
+        "track": {
+            "id": track.get("id"),
+            "name": track.get("name"),
+            "uri": track.get("uri"),
+            "album": {"images": images[:1]},
+            "artists": [
+                {"id": artist.get("id"), "name": artist.get("name")}
+                for artist in track.get("artists") or []
+            ],
+        },
+    }
+
+
+def cursor_from_newest(newest):
+    """The cursor in a ``ZREVRANGE key 0 0 WITHSCORES`` reply, or None for a new user."""
+    return int(newest[0][1]) if newest else None
+
+
+def latest_cursor(conn, user_id):
+    """Return the newest stored ``played_at`` in ms, or None for a new user."""
+    return cursor_from_newest(conn.zrevrange(history_key(user_id), 0, 0, withscores=True))
+
+
+def delta_request(cursor):
+    """Arguments of the first recently-played call: plays after ``cursor``, or a full page for a new user."""
+    if cursor is None:
+        print("🟠 Spotify APIから再生履歴を取得（初回）")
+        return {"limit": SPOTIFY_PAGE_SIZE}
+    return {"limit": SPOTIFY_PAGE_SIZE, "after": cursor}
+
+
+def needs_latest_page(cursor, page):
+    """True when the delta filled a whole page, so plays are missing and the latest page is fetched instead."""
+    # 前回から50件以上再生されている場合は最新の50件を取り直す
+    return cursor is not None and len(page.get("items") or []) >= SPOTIFY_PAGE_SIZE
+
+
+def fall_back_to_stored(cursor, error):
+    """Carry on with the stored plays after a Spotify error, or re-raise it when there are none."""
+    if cursor is None:
+        raise error
+    print(f"⚠️ Spotify API error, using stored history: {error}")
+
+
+def history_members(items):
+    """{compact item JSON: played_at ms} for the plays worth storing."""
+    return {
+        json.dumps(compact_item(item), sort_keys=True, ensure_ascii=False): played_at_ms(item["played_at"])
+        for item in items
+        if item.get("played_at") and item.get("track")
+    }
+
+
+def queue_store(pipe, user_id, items):
+    """Queue the writes of ``store_items`` on a (sync or asyncio) pipeline; returns the item count."""
+    key = history_key(user_id)
+    members = history_members(items)
+    if members:
+        pipe.zadd(key, members)
+    pipe.zremrangebyrank(key, 0, -(HISTORY_MAX_ITEMS + 1))
+    pipe.expire(key, HISTORY_TTL)
+    return len(members)
+
+
+def store_items(conn, user_id, items):
+    """Add plays to the history, trim it to HISTORY_MAX_ITEMS and refresh its TTL."""
+    pipe = conn.pipeline()
+    added = queue_store(pipe, user_id, items)
+    pipe.execute()
+    return added
+
+
+def decode_items(raw_items):
+    return [json.loads(raw.decode("utf-8") if isinstance(raw, bytes) else raw) for raw in raw_items]
+
+
+def recent_items(conn, user_id, limit=SPOTIFY_PAGE_SIZE):
+    """Return up to ``limit`` stored plays, newest first (Spotify's order)."""
+    return decode_items(conn.zrevrange(history_key(user_id), 0, limit - 1))
+
+
+def sync_recent_plays(conn, sp, user_id, limit=SPOTIFY_PAGE_SIZE):
+    """Fetch plays newer than the stored cursor and return the latest ``limit`` plays.
+
+    If Spotify fails but some history is already stored, the stored plays
+    are returned so a generation can still go ahead; with no history the
+    error is raised.
+    """
+    cursor = latest_cursor(conn, user_id)
+    try:
+        page = sp.current_user_recently_played(**delta_request(cursor))
+        if needs_latest_page(cursor, page):
+            page = sp.current_user_recently_played(limit=SPOTIFY_PAGE_SIZE)
+        added = store_items(conn, user_id, page.get("items") or [])
+        print(f"🟢 再生履歴を差分取得: {added}件追加")
+    except Exception as error:
+        fall_back_to_stored(cursor, error)
+    return recent_items(conn, user_id, limit)
+
+
+async def sync_recent_plays_async(conn, fetch_recent, user_id, limit=SPOTIFY_PAGE_SIZE):
+    """``sync_recent_plays`` for the ASGI app.
+
+    ``conn`` is a ``redis.asyncio`` client and ``fetch_recent(limit, after=None)``
+    a coroutine function returning a recently-played page.
+    """
+    key = history_key(user_id)
+    cursor = cursor_from_newest(await conn.zrevrange(key, 0, 0, withscores=True))
+    try:
+        page = await fetch_recent(**delta_request(cursor))
+        if needs_latest_page(cursor, page):
+            page = await fetch_recent(SPOTIFY_PAGE_SIZE)
+        pipe = conn.pipeline()
+        added = queue_store(pipe, user_id, page.get("items") or [])
+        await pipe.execute()
+        print(f"🟢 再生履歴を差分取得: {added}件追加")
+    except Exception as error:
+        fall_back_to_stored(cursor, error)
+    return decode_items(await conn.zrevrange(key, 0, limit - 1))
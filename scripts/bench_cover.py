@@ -0,0 +1,112 @@
+"""Compare the legacy playlist-cover loop with cover_encoder.
+
+Usage (from the repository root):
+    python scripts/bench_cover.py [image_path ...] [--runs 3] [--max-kb 256]
+
+Each image is treated as a finished 768x1024 card.  Besides the card
+itself a noisy copy is measured, since noise is what pushes a cover past
+the size limit and makes the quality search run.  For both encoders the
+script reports the time per cover, the number of JPEG encodes, the chosen
+quality and the payload size.
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import cover_encoder  # noqa: E402
+
+
+def legacy_cover(card_image, max_bytes, counter):
+    """The cover code as it was written in upload_playlist_cover."""
+    card_image = card_image.convert("RGBA")
+    canvas_size = max(card_image.size)
+    cover = Image.new("RGBA", (canvas_size, canvas_size), (7, 17, 13, 255))
+
+    glow_layer = Image.new("RGBA", cover.size, (0, 0, 0, 0))
+    glow_draw = ImageDraw.Draw(glow_layer)
+    glow_draw.ellipse(
+        (-canvas_size * 0.7, -canvas_size * 0.7, canvas_size * 0.45, canvas_size * 0.45),
+        fill=(128, 207, 100, 74),
+    )
+    glow_draw.ellipse(
+        (canvas_size * 0.55, canvas_size * 0.6, canvas_size * 1.45, canvas_size * 1.5),
+        fill=(22, 77, 60, 115),
+    )
+    cover = Image.alpha_composite(
+        cover, glow_layer.filter(ImageFilter.GaussianBlur(canvas_size // 12))
+    )
+    card_position = (
+        (canvas_size - card_image.width) // 2,
+        (canvas_size - card_image.height) // 2,
+    )
+    cover.alpha_composite(card_image, card_position)
+
+    for quality in (90, 82, 74, 66, 58, 50, 42, 34, 26, 18, 10):
+        counter[0] += 1
+        buffer = BytesIO()
+        cover.convert("RGB").save(
+            buffer, format="JPEG", quality=quality, optimize=True, progressive=True
+        )
+        if buffer.tell() <= max_bytes:
+            return buffer.getvalue(), quality
+    return None, None
+
+
+ORIGINAL_ENCODE_JPEG = cover_encoder.encode_jpeg
+
+
+def encoder_cover(card_image, max_payload, counter):
+    """cover_encoder.encode_cover, counting JPEG encodes."""
+    def encode_jpeg(image, quality):
+        counter[0] += 1
+        return ORIGINAL_ENCODE_JPEG(image, quality)
+
+    cover_encoder.encode_jpeg = encode_jpeg
+    try:
+        return cover_encoder.encode_cover(card_image, max_payload=max_payload)
+    finally:
+        cover_encoder.encode_jpeg = ORIGINAL_ENCODE_JPEG
+
+
+def measure(encode, runs):
+    counter = [0]
+    start = time.perf_counter()
+    for _ in range(runs):
+        data, quality = encode(counter)
+    elapsed_ms = (time.perf_counter() - start) / runs * 1000
+    payload = len(base64.b64encode(data)) if data else 0
+    return elapsed_ms, counter[0] / runs, quality, payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", default=["animal_templates/cat.png", "animal_templates/bug.png"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-kb", type=int, default=256)
+    args = parser.parse_args()
+    max_payload = args.max_kb * 1024
+
+    for path in args.images:
+        card = Image.open(path).convert("RGB").resize((768, 1024))
+        noisy = ImageChops.add(card, Image.effect_noise(card.size, 96).convert("RGB"), scale=1.0, offset=-64)
+        for label, sample in (("card", card), ("noisy", noisy)):
+            # 旧実装は生の JPEG サイズで判定していたので、同じ base64 上限に揃えて比べる
+            legacy = measure(lambda counter: legacy_cover(sample, max_payload * 3 // 4, counter), args.runs)
+            cover_encoder.glow_background.cache_clear()
+            cover_encoder.build_cover(sample)  # 背景キャッシュを温める（ワーカーでは初回だけ作る）
+            fast = measure(lambda counter: encoder_cover(sample, max_payload, counter), args.runs)
+
+            print(f"{path} ({label}), runs: {args.runs}, limit: {args.max_kb} KB")
+            for name, (ms, encodes, quality, payload) in (("legacy", legacy), ("encoder", fast)):
+                print(f"  {name:8} {ms:8.1f} ms/cover  {encodes:4.1f} encodes  quality {quality}  {payload / 1024:6.1f} KB")
+            print(f"  speedup: {legacy[0] / fast[0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare the legacy putpixel hologram pipeline with the vectorized engine.
+
+Usage (from the repository root):
+    python scripts/bench_hologram.py [image_path] [--runs 3]
+
+The script reports the per-card time for both pipelines and the pixel
+difference when they are fed the same raw noise field.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from hologram import apply_hologram_effect, enhance_noise  # noqa: E402
+
+
+def legacy_hologram(img, raw_noise):
+    """The pipeline as it was written in get_result before vectorization."""
+    width, height = img.size
+    gradient = Image.new("RGBA", img.size)
+    for x in range(width):
+        r = int(128 + 127 * np.sin(x / 20.0))
+        g = int(128 + 127 * np.sin(x / 25.0 + 2))
+        b = int(128 + 127 * np.sin(x / 30.0 + 4))
+        for y in range(height):
+            gradient.putpixel((x, y), (r, g, b, 40))
+
+    noise = raw_noise.convert("L")
+    noise = ImageEnhance.Contrast(noise).enhance(2.0)
+    noise_colored = Image.merge("RGBA", (noise, noise, noise, noise))
+    noise_colored.putalpha(40)
+
+    holo = Image.alpha_composite(img, gradient)
+    holo = Image.alpha_composite(holo, noise_colored)
+    holo = holo.filter(ImageFilter.SMOOTH_MORE)
+    holo = ImageEnhance.Brightness(holo).enhance(1.05)
+    holo = ImageEnhance.Contrast(holo).enhance(1.1)
+    return holo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", nargs="?", default="animal_templates/cat.png")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    img = Image.open(args.image).convert("RGB").resize((768, 1024)).convert("RGBA")
+    raw_noise = Image.effect_noise(img.size, 64)
+
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        legacy = legacy_hologram(img, raw_noise)
+    legacy_ms = (time.perf_counter() - start) / args.runs * 1000
+
+    noise = enhance_noise(np.asarray(raw_noise))
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        fast = apply_hologram_effect(img, noise=noise)
+    fast_ms = (time.perf_counter() - start) / args.runs * 1000
+
+    diff = np.abs(np.asarray(legacy, dtype=np.int16) - np.asarray(fast, dtype=np.int16))
+    print(f"image: {args.image} {img.size[0]}x{img.size[1]}, runs: {args.runs}")
+    print(f"legacy:     {legacy_ms:8.1f} ms/card")
+    print(f"vectorized: {fast_ms:8.1f} ms/card  ({legacy_ms / fast_ms:.1f}x faster)")
+    print(f"max |diff|: {diff.max()}  mean |diff|: {diff.mean():.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,11 @@ import time
 import uuid
 import yaml
 import webbrowser
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from animal_classifier import classify  # noqa: E402
 
 ################# Spotify #################
 BASE_URL = "https://music-cat-7r71.onrender.com"
@@ -83,27 +88,8 @@ if __name__ == "__main__":
             influenced_word_box.append(i)
             print(f"   - {i}: {weight}")
     
-    # 動物の確定
-    if definition_score <= 500:
-        character_animal = "bug"
-    elif definition_score <= 1000:
-        character_animal = "fish"
-    elif definition_score <= 1500:
-        character_animal = "octopus"    
-    elif definition_score <= 2000:
-        character_animal = "crab"
-    elif definition_score <= 3000:
-        character_animal = "frog"
-    elif definition_score <= 4000:
-        character_animal = "snake"
-    elif definition_score <= 8000:
-        character_animal = "horse"
-    elif definition_score <= 9000:
-        character_animal = "dog"
-    elif definition_score <= 13000:
-        character_animal = "cat"
-    else:
-        character_animal = "dragon"
+    # 動物の確定（app.py と同じ data/animal_thresholds.yaml を使う）
+    character_animal = classify(definition_score)
     
     # 影響を受けるキーワードの確定
     influenced_word = random.choice(influenced_word_box)
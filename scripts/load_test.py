@@ -0,0 +1,155 @@
+"""Concurrent generations against one or more running deployments.
+
+Usage (from the repository root):
+    python scripts/load_test.py http://localhost:8000 http://localhost:8001 [--users 200]
+
+Each target must be an app (gunicorn ``app:app`` or uvicorn ``asgi:app``)
+started against the local stubs, for example:
+
+    python scripts/spotify_stub.py --port 5003 --latency 1.0
+    REPLICATE_STUB_STEP_SECONDS=5 python scripts/replicate_stub.py --port 5001 --latency 2.0
+    export SPOTIFY_ACCOUNTS_BASE=http://localhost:5003 SPOTIFY_API_BASE=http://localhost:5003/v1 \\
+        REPLICATE_API_BASE=http://localhost:5001/v1 SESSION_COOKIE_NAME=spotify_session
+    gunicorn app:app --workers=2 --threads=8 --timeout=180 --bind 127.0.0.1:8000
+    uvicorn asgi:app --port 8001
+
+Every virtual user logs in through ``/callback`` first (not timed).  Then
+all of them at once call ``/generate_api`` and long-poll
+``/result/<id>/wait`` until the prediction leaves Replicate (``finishing``
+or a final status); no worker is needed.  For each target the script
+prints the number of completed generations, errors, throughput and the
+p50 / p95 of ``/generate_api`` and of the whole generation.  The stubs
+and the app compete for the same CPU, so keep the upstream latencies
+realistic (seconds, not milliseconds) when comparing.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+DONE_STATUSES = ("finishing", "succeeded", "failed")
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(fraction * 100) - 1]
+
+
+async def get(client, url, **kwargs):
+    try:
+        return await client.get(url, **kwargs)
+    except httpx.RemoteProtocolError:
+        # サーバーが閉じた keep-alive 接続を使ってしまった場合（リクエストは届いていない）は1回だけやり直す
+        return await client.get(url, **kwargs)
+
+
+async def login(client, user_id):
+    """Log in as ``user_id`` through the Spotify stub; returns the session Cookie header."""
+    response = await get(client, "/callback", params={"code": user_id})
+    if response.status_code != 302:
+        raise RuntimeError(f"login failed for {user_id}: {response.status_code} {response.text[:200]}")
+    # セッション cookie は Secure なので http では自動で送られない。ヘッダーで渡す
+    return "; ".join(f"{name}={value}" for name, value in response.cookies.items())
+
+
+async def generate(client, user_id, cookie, deadline):
+    """One generation; returns (seconds in /generate_api, seconds until done, final status)."""
+    headers = {"Cookie": cookie}
+    started = time.perf_counter()
+    response = await get(client, f"/generate_api/{user_id}", headers=headers)
+    generated = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"/generate_api {response.status_code}: {response.text[:200]}")
+    prediction_id = response.json()["prediction_id"]
+
+    status = ""
+    while status not in DONE_STATUSES:
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"timed out in status {status or 'none'}")
+        response = await get(
+            client, f"/result/{prediction_id}/wait", params={"status": status, "timeout": 25}, headers=headers
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"/wait {response.status_code}: {response.text[:200]}")
+        status = response.json()["status"]
+    return generated, time.perf_counter() - started, status
+
+
+async def run_target(base_url, users, login_concurrency, timeout):
+    run_id = uuid.uuid4().hex[:6]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=users)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        semaphore = asyncio.Semaphore(login_concurrency)
+
+        async def login_one(index):
+            async with semaphore:
+                user_id = f"load-{run_id}-{index}"
+                return user_id, await login(client, user_id)
+
+        sessions = await asyncio.gather(*(login_one(index) for index in range(users)))
+
+        started = time.perf_counter()
+        deadline = started + timeout
+        outcomes = await asyncio.gather(
+            *(generate(client, user_id, cookie, deadline) for user_id, cookie in sessions),
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - started
+
+    results = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    generate_times = [result[0] for result in results]
+    total_times = [result[1] for result in results]
+    for error in errors[:3]:
+        print(f"⚠️ {base_url}: {type(error).__name__}: {error}")
+    return {
+        "target": base_url,
+        "completed": len(results),
+        "errors": len(errors),
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "generate_p50": percentile(generate_times, 0.5),
+        "generate_p95": percentile(generate_times, 0.95),
+        "total_p50": percentile(total_times, 0.5),
+        "total_p95": percentile(total_times, 0.95),
+        "elapsed": elapsed,
+    }
+
+
+def seconds(value):
+    return "-" if value != value else f"{value:.2f}s"  # NaN = 完了したユーザーなし
+
+
+def print_table(rows):
+    print(
+        f"{'target':<28} {'done':>5} {'err':>4} {'gen/s':>7} "
+        f"{'api p50':>8} {'api p95':>8} {'e2e p50':>8} {'e2e p95':>8} {'wall':>7}"
+    )
+    for row in rows:
+        print(
+            f"{row['target']:<28} {row['completed']:>5} {row['errors']:>4} {row['throughput']:>7.1f} "
+            f"{seconds(row['generate_p50']):>8} {seconds(row['generate_p95']):>8} "
+            f"{seconds(row['total_p50']):>8} {seconds(row['total_p95']):>8} {row['elapsed']:>6.1f}s"
+        )
+
+
+async def main(args):
+    rows = []
+    for target in args.targets:
+        print(f"🚀 {target}: {args.users} concurrent generations")
+        rows.append(await run_target(target.rstrip("/"), args.users, args.login_concurrency, args.timeout))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent generation load test")
+    parser.add_argument("targets", nargs="+", help="base URLs of running deployments")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds before a generation counts as failed")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,163 @@
+"""Local stand-in for the parts of the Replicate API that app.py uses.
+
+Usage (from the repository root):
+    REPLICATE_WEBHOOK_SECRET=whsec_c3R1Yi1zZWNyZXQ= python scripts/replicate_stub.py --port 5001
+
+and start the app with REPLICATE_API_BASE=http://localhost:5001/v1 plus the
+same REPLICATE_WEBHOOK_SECRET.  Predictions move starting -> processing ->
+succeeded on a timer and, if a webhook was registered, each transition
+is delivered to it signed the way Replicate signs webhooks.  Files uploaded
+with ``POST /v1/files`` are kept in memory.  The "generated" image is the
+prediction's input template, inline or uploaded (or a grey card).
+``--latency`` delays every API response, standing in for the round trip
+to Replicate (used by ``scripts/load_test.py``).
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import threading
+import time
+import uuid
+
+import requests
+from flask import Flask, jsonify, request, send_file
+from PIL import Image
+
+stub = Flask(__name__)
+predictions = {}
+files = {}
+STEP_SECONDS = float(os.getenv("REPLICATE_STUB_STEP_SECONDS", "1.0"))
+WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET", "")
+LATENCY_SECONDS = 0.0
+
+
+def sign_webhook(webhook_id, timestamp, body):
+    key = base64.b64decode(WEBHOOK_SECRET.removeprefix("whsec_"))
+    signed_content = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    digest = hmac.new(key, signed_content, hashlib.sha256).digest()
+    return f"v1,{base64.b64encode(digest).decode()}"
+
+
+def deliver_webhook(prediction):
+    url = prediction.get("webhook")
+    events = prediction.get("webhook_events_filter") or ["start", "output", "logs", "completed"]
+    event = "completed" if prediction["status"] == "succeeded" else "start"
+    if not url or event not in events:
+        return
+    body = json.dumps({k: v for k, v in prediction.items() if k != "input_image"}).encode("utf-8")
+    webhook_id = f"msg_{uuid.uuid4().hex}"
+    timestamp = str(int(time.time()))
+    try:
+        requests.post(url, data=body, timeout=10, headers={
+            "Content-Type": "application/json",
+            "webhook-id": webhook_id,
+            "webhook-timestamp": timestamp,
+            "webhook-signature": sign_webhook(webhook_id, timestamp, body),
+        })
+    except requests.RequestException as error:
+        print(f"⚠️ Stub webhook delivery failed: {error}")
+
+
+def advance(prediction_id):
+    for status in ("processing", "succeeded"):
+        time.sleep(STEP_SECONDS)
+        prediction = predictions[prediction_id]
+        prediction["status"] = status
+        if status == "succeeded":
+            prediction["output"] = [f"{request_base}/outputs/{prediction_id}.png"]
+            prediction["completed_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        deliver_webhook(prediction)
+
+
+@stub.before_request
+def simulate_latency():
+    if LATENCY_SECONDS and request.path.startswith("/v1/"):
+        time.sleep(LATENCY_SECONDS)
+
+
+def public(prediction):
+    return {k: v for k, v in prediction.items() if k != "input_image"}
+
+
+@stub.route("/v1/predictions", methods=["POST"])
+def create_prediction():
+    global request_base
+    request_base = request.host_url.rstrip("/")
+    body = request.get_json(force=True)
+    prediction_id = uuid.uuid4().hex[:20]
+    predictions[prediction_id] = {
+        "id": prediction_id,
+        "version": body.get("version"),
+        "status": "starting",
+        "output": None,
+        "error": None,
+        "webhook": body.get("webhook"),
+        "webhook_events_filter": body.get("webhook_events_filter"),
+        "input_image": (body.get("input") or {}).get("image"),
+    }
+    threading.Thread(target=advance, args=(prediction_id,), daemon=True).start()
+    return jsonify(public(predictions[prediction_id])), 201
+
+
+@stub.route("/v1/predictions/<prediction_id>")
+def get_prediction(prediction_id):
+    if prediction_id not in predictions:
+        return jsonify({"detail": "Not found."}), 404
+    return jsonify(public(predictions[prediction_id]))
+
+
+@stub.route("/v1/files", methods=["POST"])
+def create_file():
+    upload = request.files.get("content")
+    if upload is None:
+        return jsonify({"detail": "content is required"}), 400
+    file_id = uuid.uuid4().hex[:20]
+    content = upload.read()
+    files[file_id] = content
+    expires_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 24 * 60 * 60))
+    return jsonify({
+        "id": file_id,
+        "name": upload.filename,
+        "content_type": upload.mimetype,
+        "size": len(content),
+        "expires_at": expires_at,
+        "urls": {"get": f"{request.host_url.rstrip('/')}/v1/files/{file_id}"},
+    }), 201
+
+
+@stub.route("/v1/files/<file_id>")
+def get_file(file_id):
+    if file_id not in files:
+        return jsonify({"detail": "Not found."}), 404
+    return send_file(io.BytesIO(files[file_id]), mimetype="application/octet-stream")
+
+
+@stub.route("/outputs/<prediction_id>.png")
+def output_image(prediction_id):
+    source = (predictions.get(prediction_id) or {}).get("input_image") or ""
+    file_id = source.rstrip("/").rsplit("/", 1)[-1] if "/v1/files/" in source else None
+    if source.startswith("data:"):
+        img = Image.open(io.BytesIO(base64.b64decode(source.split(",", 1)[1])))
+    elif file_id in files:
+        img = Image.open(io.BytesIO(files[file_id]))
+    else:
+        img = Image.new("RGB", (768, 1024), (90, 90, 90))
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="PNG")
+    buffer.seek(0)
+    return send_file(buffer, mimetype="image/png")
+
+
+request_base = ""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Replicate API stub")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API response")
+    args = parser.parse_args()
+    LATENCY_SECONDS = args.latency
+    stub.run(host="127.0.0.1", port=args.port, threaded=True)
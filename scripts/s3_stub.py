@@ -0,0 +1,56 @@
+"""Local stand-in for the S3 calls that image_store.py makes.
+
+Usage (from the repository root):
+    python scripts/s3_stub.py --port 5002
+
+and start the app / worker with
+    IMAGE_STORE=s3 S3_BUCKET=cards S3_ENDPOINT_URL=http://localhost:5002 \\
+    S3_PUBLIC_BASE_URL=http://localhost:5002/cards \\
+    AWS_ACCESS_KEY_ID=stub AWS_SECRET_ACCESS_KEY=stub S3_REGION=us-east-1
+
+Objects live in memory, path-style (``/<bucket>/<key>``).  Signatures are
+not checked; PUT, GET, HEAD and DELETE of single objects are supported,
+which is all the app needs.
+"""
+import argparse
+import hashlib
+
+from flask import Flask, Response, request
+
+stub = Flask(__name__)
+objects = {}  # (bucket, key) -> (body, content_type, cache_control)
+
+
+@stub.route("/<bucket>/<path:key>", methods=["PUT"])
+def put_object(bucket, key):
+    body = request.get_data()
+    objects[(bucket, key)] = (
+        body,
+        request.headers.get("Content-Type", "application/octet-stream"),
+        request.headers.get("Cache-Control"),
+    )
+    return Response(status=200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+
+@stub.route("/<bucket>/<path:key>", methods=["GET", "HEAD"])
+def get_object(bucket, key):
+    if (bucket, key) not in objects:
+        return Response("<Error><Code>NoSuchKey</Code></Error>", status=404, mimetype="application/xml")
+    body, content_type, cache_control = objects[(bucket, key)]
+    headers = {"ETag": f'"{hashlib.md5(body).hexdigest()}"'}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return Response(body, mimetype=content_type, headers=headers)
+
+
+@stub.route("/<bucket>/<path:key>", methods=["DELETE"])
+def delete_object(bucket, key):
+    objects.pop((bucket, key), None)
+    return Response(status=204)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local S3 API stub")
+    parser.add_argument("--port", type=int, default=5002)
+    args = parser.parse_args()
+    stub.run(host="127.0.0.1", port=args.port, threaded=True)
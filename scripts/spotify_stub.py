@@ -0,0 +1,151 @@
+"""Local stand-in for the Spotify accounts and Web API calls the app makes.
+
+Usage (from the repository root):
+    python scripts/spotify_stub.py --port 5003 [--latency 0.2]
+
+and start the app with
+    SPOTIFY_ACCOUNTS_BASE=http://localhost:5003 SPOTIFY_API_BASE=http://localhost:5003/v1
+
+``/authorize`` redirects straight back with a code, and any code is
+accepted: ``/callback?code=alice`` logs in as user ``alice`` (access
+tokens are ``access-<user>``).  Every user has the same 50 recent plays
+spread over a few artists with genres from ``data/genre_weights.yaml``
+(they score 5200, a dog, whose template is in ``animal_templates``);
+plays after a cursor are always empty.  Playlists are accepted and
+forgotten.  ``--latency`` delays every API response, standing in for the
+round trip to Spotify.
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+from flask import Flask, jsonify, redirect, request
+
+stub = Flask(__name__)
+stub.url_map.strict_slashes = False  # spotipy は "me/" のように末尾に / を付ける
+LATENCY_SECONDS = 0.0
+TOKEN_SECONDS = 3600
+ARTISTS = {
+    f"stubartist{index:02d}": {
+        "id": f"stubartist{index:02d}",
+        "name": name,
+        "genres": genres,
+    }
+    for index, (name, genres) in enumerate([
+        ("The Beatles", ["british", "classic rock"]),
+        ("Stub Quartet", ["indie rock", "alt rock"]),
+        ("Loopback", ["ambient", "chill", "acoustic"]),
+        ("Mock Orchestra", ["classical"]),
+        ("Fixture Blues", ["blues", "acoustic"]),
+    ])
+}
+
+
+def recent_plays(limit):
+    now = datetime.now(timezone.utc)
+    artists = list(ARTISTS.values())
+    items = []
+    for index in range(limit):
+        artist = artists[index % len(artists)]
+        played_at = now - timedelta(minutes=5 * (index + 1))
+        items.append({
+            "played_at": played_at.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "track": {
+                "id": f"stubtrack{index:04d}",
+                "name": f"Stub Song {index}",
+                "uri": f"spotify:track:stubtrack{index:04d}",
+                "album": {"images": [{"url": f"https://i.scdn.co/image/stub{index % 7}"}]},
+                "artists": [{"id": artist["id"], "name": artist["name"]}],
+            },
+        })
+    return items
+
+
+def token_user():
+    auth = request.headers.get("Authorization", "")
+    token = auth.removeprefix("Bearer ").strip()
+    return token.removeprefix("access-") if token.startswith("access-") else None
+
+
+@stub.before_request
+def simulate_latency():
+    if LATENCY_SECONDS and request.path != "/authorize":
+        time.sleep(LATENCY_SECONDS)
+    if request.path.startswith("/v1/") and not token_user():
+        return jsonify({"error": {"status": 401, "message": "Invalid access token"}}), 401
+    return None
+
+
+@stub.route("/authorize")
+def authorize():
+    params = {"code": f"stub-{uuid.uuid4().hex[:8]}", "state": request.args.get("state", "")}
+    return redirect(f"{request.args['redirect_uri']}?{urlencode(params)}")
+
+
+@stub.route("/api/token", methods=["POST"])
+def token():
+    if request.form.get("grant_type") == "refresh_token":
+        user = request.form.get("refresh_token", "").removeprefix("refresh-")
+    else:
+        user = request.form.get("code") or "stub-user"
+    return jsonify({
+        "access_token": f"access-{user}",
+        "token_type": "Bearer",
+        "expires_in": TOKEN_SECONDS,
+        "refresh_token": f"refresh-{user}",
+        "scope": request.form.get("scope", ""),
+    })
+
+
+@stub.route("/v1/me/")
+def me():
+    user = token_user()
+    return jsonify({"id": user, "display_name": user})
+
+
+@stub.route("/v1/me/player/recently-played")
+def recently_played():
+    limit = min(int(request.args.get("limit", 20)), 50)
+    items = [] if request.args.get("after") else recent_plays(limit)
+    return jsonify({"items": items, "limit": limit, "next": None})
+
+
+@stub.route("/v1/artists/")
+def artists():
+    ids = [aid for aid in request.args.get("ids", "").split(",") if aid]
+    return jsonify({"artists": [ARTISTS.get(aid) for aid in ids]})
+
+
+@stub.route("/v1/me/playlists", methods=["POST"])
+def create_playlist():
+    playlist_id = uuid.uuid4().hex[:22]
+    return jsonify({
+        "id": playlist_id,
+        "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+    }), 201
+
+
+@stub.route("/v1/playlists/<playlist_id>/items", methods=["POST"])
+def add_items(playlist_id):
+    return jsonify({"snapshot_id": uuid.uuid4().hex}), 201
+
+
+@stub.route("/v1/playlists/<playlist_id>/images", methods=["PUT"])
+def upload_image(playlist_id):
+    return "", 202
+
+
+@stub.route("/v1/playlists/<playlist_id>/followers", methods=["DELETE"])
+def unfollow(playlist_id):
+    return "", 200
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Spotify API stub")
+    parser.add_argument("--port", type=int, default=5003)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API response")
+    args = parser.parse_args()
+    LATENCY_SECONDS = args.latency
+    stub.run(host="127.0.0.1", port=args.port, threaded=True)
@@ -0,0 +1,156 @@
+"""Per-user Spotify tokens shared by the web app and the worker.
+
+Tokens live in Redis under ``music_monster:spotify_token:<user_id>``
+rather than in the Flask session, so jobs that run after the request
+(playlist creation, cover upload, cleanup) can get a valid token for the
+card's owner instead of carrying a copy that may have expired.
+
+``get_access_token`` refreshes ``REFRESH_MARGIN_SECONDS`` before expiry.
+Only one process refreshes a user at a time: the refresher holds
+``music_monster:spotify_token_lock:<user_id>`` (SET NX with a short TTL)
+and everyone else waits briefly for the new token, falling back to the
+current one while it is still valid.  Spotify may rotate refresh tokens,
+so concurrent refreshes could otherwise invalidate each other.
+
+The OAuth client is passed in by the caller; its cache handler should be
+a no-op (``NoTokenCache``) so one client can be shared by every user.
+Every function takes the Redis connection explicitly, like ``job_queue``.
+"""
+import json
+import time
+import uuid
+
+from spotipy.cache_handler import CacheHandler
+from spotipy.oauth2 import SpotifyOauthError
+
+TOKEN_PREFIX = "music_monster:spotify_token:"
+TOKEN_LOCK_PREFIX = "music_monster:spotify_token_lock:"
+TOKEN_TTL = 60 * 60 * 24 * 30  # refresh token を保持する期間（使うたびに延長）
+REFRESH_MARGIN_SECONDS = 5 * 60
+MIN_VALIDITY_SECONDS = 30  # 更新中に古いトークンを返してよい残り時間
+LOCK_TTL_SECONDS = 15
+LOCK_WAIT_SECONDS = 5
+LOCK_POLL_SECONDS = 0.1
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class TokenRefreshTimeout(RuntimeError):
+    """Another process holds the refresh lock and the stored token has already expired."""
+
+
+class TokenMissing(RuntimeError):
+    """A job needs a user's token but none is stored (logged out, or it was revoked)."""
+
+
+class NoTokenCache(CacheHandler):
+    """Cache handler that stores nothing; tokens are kept per user in Redis instead."""
+
+    def get_cached_token(self):
+        return None
+
+    def save_token_to_cache(self, token_info):
+        pass
+
+
+def token_key(user_id):
+    return f"{TOKEN_PREFIX}{user_id}"
+
+
+def load_token(conn, user_id):
+    """Return the stored token_info of a user, or None."""
+    value = conn.get(token_key(user_id))
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return json.loads(value)
+
+
+def save_token(conn, user_id, token_info):
+    """Store the fields we need from a spotipy token_info dict."""
+    token = {
+        "access_token": token_info["access_token"],
+        "refresh_token": token_info.get("refresh_token"),
+        "expires_at": int(token_info.get("expires_at") or 0),
+        "scope": token_info.get("scope"),
+    }
+    conn.set(token_key(user_id), json.dumps(token), ex=TOKEN_TTL)
+    return token
+
+
+def delete_token(conn, user_id):
+    conn.delete(token_key(user_id))
+
+
+def is_fresh(token, margin):
+    """True if ``token`` stays valid for at least ``margin`` more seconds."""
+    return token and token.get("expires_at", 0) - margin > time.time()
+
+
+def _refresh(conn, oauth, user_id, token):
+    try:
+        refreshed = oauth.refresh_access_token(token["refresh_token"])
+    except SpotifyOauthError as error:
+        if getattr(error, "error", None) == "invalid_grant":
+            # 取り消された refresh token は再ログインまで使えない
+            print(f"⚠️ Spotify refresh token rejected, login required: {user_id}")
+            delete_token(conn, user_id)
+            return None
+        raise
+    print(f"🔄 Spotify token refreshed: {user_id}")
+    return save_token(conn, user_id, refreshed)
+
+
+def get_access_token(conn, oauth, user_id, margin=REFRESH_MARGIN_SECONDS):
+    """Return a Spotify access token for ``user_id`` valid for at least ``margin`` seconds.
+
+    Returns None when the user has no usable token (never logged in, or
+    the refresh token was revoked).  Transient Spotify errors and
+    ``TokenRefreshTimeout`` are raised, so jobs are retried.
+    """
+    token = load_token(conn, user_id)
+    if not token:
+        return None
+    if is_fresh(token, margin):
+        return token["access_token"]
+    if not token.get("refresh_token"):
+        return token["access_token"] if is_fresh(token, 0) else None
+
+    lock_key = f"{TOKEN_LOCK_PREFIX}{user_id}"
+    lock_token = uuid.uuid4().hex
+    if conn.set(lock_key, lock_token, nx=True, ex=LOCK_TTL_SECONDS):
+        try:
+            # ロック待ちの間に他のプロセスが更新していればそれを使う
+            token = load_token(conn, user_id)
+            if not token:
+                return None
+            if is_fresh(token, margin):
+                return token["access_token"]
+            token = _refresh(conn, oauth, user_id, token)
+            return token["access_token"] if token else None
+        finally:
+            conn.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, lock_token)
+
+    # 他のプロセスが更新中: 今のトークンがまだ使えればそれを返し、切れかけなら新しいトークンを待つ
+    if is_fresh(token, MIN_VALIDITY_SECONDS):
+        return token["access_token"]
+    deadline = time.time() + LOCK_WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_SECONDS)
+        current = load_token(conn, user_id)
+        if not current:
+            return None
+        if is_fresh(current, margin):
+            return current["access_token"]
+    current = load_token(conn, user_id)
+    if not current:
+        return None
+    if is_fresh(current, 0):
+        return current["access_token"]
+    raise TokenRefreshTimeout(f"Spotify token refresh for {user_id} did not finish")
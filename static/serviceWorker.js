@@ -1,11 +1,11 @@
 // serviceWorker.js
+// /serviceWorker.js として配信するときに @build 行を asset-manifest.json の内容で置き換える
+// （static_assets.render_service_worker）。
 
-const CACHE_NAME = 'spotify-ai-card-v2';
-const STATIC_ASSETS = [
-  '/', 
-  '/manifest.json',
-  '/static/favicon.ico'
-];
+const CACHE_VERSION = 'dev';  // @build:cache-version
+const PRECACHE_ASSETS = ['/manifest.json'];  // @build:precache
+const CACHE_NAME = `spotify-ai-card-${CACHE_VERSION}`;
+const PAGE_CACHE_NAME = 'spotify-ai-card-pages';
 
 // ==============================
 // 🔹 インストール
@@ -13,7 +13,7 @@ const STATIC_ASSETS = [
 self.addEventListener('install', (event) => {
   console.log('🟢 Service Worker: Installed');
   event.waitUntil(
-    caches.open(CACHE_NAME).then((cache) => cache.addAll(STATIC_ASSETS))
+    caches.open(CACHE_NAME).then((cache) => cache.addAll(PRECACHE_ASSETS))
   );
 });
 
@@ -23,7 +23,11 @@ self.addEventListener('install', (event) => {
 self.addEventListener('activate', (event) => {
   event.waitUntil(
     caches.keys().then((keys) =>
-      Promise.all(keys.filter((k) => k !== CACHE_NAME).map((k) => caches.delete(k)))
+      Promise.all(
+        keys
+          .filter((k) => k !== CACHE_NAME && k !== PAGE_CACHE_NAME)
+          .map((k) => caches.delete(k))
+      )
     )
   );
   console.log('🟠 Service Worker: Activated');
@@ -33,41 +37,66 @@ self.addEventListener('activate', (event) => {
 // 🔹 Fetch イベント処理
 // ==============================
 self.addEventListener('fetch', (event) => {
-  const url = event.request.url;
+  const request = event.request;
+  const url = new URL(request.url);
+
+  if (request.method !== 'GET' || url.origin !== self.location.origin) {
+    return;
+  }
 
   // 🚫 Spotify 認証や画像生成など動的APIはキャッシュしない
   if (
-    url.includes('/generate_api') ||
-    url.includes('/callback') ||
-    url.includes('/login') ||
-    url.includes('/result') ||
-    url.includes('/generate/')
+    url.pathname.startsWith('/generate_api') ||
+    url.pathname.startsWith('/callback') ||
+    url.pathname.startsWith('/login') ||
+    url.pathname.startsWith('/result') ||
+    url.pathname.startsWith('/generate/') ||
+    url.pathname.startsWith('/api/')
   ) {
-    console.log('🚫 APIリクエストはキャッシュせず直接取得:', url);
-    event.respondWith(fetch(event.request));
     return;
   }
 
-  // ✅ GET リクエストで静的ファイルのみキャッシュ利用
-  if (event.request.method === 'GET') {
+  // ✅ ハッシュ付きファイル・カード画像は中身が変わらないので cache-first
+  if (
+    url.pathname.startsWith('/static/dist/') ||
+    url.pathname.startsWith('/static/cards/') ||
+    url.pathname.startsWith('/cards/')
+  ) {
     event.respondWith(
-      caches.match(event.request).then((cachedResponse) => {
+      caches.match(request).then((cachedResponse) => {
         if (cachedResponse) {
           return cachedResponse;
         }
-        return fetch(event.request)
-          .then((networkResponse) => {
+        return fetch(request).then((networkResponse) => {
+          if (networkResponse.ok) {
             const cloned = networkResponse.clone();
-            caches.open(CACHE_NAME).then((cache) => {
-              cache.put(event.request, cloned);
-            });
-            return networkResponse;
-          })
-          .catch(() => {
-            // オフライン時 fallback
-            return caches.match('/');
-          });
+            caches.open(CACHE_NAME).then((cache) => cache.put(request, cloned));
+          }
+          return networkResponse;
+        });
       })
     );
+    return;
   }
+
+  // 🌐 ページ（/ など）は network-first。オフライン時だけ前回のページを返す
+  if (request.mode === 'navigate' || url.pathname === '/') {
+    event.respondWith(
+      fetch(request)
+        .then((networkResponse) => {
+          if (networkResponse.ok) {
+            const cloned = networkResponse.clone();
+            caches.open(PAGE_CACHE_NAME).then((cache) => cache.put(request, cloned));
+          }
+          return networkResponse;
+        })
+        .catch(() =>
+          caches.match(request).then((cachedResponse) => cachedResponse || caches.match('/'))
+        )
+    );
+    return;
+  }
+
+  // その他はネットワーク優先（ETag で再検証される）、失敗時だけキャッシュ
+  event.respondWith(fetch(request).catch(() => caches.match(request)));
 });
@@ -0,0 +1,287 @@
+"""Build and serve the files under ``static/`` with long-lived caching.
+
+``python static_assets.py`` runs at deploy time.  It copies every static
+file to ``static/dist/`` under a content-hashed name
+(``icon.png`` -> ``dist/icon.<hash>.png``), writes ``.gz`` / ``.br``
+siblings for compressible types, and records everything in
+``static/dist/asset-manifest.json``::
+
+    {"version": "...",
+     "assets": {"icon.png": {"path": "dist/icon.<hash>.png",
+                             "etag": "<sha256>", "encodings": ["br", "gzip"]}},
+     "precache": ["/static/dist/icon.<hash>.png", ...]}
+
+At request time ``send_static`` serves:
+
+* hashed files (and content-addressed ``cards/``) with
+  ``Cache-Control: public, max-age=31536000, immutable``;
+* everything else with ``no-cache`` and a strong ETag, so revisits are a
+  304 instead of a full download;
+* the precompressed variant the client accepts, with ``Vary: Accept-Encoding``.
+
+Templates link assets through ``asset_url``, and ``/serviceWorker.js`` is
+rendered from ``static/serviceWorker.js`` with the precache list and cache
+version taken from the same manifest.  Without a build the unhashed files
+are served as before.  ``brotli`` is optional; without it only gzip
+variants are written.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import threading
+
+from flask import Response, abort, request, send_from_directory
+from werkzeug.security import safe_join
+
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+DIST_DIR = "dist"
+MANIFEST_NAME = "asset-manifest.json"
+SERVICE_WORKER_SOURCE = "serviceWorker.js"
+IMMUTABLE_MAX_AGE = 31536000
+HASH_LENGTH = 12
+
+# dist 自体・生成物・URL を固定したいファイルはハッシュ化しない
+EXCLUDED_DIRS = {DIST_DIR, "generated", "cards"}
+STABLE_FILES = {"manifest.json", SERVICE_WORKER_SOURCE}
+# 既に圧縮済みの画像などは事前圧縮しない
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".json", ".svg", ".ttf", ".otf", ".ico", ".txt", ".html", ".map", ".xml"}
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# フォントとテンプレートは画像生成用でブラウザは読まないので事前キャッシュしない
+PRECACHE_EXCLUDED_PREFIXES = ("fonts/", "animal_templates/")
+CONTENT_ADDRESSED_PREFIX = "cards/"  # image_store のキーは内容のハッシュ
+
+_manifest = None
+_manifest_mtime_ns = None
+_etags = {}  # path -> (mtime_ns, size, etag)
+_service_worker = None  # (sw mtime_ns, manifest version, body, etag)
+_lock = threading.Lock()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashed_name(name, digest):
+    stem, ext = os.path.splitext(name)
+    return f"{DIST_DIR}/{stem}.{digest[:HASH_LENGTH]}{ext}"
+
+
+def iter_static_files(static_dir=STATIC_DIR):
+    """Yield the static paths (relative, '/'-separated) that get a hashed copy."""
+    for root, dirs, files in os.walk(static_dir):
+        rel_root = os.path.relpath(root, static_dir).replace(os.sep, "/")
+        if rel_root == ".":
+            dirs[:] = [d for d in dirs if d not in EXCLUDED_DIRS]
+            rel_root = ""
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            rel = f"{rel_root}/{name}" if rel_root else name
+            if rel not in STABLE_FILES and not name.startswith("."):
+                yield rel
+
+
+def precompress(path):
+    """Write .br / .gz next to ``path`` when they are smaller; returns the encodings written."""
+    with open(path, "rb") as f:
+        data = f.read()
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli  # 任意: 無ければ gzip だけ作る
+    except ImportError:
+        brotli = None
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+
+    written = []
+    for encoding in ("br", "gzip"):
+        encoded = variants.get(encoding)
+        if encoded is not None and len(encoded) < len(data):
+            with open(path + ENCODING_SUFFIXES[encoding], "wb") as f:
+                f.write(encoded)
+            written.append(encoding)
+    return written
+
+
+def build(static_dir=STATIC_DIR):
+    """Rebuild ``static/dist`` and its manifest; returns the manifest."""
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    # 作業用ディレクトリはドット始まりにして走査対象から外す
+    tmp_dir = os.path.join(static_dir, f".{DIST_DIR}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    assets = {}
+    for rel in iter_static_files(static_dir):
+        source = os.path.join(static_dir, rel)
+        digest = file_sha256(source)
+        path = hashed_name(rel, digest)
+        target = os.path.join(tmp_dir, path[len(DIST_DIR) + 1:])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, target)
+        encodings = []
+        if os.path.splitext(rel)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+            encodings = precompress(target)
+        assets[rel] = {"path": path, "etag": digest, "encodings": encodings}
+
+    version = hashlib.sha256(
+        json.dumps({rel: entry["etag"] for rel, entry in assets.items()}, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:HASH_LENGTH]
+    manifest = {
+        "version": version,
+        "assets": assets,
+        "precache": ["/manifest.json"] + sorted(
+            f"/static/{entry['path']}" for rel, entry in assets.items()
+            if not rel.startswith(PRECACHE_EXCLUDED_PREFIXES)
+        ),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+    old_dir = os.path.join(static_dir, f".{DIST_DIR}.{os.getpid()}.old")
+    if os.path.exists(dist_dir):
+        os.replace(dist_dir, old_dir)
+    os.replace(tmp_dir, dist_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def get_manifest(static_dir=STATIC_DIR):
+    """Return the built manifest (re-read after a rebuild), or an empty one."""
+    global _manifest, _manifest_mtime_ns
+    path = os.path.join(static_dir, DIST_DIR, MANIFEST_NAME)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if _manifest is not None and mtime_ns == _manifest_mtime_ns:
+        return _manifest
+    with _lock:
+        if _manifest is not None and mtime_ns == _manifest_mtime_ns:
+            return _manifest
+        manifest = {"version": "dev", "assets": {}, "precache": ["/manifest.json"]}
+        if mtime_ns is not None:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as error:
+                print(f"⚠️ asset-manifest.json の読み込みに失敗: {error}")
+        # 配信時に hashed path から引けるようにしておく
+        manifest["by_path"] = {entry["path"]: entry for entry in manifest.get("assets", {}).values()}
+        _manifest, _manifest_mtime_ns = manifest, mtime_ns
+        return manifest
+
+
+def asset_url(name):
+    """Return the URL of ``static/<name>``: the hashed copy when one is built."""
+    entry = get_manifest()["assets"].get(name)
+    return f"/static/{entry['path'] if entry else name}"
+
+
+def file_etag(path):
+    """Strong ETag (sha256) of a file, recomputed only when it changes."""
+    stat = os.stat(path)
+    cached = _etags.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    etag = file_sha256(path)
+    _etags[path] = (stat.st_mtime_ns, stat.st_size, etag)
+    return etag
+
+
+def _accepted_encoding(encodings):
+    for encoding in ("br", "gzip"):
+        if encoding in encodings and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def send_static(filename, static_dir=STATIC_DIR):
+    """Serve ``static/<filename>`` with cache headers, a strong ETag and precompression."""
+    path = safe_join(static_dir, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    manifest = get_manifest(static_dir)
+    entry = manifest["by_path"].get(filename) or manifest["assets"].get(filename)
+    if entry and entry["path"] == filename:
+        immutable, etag, encodings = True, entry["etag"], entry["encodings"]
+    elif filename.startswith(CONTENT_ADDRESSED_PREFIX):
+        immutable, etag, encodings = True, os.path.splitext(os.path.basename(filename))[0], []
+    else:
+        # 元の名前で来た場合も事前圧縮版は使える（ハッシュ版と中身が同じとき）
+        immutable, etag = False, file_etag(path)
+        encodings = entry["encodings"] if entry and entry["etag"] == etag else []
+
+    encoding = _accepted_encoding(encodings)
+    send_name = filename
+    if encoding:
+        send_name = entry["path"] + ENCODING_SUFFIXES[encoding]
+        etag = f"{etag}-{encoding}"  # 表現ごとに別の strong ETag にする
+    response = send_from_directory(
+        os.path.abspath(static_dir), send_name,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        etag=etag,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        conditional=True,
+    )
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if encodings:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+_SW_MARKERS = {
+    "cache-version": lambda manifest: f"const CACHE_VERSION = {json.dumps(manifest['version'])};",
+    "precache": lambda manifest: f"const PRECACHE_ASSETS = {json.dumps(manifest['precache'])};",
+}
+_SW_MARKER_LINE = re.compile(r"^.*// @build:([a-z-]+)\s*$", re.MULTILINE)
+
+
+def render_service_worker(static_dir=STATIC_DIR):
+    """Return (body, etag) of the service worker with the manifest's precache list filled in."""
+    global _service_worker
+    manifest = get_manifest(static_dir)
+    source_path = os.path.join(static_dir, SERVICE_WORKER_SOURCE)
+    mtime_ns = os.stat(source_path).st_mtime_ns
+    cached = _service_worker
+    if cached and cached[:2] == (mtime_ns, manifest["version"]):
+        return cached[2], cached[3]
+
+    with open(source_path, "r", encoding="utf-8") as f:
+        source = f.read()
+
+    def replace(match):
+        render = _SW_MARKERS.get(match.group(1))
+        return render(manifest) if render else match.group(0)
+
+    body = _SW_MARKER_LINE.sub(replace, source)
+    etag = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    _service_worker = (mtime_ns, manifest["version"], body, etag)
+    return body, etag
+
+
+def send_service_worker(static_dir=STATIC_DIR):
+    body, etag = render_service_worker(static_dir)
+    response = Response(body, mimetype="application/javascript")
+    response.set_etag(etag)
+    # SW 本体は常に再検証させる（更新がすぐ届くように）
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+if __name__ == "__main__":
+    built = build()
+    print(f"✅ Static assets built: {len(built['assets'])} files, version {built['version']}")
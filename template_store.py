@@ -0,0 +1,218 @@
+"""Ready-to-send data URIs for the animal template images.
+
+``generate_image`` used to open ``animal_templates/<animal>.png`` on every
+request, resize it to the model's 768x1024 input, re-encode it and base64
+it.  The result only depends on the template file, so it is built once
+and kept in two places:
+
+* an in-process dict, checked against the template's mtime on every
+  lookup, so an edited template is picked up without a restart;
+* a directory shared by all gunicorn workers (``TEMPLATE_CACHE_DIR``),
+  written atomically, whose file names carry the source mtime so stale
+  entries are never read.
+
+``TEMPLATE_FORMAT`` selects the encoding: ``png`` (default, the same
+bytes as before), or ``webp`` / ``jpeg`` for a much smaller request body.
+
+Build every entry ahead of time with:
+    python template_store.py
+
+Templates can also be uploaded once to Replicate's file store
+(``POST /v1/files``) so predictions reference a hosted URL instead of
+carrying the image inline.  The returned URL is kept in Redis until
+shortly before the file expires; ``get_template_url`` takes the Redis
+connection explicitly, like ``job_queue``.
+"""
+import base64
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+from PIL import Image
+
+import http_client
+
+TEMPLATE_DIR = "animal_templates"
+TEMPLATE_SIZE = (768, 1024)  # 3:4 比率（幅768, 高さ1024）
+TEMPLATE_FORMAT = os.getenv("TEMPLATE_FORMAT", "png").lower()
+TEMPLATE_QUALITY = int(os.getenv("TEMPLATE_QUALITY", "90"))
+TEMPLATE_CACHE_DIR = os.getenv(
+    "TEMPLATE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "music_monster_templates")
+)
+
+TEMPLATE_FILE_PREFIX = "music_monster:template_file:"
+TEMPLATE_FILE_DEFAULT_TTL = 60 * 60 * 24  # expires_at が返らない場合
+TEMPLATE_FILE_REFRESH_MARGIN = 60 * 60  # 期限の1時間前には使わない
+TEMPLATE_UPLOAD_LOCK_TTL = 60
+
+_MIME_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+if TEMPLATE_FORMAT not in _MIME_TYPES:
+    # リクエストの途中で KeyError になる前に、起動時に止める
+    raise ValueError(f"Unknown TEMPLATE_FORMAT: {TEMPLATE_FORMAT} (expected one of {', '.join(_MIME_TYPES)})")
+
+_entries = {}
+_entries_lock = threading.Lock()
+
+
+def template_path(animal):
+    return os.path.join(TEMPLATE_DIR, f"{animal}.png")
+
+
+def encode_template(path, fmt=TEMPLATE_FORMAT):
+    """Resize one template to TEMPLATE_SIZE and return it as a data URI."""
+    img = Image.open(path).resize(TEMPLATE_SIZE)
+    buffer = BytesIO()
+    if fmt == "png":
+        img.save(buffer, format="PNG")
+    else:
+        # WebP / JPEG は透過を持てない（JPEG）・不要なので RGB に揃える
+        img.convert("RGB").save(buffer, format=fmt.upper(), quality=TEMPLATE_QUALITY)
+    image_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return f"data:{_MIME_TYPES[fmt]};base64,{image_b64}"
+
+
+def _disk_path(animal, fmt, mtime_ns, cache_dir):
+    width, height = TEMPLATE_SIZE
+    return os.path.join(cache_dir, f"{animal}_{width}x{height}.{fmt}.{mtime_ns}.uri")
+
+
+def _load_from_disk(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data_uri = f.read()
+    except OSError:
+        return None
+    return data_uri if data_uri.startswith("data:") else None
+
+
+def _save_to_disk(animal, fmt, mtime_ns, data_uri, cache_dir):
+    """Write the entry atomically and drop entries built from older versions."""
+    path = _disk_path(animal, fmt, mtime_ns, cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data_uri)
+        os.replace(tmp_path, path)
+        for stale in glob.glob(_disk_path(animal, fmt, "*", cache_dir)):
+            if stale != path:
+                os.remove(stale)
+    except OSError as error:
+        print(f"⚠️ Template cache could not be written: {error}")
+
+
+def get_template_data_uri(animal, fmt=TEMPLATE_FORMAT, cache_dir=None):
+    """Return the data URI for ``animal``'s template, or None if the template is missing."""
+    path = template_path(animal)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    key = (animal, fmt)
+    with _entries_lock:
+        entry = _entries.get(key)
+    if entry and entry[0] == mtime_ns:
+        return entry[1]
+
+    cache_dir = cache_dir or TEMPLATE_CACHE_DIR
+    data_uri = _load_from_disk(_disk_path(animal, fmt, mtime_ns, cache_dir)) if cache_dir else None
+    if data_uri is None:
+        data_uri = encode_template(path, fmt)
+        if cache_dir:
+            _save_to_disk(animal, fmt, mtime_ns, data_uri, cache_dir)
+
+    with _entries_lock:
+        _entries[key] = (mtime_ns, data_uri)
+    return data_uri
+
+
+def _template_file_key(animal, fmt, mtime_ns):
+    return f"{TEMPLATE_FILE_PREFIX}{animal}:{fmt}:{mtime_ns}"
+
+
+def _seconds_until(expires_at):
+    """Seconds until an ISO-8601 timestamp such as ``2024-01-01T00:00:00.000Z``."""
+    try:
+        expires = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return TEMPLATE_FILE_DEFAULT_TTL
+    return expires.timestamp() - time.time()
+
+
+def upload_template(animal, api_base, api_token, fmt=TEMPLATE_FORMAT):
+    """Upload one template to Replicate's file store and return the file object."""
+    data_uri = get_template_data_uri(animal, fmt)
+    if data_uri is None:
+        raise FileNotFoundError(template_path(animal))
+    content = base64.b64decode(data_uri.split(",", 1)[1])
+    res = http_client.post(
+        f"{api_base}/files",
+        headers={"Authorization": f"Token {api_token}"},
+        files={"content": (f"{animal}.{fmt}", content, _MIME_TYPES[fmt])},
+        timeout=60,
+    )
+    res.raise_for_status()
+    return res.json()
+
+
+def get_template_url(conn, animal, api_base, api_token, fmt=TEMPLATE_FORMAT, refresh=False):
+    """Return a hosted URL for ``animal``'s template, uploading it when needed.
+
+    Returns None when the template does not exist, the upload fails, or
+    another worker is uploading it right now; callers then fall back to
+    ``get_template_data_uri``.  ``refresh=True`` discards the cached URL,
+    e.g. after Replicate rejected it.
+    """
+    try:
+        mtime_ns = os.stat(template_path(animal)).st_mtime_ns
+    except OSError:
+        return None
+    key = _template_file_key(animal, fmt, mtime_ns)
+    if refresh:
+        conn.delete(key)
+    else:
+        cached = conn.get(key)
+        if cached:
+            return json.loads(cached)["url"]
+
+    lock_key = f"{key}:lock"
+    if not conn.set(lock_key, "1", nx=True, ex=TEMPLATE_UPLOAD_LOCK_TTL):
+        return None
+    try:
+        uploaded = upload_template(animal, api_base, api_token, fmt)
+        url = uploaded["urls"]["get"]
+        ttl = int(_seconds_until(uploaded.get("expires_at")) - TEMPLATE_FILE_REFRESH_MARGIN)
+        if ttl > 0:
+            conn.setex(key, ttl, json.dumps({
+                "url": url,
+                "id": uploaded.get("id"),
+                "expires_at": uploaded.get("expires_at"),
+            }))
+        print(f"📤 Template uploaded: {animal} -> {url}")
+        return url
+    except Exception as error:
+        print(f"⚠️ Template upload failed for {animal}: {error}")
+        return None
+    finally:
+        conn.delete(lock_key)
+
+
+def build_all(fmt=TEMPLATE_FORMAT, cache_dir=None):
+    """Build (or load) the entry of every template; returns the animals done."""
+    animals = sorted(
+        os.path.splitext(name)[0] for name in os.listdir(TEMPLATE_DIR) if name.endswith(".png")
+    )
+    for animal in animals:
+        get_template_data_uri(animal, fmt, cache_dir)
+    return animals
+
+
+if __name__ == "__main__":
+    built = build_all()
+    print(f"✅ {len(built)} templates ready ({TEMPLATE_FORMAT}) in {TEMPLATE_CACHE_DIR}")
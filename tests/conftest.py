@@ -0,0 +1,101 @@
+"""Shared fixtures: the app runs against fakeredis and the stubs in ``scripts/``.
+
+Run from the repository root with ``python -m pytest`` after
+``pip install -r requirements-dev.txt``.  Configuration is read at
+import time, so the environment is set here before ``app`` is imported.
+"""
+import os
+import sys
+import tempfile
+from urllib.parse import urlsplit
+
+import fakeredis
+import pytest
+import redis
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+os.chdir(ROOT)  # data/・static/・animal_templates/ はリポジトリからの相対パス
+
+WEBHOOK_SECRET = "whsec_c3R1Yi1zZWNyZXQ="
+_scratch = tempfile.mkdtemp(prefix="music_monster_tests_")
+os.environ.update(
+    REDIS_URL="redis://localhost:6379/0",
+    SPOTIPY_CLIENT_ID="test-client",
+    SPOTIPY_CLIENT_SECRET="test-secret",
+    SPOTIPY_REDIRECT_URI="http://localhost/callback",
+    REPLICATE_API_TOKEN="test-token",
+    REPLICATE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+    PUBLIC_BASE_URL="http://localhost",
+    SESSION_COOKIE_NAME="spotify_session",
+    IMAGE_STORE_DIR=os.path.join(_scratch, "cards"),
+    TEMPLATE_CACHE_DIR=os.path.join(_scratch, "templates"),
+)
+
+FAKE_REDIS = fakeredis.FakeServer()
+redis.from_url = lambda *args, **kwargs: fakeredis.FakeRedis(server=FAKE_REDIS)
+
+
+@pytest.fixture
+def web():
+    """The Flask app module on an empty fake Redis."""
+    import app
+
+    app.redis_client.flushall()
+    app.invalidate_gallery_cache()
+    return app
+
+
+@pytest.fixture
+def client(web):
+    return web.app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """Log the test client in as a user without going through Spotify."""
+    def log_in(user_id):
+        with client.session_transaction() as user_session:
+            user_session["user_id"] = user_id
+    return log_in
+
+
+class StubResponse:
+    """The parts of ``requests.Response`` the app uses, over a Flask test response."""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.text = response.get_data(as_text=True)
+        self.content = response.get_data()
+        self._response = response
+
+    def json(self):
+        return self._response.get_json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}: {self.text[:200]}", response=self)
+
+
+@pytest.fixture
+def spotify_stub(web, monkeypatch):
+    """Route ``http_client`` calls to scripts/spotify_stub.py; ``.calls`` lists (method, path)."""
+    import spotify_stub
+
+    stub_client = spotify_stub.stub.test_client()
+    stub_client.calls = []
+
+    def forward(method):
+        def send(url, headers=None, json=None, data=None, params=None, timeout=None, **kwargs):
+            path = urlsplit(url).path
+            stub_client.calls.append((method, path))
+            return StubResponse(stub_client.open(
+                path, method=method, headers=headers, json=json, data=data, query_string=params,
+            ))
+        return send
+
+    for method in ("get", "post", "put", "delete"):
+        monkeypatch.setattr(web.http_client, method, forward(method.upper()))
+    return stub_client
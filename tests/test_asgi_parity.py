@@ -0,0 +1,173 @@
+"""The ASGI routes (asgi.py) answer exactly like the Flask routes they replace."""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from starlette.testclient import TestClient
+from werkzeug.serving import make_server
+
+import job_queue
+import replicate_stub
+import spotify_stub
+import spotify_tokens
+from conftest import FAKE_REDIS
+
+
+def serve(wsgi_app):
+    server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def stubs(web, monkeypatch):
+    """scripts/spotify_stub.py and scripts/replicate_stub.py on free local ports; predictions stay ``starting``."""
+    spotify, replicate = serve(spotify_stub.stub), serve(replicate_stub.stub)
+    monkeypatch.setattr(replicate_stub, "threading", SimpleNamespace(Thread=lambda **kwargs: SimpleNamespace(start=lambda: None)))
+    monkeypatch.setattr(web, "SPOTIFY_API_BASE", f"http://127.0.0.1:{spotify.server_port}/v1")
+    monkeypatch.setattr(web, "REPLICATE_API_BASE", f"http://127.0.0.1:{replicate.server_port}/v1")
+    monkeypatch.setattr(web, "STATUS_KEEPALIVE_SECONDS", 0.05)
+    monkeypatch.setattr(web, "STATUS_STREAM_SECONDS", 0.3)
+    yield
+    spotify.shutdown()
+    replicate.shutdown()
+
+
+@pytest.fixture
+def asgi_client(web, stubs, monkeypatch):
+    import asgi
+
+    monkeypatch.setattr(asgi, "aioredis", SimpleNamespace(
+        Redis=lambda connection_pool: fakeredis.aioredis.FakeRedis(server=FAKE_REDIS),
+        BlockingConnectionPool=SimpleNamespace(from_url=lambda *args, **kwargs: None),
+    ))
+    with TestClient(asgi.app) as asgi_client:
+        yield asgi_client
+
+
+@pytest.fixture
+def get_both(web, client, asgi_client):
+    """GET a path from both apps with the Flask test client's session; returns (Flask, ASGI) responses."""
+    def get(path):
+        flask_response = client.get(path)
+        cookie = client.get_cookie(web.app.config["SESSION_COOKIE_NAME"])
+        headers = {"Cookie": f"{cookie.key}={cookie.value}"} if cookie else {}
+        return flask_response, asgi_client.get(path, headers=headers)
+    return get
+
+
+def status_events(text):
+    """The ``status`` events of an SSE body (keepalives depend on timing)."""
+    return [line for line in text.splitlines() if line.startswith("data: ")]
+
+
+def assert_same(flask_response, asgi_response):
+    assert asgi_response.status_code == flask_response.status_code
+    if flask_response.is_json:
+        assert asgi_response.json() == flask_response.get_json()
+    elif flask_response.mimetype == "text/event-stream":
+        assert asgi_response.headers["Cache-Control"] == flask_response.headers["Cache-Control"]
+        assert status_events(asgi_response.text) == status_events(flask_response.get_data(as_text=True))
+    else:
+        assert asgi_response.text == flask_response.get_data(as_text=True)
+
+
+def own_card(web, prediction_id, user_id="alice"):
+    web.redis_client.set(f"{web.CARD_SPEC_PREFIX}{prediction_id}", json.dumps({"user_id": user_id}))
+
+
+CARD_STATES = {
+    "finished": lambda web, pid: web.save_finished_card(pid, {
+        "status": "succeeded", "image_url": "http://img/card.webp", "user": "alice",
+        "playlist_status": web.PLAYLIST_READY, "playlist_url": "https://open.spotify.com/playlist/x",
+    }),
+    "finishing": lambda web, pid: web.set_card_status(pid, "queued"),
+    "expired": lambda web, pid: web.set_card_status(pid, "succeeded"),
+    "processing": lambda web, pid: web.record_prediction({"id": pid, "status": "processing", "output": None}),
+    "failed": lambda web, pid: web.record_prediction({"id": pid, "status": "failed", "output": None}),
+}
+
+
+@pytest.mark.parametrize("state", sorted(CARD_STATES))
+def test_result_routes_answer_alike(web, login, get_both, state):
+    prediction_id = f"pred-{state}"
+    own_card(web, prediction_id)
+    CARD_STATES[state](web, prediction_id)
+    login("alice")
+
+    flask_result, asgi_result = get_both(f"/result/{prediction_id}")
+    assert_same(flask_result, asgi_result)
+
+    status = flask_result.get_json()["status"]
+    assert_same(*get_both(f"/result/{prediction_id}/wait?status={status}&timeout=0.1"))
+    assert_same(*get_both(f"/result/{prediction_id}/wait?timeout=oops&status=other"))
+
+    assert_same(*get_both(f"/result/{prediction_id}/events"))
+
+
+@pytest.mark.parametrize("user_id", [None, "bob"])
+@pytest.mark.parametrize("prediction_id", ["pred-owned", "pred-unknown"])
+def test_access_errors_answer_alike(web, login, get_both, user_id, prediction_id):
+    own_card(web, "pred-owned")
+    web.set_card_status("pred-owned", "queued")
+    if user_id:
+        login(user_id)
+
+    for path in (f"/result/{prediction_id}", f"/result/{prediction_id}/wait", f"/result/{prediction_id}/events"):
+        assert_same(*get_both(path))
+
+
+def test_generate_api_plans_the_same_card(web, login, get_both, monkeypatch):
+    monkeypatch.setattr(web.random, "choice", lambda options: options[0])  # タイトルの語を固定
+    spotify_tokens.save_token(web.redis_client, "alice", {
+        "access_token": "access-alice", "refresh_token": "refresh-alice", "expires_at": time.time() + 3600,
+    })
+    login("alice")
+
+    flask_response, asgi_response = get_both("/generate_api/alice")
+
+    assert flask_response.status_code == asgi_response.status_code == 200
+    predictions = [flask_response.get_json(), asgi_response.json()]
+    assert [set(body) for body in predictions] == [{"prediction_id", "status_url"}] * 2
+    records = [
+        {
+            prefix: json.loads(web.redis_client.get(f"{prefix}{body['prediction_id']}"))
+            for prefix in (web.SOURCE_TRACKS_PREFIX, web.CARD_SPEC_PREFIX)
+        }
+        for body in predictions
+    ]
+    assert records[0] == records[1]
+    assert records[0][web.SOURCE_TRACKS_PREFIX]["track_uris"]
+
+
+def test_busy_answer_alike(web, login, get_both, monkeypatch):
+    monkeypatch.setattr(web, "FINISH_BACKLOG_MAX", 1)
+    job_queue.enqueue(web.redis_client, web.CARD_QUEUE, "finish_card", {"prediction_id": "pred-backlog"})
+    login("alice")
+
+    flask_response, asgi_response = get_both("/generate_api/alice")
+
+    assert_same(flask_response, asgi_response)
+    assert flask_response.status_code == 503
+    assert asgi_response.headers["Retry-After"] == flask_response.headers["Retry-After"]
+    assert_same(*get_both("/generate_api/bob"))
+
+
+def test_asgi_moves_a_legacy_session_token_once(web, client, asgi_client):
+    with client.session_transaction() as user_session:
+        user_session.update(
+            user_id="alice", access_token="access-alice", refresh_token="refresh-alice",
+            expires_at=int(time.time()) + 3600,
+        )
+    cookie = client.get_cookie(web.app.config["SESSION_COOKIE_NAME"])
+    cookie_header = f"{cookie.key}={cookie.value}"
+
+    assert asgi_client.get("/generate_api/alice", headers={"Cookie": cookie_header}).status_code == 200
+
+    assert spotify_tokens.load_token(web.redis_client, "alice")["refresh_token"] == "refresh-alice"
+    stored_session = web.load_session(cookie_header)
+    assert stored_session["user_id"] == "alice"
+    assert "refresh_token" not in stored_session and "access_token" not in stored_session
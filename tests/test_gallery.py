@@ -0,0 +1,84 @@
+"""The gallery save and page scripts (_SAVE_GALLERY_CARD_SCRIPT, _READ_GALLERY_PAGE_SCRIPT)."""
+import json
+
+import pytest
+
+import job_queue
+
+NOW = 1_700_000_000.0
+
+
+def save_card(web, monkeypatch, prediction_id, seconds=0.0):
+    """Save a public card as if it finished ``seconds`` after NOW."""
+    monkeypatch.setattr(web.time, "time", lambda: NOW + seconds)
+    web.redis_client.set(f"{web.SOURCE_PLAYLIST_PREFIX}{prediction_id}", json.dumps({"state": web.PLAYLIST_READY}))
+    web.save_finished_card(prediction_id, {"status": "succeeded", "image_url": f"http://img/{prediction_id}.webp"})
+    web.save_public_card(
+        prediction_id, f"http://img/{prediction_id}.webp", "Cat", prediction_id, "alice",
+        source_playlist={"playlist_id": f"list{prediction_id}", "playlist_url": "https://open.spotify.com/playlist/x"},
+        images={"full": {"key": f"cards/{prediction_id}.webp", "url": f"http://img/{prediction_id}.webp"}},
+    )
+
+
+def cleanup_jobs(web):
+    """(type, payload) of the queued cleanup jobs, oldest first."""
+    ready = job_queue.queue_keys(web.CLEANUP_QUEUE)[0]
+    return [
+        (job["type"], job["payload"])
+        for job in (json.loads(raw) for raw in reversed(web.redis_client.lrange(ready, 0, -1)))
+    ]
+
+
+@pytest.fixture
+def small_gallery(web, monkeypatch):
+    """Three cards are kept, the newest two of them with their playlist."""
+    monkeypatch.setattr(web, "GALLERY_RETENTION_ITEMS", 3)
+    monkeypatch.setattr(web, "GALLERY_PLAYLIST_RETENTION_ITEMS", 2)
+
+
+def test_card_past_the_retention_is_removed_with_its_records(web, monkeypatch, small_gallery):
+    for index in range(4):
+        save_card(web, monkeypatch, f"pred{index}", index)
+
+    assert web.redis_client.zrevrange(web.GALLERY_TIMELINE_KEY, 0, -1) == [b"pred3", b"pred2", b"pred1"]
+    for prefix in (web.GALLERY_CARD_PREFIX, web.SOURCE_PLAYLIST_PREFIX, web.CARD_RESULT_PREFIX):
+        assert not web.redis_client.exists(f"{prefix}pred0")
+    assert ("cleanup_card", {
+        "prediction_id": "pred0", "playlist_id": "listpred0", "image_keys": ["cards/pred0.webp"], "owner_id": "alice",
+    }) in cleanup_jobs(web)
+
+
+def test_only_the_playlist_is_dropped_past_the_playlist_retention(web, monkeypatch, small_gallery):
+    for index in range(3):
+        save_card(web, monkeypatch, f"pred{index}", index)
+
+    assert cleanup_jobs(web) == [("expire_playlist", {"prediction_id": "pred0"})]
+    for prefix in (web.GALLERY_CARD_PREFIX, web.SOURCE_PLAYLIST_PREFIX, web.CARD_RESULT_PREFIX):
+        assert web.redis_client.exists(f"{prefix}pred0")
+
+
+def test_saving_a_card_again_changes_nothing(web, monkeypatch, small_gallery):
+    for index in range(3):
+        save_card(web, monkeypatch, f"pred{index}", index)
+
+    save_card(web, monkeypatch, "pred0", 10)
+
+    assert web.redis_client.zrevrange(web.GALLERY_TIMELINE_KEY, 0, -1) == [b"pred2", b"pred1", b"pred0"]
+    assert len(cleanup_jobs(web)) == 1
+
+
+def test_cursor_pages_do_not_skip_or_repeat_cards_with_the_same_score(web, monkeypatch):
+    saved = ["pred9"] + [f"pred{index}" for index in range(7)] + ["pred8"]
+    for prediction_id, seconds in zip(saved, [2] + [1] * 7 + [0]):
+        save_card(web, monkeypatch, prediction_id, seconds)
+
+    seen, cursor = [], None
+    while True:
+        cards, cursor = web.load_gallery_page(cursor, limit=2)
+        seen.extend(card["prediction_id"] for card in cards)
+        if cursor is None:
+            break
+        assert web.parse_gallery_cursor(cursor)
+
+    # 同じ時刻のカードは ID の逆辞書順に並ぶ
+    assert seen == ["pred9", "pred6", "pred5", "pred4", "pred3", "pred2", "pred1", "pred0", "pred8"]
@@ -0,0 +1,20 @@
+import pytest
+
+
+@pytest.mark.parametrize("owner, user_id", [(None, None), (None, "alice"), ("owner", None), ("owner", "alice")])
+def test_metrics_are_private(web, client, login, monkeypatch, owner, user_id):
+    monkeypatch.setattr(web, "OWNER_SPOTIFY_ID", owner)
+    if user_id:
+        login(user_id)
+
+    assert client.get("/metrics/http").status_code == 403
+
+
+def test_owner_sees_the_metrics(web, client, login, monkeypatch):
+    monkeypatch.setattr(web, "OWNER_SPOTIFY_ID", "owner")
+    login("owner")
+
+    response = client.get("/metrics/http")
+
+    assert response.status_code == 200
+    assert response.get_json() == web.http_client.metrics_snapshot()
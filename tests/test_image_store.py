@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import pytest
+from PIL import Image
+from werkzeug.serving import make_server
+
+import image_store
+import s3_stub
+
+
+@pytest.fixture
+def s3_endpoint():
+    """scripts/s3_stub.py served on a free local port."""
+    server = make_server("127.0.0.1", 0, s3_stub.stub, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    s3_stub.objects.clear()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture(params=["local", "s3"])
+def backend(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_store, "IMAGE_STORE", request.param)
+    monkeypatch.setattr(image_store, "IMAGE_STORE_DIR", str(tmp_path / "cards"))
+    if request.param == "s3":
+        pytest.importorskip("boto3")
+        endpoint = request.getfixturevalue("s3_endpoint")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "stub")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "stub")
+        monkeypatch.setattr(image_store, "S3_BUCKET", "cards")
+        monkeypatch.setattr(image_store, "S3_ENDPOINT_URL", endpoint)
+        monkeypatch.setattr(image_store, "S3_REGION", "us-east-1")
+        monkeypatch.setattr(image_store, "S3_PUBLIC_BASE_URL", f"{endpoint}/cards")
+        monkeypatch.setattr(image_store, "_s3_client", None)
+    return request.param
+
+
+def card(color=(200, 60, 90)):
+    return Image.new("RGBA", (768, 1024), color + (255,))
+
+
+def test_variants_are_webp_at_their_sizes(backend):
+    stored = image_store.store_card_image(card(), "http://localhost")
+
+    assert set(stored) == set(image_store.VARIANTS)
+    sizes = {}
+    for variant, entry in stored.items():
+        img = Image.open(BytesIO(image_store.load_image(entry["key"])))
+        assert img.format == "WEBP"
+        sizes[variant] = img.size
+    assert sizes == {"full": (768, 1024), "thumb": (360, 480)}
+
+
+def test_keys_are_the_hash_of_the_stored_bytes(backend):
+    stored = image_store.store_card_image(card())
+
+    for entry in stored.values():
+        data = image_store.load_image(entry["key"])
+        assert entry["key"] == f"cards/{hashlib.sha256(data).hexdigest()}.webp"
+    assert image_store.store_card_image(card()) == stored
+    assert image_store.store_card_image(card((10, 20, 30)))["full"]["key"] != stored["full"]["key"]
+
+
+def test_urls_point_at_the_backend(backend):
+    stored = image_store.store_card_image(card(), "http://localhost")
+
+    key = stored["full"]["key"]
+    if backend == "s3":
+        assert stored["full"]["url"] == f"{image_store.S3_PUBLIC_BASE_URL}/{key}"
+        body, content_type, cache_control = s3_stub.objects[("cards", key)]
+        assert content_type == "image/webp"
+        assert cache_control == image_store.IMMUTABLE_CACHE_CONTROL
+    else:
+        assert stored["full"]["url"].startswith("http://localhost/")
+        assert stored["full"]["url"].endswith(key[len(image_store.IMAGE_KEY_PREFIX):])
+
+
+def test_delete_removes_every_variant_and_ignores_other_keys(backend):
+    stored = image_store.store_card_image(card())
+    keys = [entry["key"] for entry in stored.values()]
+
+    image_store.delete_images(keys + [None, "static/other.png", "cards/missing.webp"])
+
+    if backend == "s3":
+        from botocore.exceptions import ClientError as missing
+    else:
+        missing = FileNotFoundError
+    for key in keys:
+        with pytest.raises(missing):
+            image_store.load_image(key)
+
+
+def test_store_variants_stores_bytes_encoded_elsewhere(backend):
+    encoded = image_store.encode_card_variants(card())
+
+    stored = image_store.store_variants(encoded)
+
+    for variant, data in encoded.items():
+        assert image_store.load_image(stored[variant]["key"]) == data
+
+
+def test_local_images_are_served_from_any_directory(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_store, "IMAGE_STORE", "local")
+    monkeypatch.setattr(image_store, "IMAGE_STORE_DIR", str(tmp_path / "outside-static"))
+    stored = image_store.store_card_image(card(), "http://localhost")
+
+    response = client.get(urlsplit(stored["full"]["url"]).path)
+
+    assert response.status_code == 200
+    assert response.data == image_store.load_image(stored["full"]["key"])
+    assert response.mimetype == "image/webp"
+    assert response.cache_control.immutable
+    assert client.get("/cards/missing.webp").status_code == 404
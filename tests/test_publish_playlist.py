@@ -0,0 +1,140 @@
+import json
+import time
+
+import pytest
+import redis
+from PIL import Image
+
+import image_store
+import spotify_tokens
+
+PREDICTION_ID = "pred-playlist"
+
+
+@pytest.fixture
+def finished_card(web):
+    """A delivered card whose playlist job is queued, owned by ``alice``."""
+    spotify_tokens.save_token(web.redis_client, "alice", {
+        "access_token": "access-alice",
+        "refresh_token": "refresh-alice",
+        "expires_at": time.time() + 3600,
+    })
+    web.redis_client.set(f"{web.SOURCE_TRACKS_PREFIX}{PREDICTION_ID}", json.dumps({
+        "user_id": "alice", "track_uris": ["spotify:track:stubtrack0000"],
+    }))
+    web.redis_client.set(
+        f"{web.SOURCE_PLAYLIST_PREFIX}{PREDICTION_ID}", json.dumps({"state": web.PLAYLIST_PENDING}),
+    )
+    web.save_public_card(PREDICTION_ID, "http://img/card.webp", "Cat", "0001", "alice")
+    web.save_finished_card(PREDICTION_ID, {
+        "status": "succeeded",
+        "image_url": "http://img/card.webp",
+        "playlist_url": None,
+        "playlist_status": web.PLAYLIST_PENDING,
+        "user": "alice",
+    })
+    return {"prediction_id": PREDICTION_ID, "card_id": "0001", "user_id": "alice"}
+
+
+def gallery_card(web):
+    return json.loads(web.redis_client.get(f"{web.GALLERY_CARD_PREFIX}{PREDICTION_ID}"))
+
+
+def test_playlist_is_published_to_both_cards(web, spotify_stub, finished_card):
+    web.run_publish_playlist_job(finished_card)
+
+    source_playlist = web.get_source_playlist(PREDICTION_ID)
+    assert source_playlist["state"] == web.PLAYLIST_READY
+    card = web.get_finished_card(PREDICTION_ID)
+    assert card["playlist_status"] == web.PLAYLIST_READY
+    assert card["playlist_url"] == source_playlist["playlist_url"]
+    assert gallery_card(web)["playlist_url"] == source_playlist["playlist_url"]
+
+
+def test_retry_publishes_a_playlist_that_became_ready_before_the_failure(
+    web, spotify_stub, finished_card, monkeypatch,
+):
+    save_finished_card = web.save_finished_card
+    failures = []
+
+    def flaky_save(prediction_id, card):
+        if card.get("playlist_status") == web.PLAYLIST_READY and not failures:
+            failures.append(prediction_id)
+            raise redis.ConnectionError("connection reset")
+        save_finished_card(prediction_id, card)
+
+    monkeypatch.setattr(web, "save_finished_card", flaky_save)
+    with pytest.raises(redis.ConnectionError):
+        web.run_publish_playlist_job(finished_card)
+    assert web.get_source_playlist(PREDICTION_ID)["state"] == web.PLAYLIST_READY
+    assert web.get_finished_card(PREDICTION_ID)["playlist_status"] == web.PLAYLIST_PENDING
+
+    web.run_publish_playlist_job(finished_card)
+
+    playlist_url = web.get_source_playlist(PREDICTION_ID)["playlist_url"]
+    assert web.get_finished_card(PREDICTION_ID)["playlist_url"] == playlist_url
+    assert gallery_card(web)["playlist_url"] == playlist_url
+    assert spotify_stub.calls.count(("POST", "/v1/me/playlists")) == 1
+
+
+def test_missing_token_is_retried_instead_of_failing_the_playlist(web, spotify_stub, finished_card):
+    spotify_tokens.delete_token(web.redis_client, "alice")
+
+    with pytest.raises(spotify_tokens.TokenMissing):
+        web.run_publish_playlist_job(finished_card)
+    assert web.get_source_playlist(PREDICTION_ID)["state"] == web.PLAYLIST_PENDING
+    assert spotify_stub.calls == []
+
+    spotify_tokens.save_token(web.redis_client, "alice", {
+        "access_token": "access-alice", "expires_at": time.time() + 3600,
+    })
+    web.run_publish_playlist_job(finished_card)
+
+    assert web.get_finished_card(PREDICTION_ID)["playlist_status"] == web.PLAYLIST_READY
+
+
+def test_card_without_source_tracks_fails_its_playlist(web, spotify_stub, finished_card):
+    web.redis_client.delete(f"{web.SOURCE_TRACKS_PREFIX}{PREDICTION_ID}")
+
+    web.run_publish_playlist_job(finished_card)
+
+    assert web.get_source_playlist(PREDICTION_ID)["error"] == "No source tracks for this card"
+    assert web.get_finished_card(PREDICTION_ID)["playlist_status"] == web.PLAYLIST_FAILED
+
+
+@pytest.mark.parametrize("evicted_after", ["/me/playlists", "/items"])
+def test_playlist_made_for_an_evicted_card_is_removed(web, spotify_stub, finished_card, monkeypatch, evicted_after):
+    post = web.http_client.post
+
+    def evicting_post(url, **kwargs):
+        response = post(url, **kwargs)
+        if url.endswith(evicted_after):
+            web.redis_client.delete(f"{web.SOURCE_PLAYLIST_PREFIX}{PREDICTION_ID}")  # ギャラリーから押し出された
+        return response
+
+    monkeypatch.setattr(web.http_client, "post", evicting_post)
+
+    web.run_publish_playlist_job(finished_card)
+
+    assert web.get_source_playlist(PREDICTION_ID) is None
+    removed = [path for method, path in spotify_stub.calls if method == "DELETE"]
+    assert len(removed) == 1 and removed[0].endswith("/followers")
+
+
+def test_cover_waits_for_a_token_instead_of_being_skipped(web, spotify_stub, finished_card):
+    stored = image_store.store_card_image(Image.new("RGBA", (768, 1024), (200, 60, 90, 255)))
+    job = dict(finished_card, image_key=stored["full"]["key"])
+    web.create_source_playlist(PREDICTION_ID, job["card_id"], "alice")
+    spotify_tokens.delete_token(web.redis_client, "alice")
+
+    with pytest.raises(spotify_tokens.TokenMissing):
+        web.run_publish_playlist_job(job)
+    assert not web.get_source_playlist(PREDICTION_ID)["cover_uploaded"]
+
+    spotify_tokens.save_token(web.redis_client, "alice", {
+        "access_token": "access-alice", "expires_at": time.time() + 3600,
+    })
+    web.run_publish_playlist_job(job)
+
+    assert web.get_source_playlist(PREDICTION_ID)["cover_uploaded"]
+    assert [method for method, path in spotify_stub.calls if path.endswith("/images")] == ["PUT"]
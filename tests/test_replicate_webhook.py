@@ -0,0 +1,144 @@
+import json
+import time
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+import job_queue
+import replicate_stub
+
+
+def signed_delivery(body, webhook_id="msg_test", timestamp=None):
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    return {
+        "Content-Type": "application/json",
+        "webhook-id": webhook_id,
+        "webhook-timestamp": timestamp,
+        "webhook-signature": replicate_stub.sign_webhook(webhook_id, timestamp, body),
+    }
+
+
+def succeeded(prediction_id):
+    return json.dumps({
+        "id": prediction_id,
+        "status": "succeeded",
+        "output": [f"http://localhost:5001/outputs/{prediction_id}.png"],
+        "error": None,
+    }).encode("utf-8")
+
+
+def queued_predictions(web):
+    ready = web.redis_client.lrange(job_queue.queue_keys(web.CARD_QUEUE)[0], 0, -1)
+    return [json.loads(raw)["payload"]["prediction_id"] for raw in ready]
+
+
+@pytest.fixture
+def stub(client, monkeypatch):
+    """The Replicate stub with its webhooks delivered to the app's test client, in order."""
+    deliveries = []
+
+    def post(url, data, timeout, headers):
+        response = client.post(urlsplit(url).path, data=data, headers=headers)
+        deliveries.append(response.status_code)
+        return response
+
+    class RunNow:
+        def __init__(self, target, args, daemon):
+            self.target, self.args = target, args
+
+        def start(self):
+            self.target(*self.args)
+
+    monkeypatch.setattr(replicate_stub, "STEP_SECONDS", 0)
+    monkeypatch.setattr(replicate_stub, "threading", SimpleNamespace(Thread=RunNow))
+    monkeypatch.setattr(replicate_stub, "requests", SimpleNamespace(
+        post=post, RequestException=requests.RequestException,
+    ))
+    stub_client = replicate_stub.stub.test_client()
+    stub_client.deliveries = deliveries
+    return stub_client
+
+
+def test_stub_webhooks_record_the_prediction_and_queue_finishing(web, stub):
+    response = stub.post("/v1/predictions", json={
+        "version": "test",
+        "input": {"prompt": "a cat"},
+        "webhook": f"{web.PUBLIC_BASE_URL}/webhooks/replicate",
+        "webhook_events_filter": ["start", "completed"],
+    })
+    prediction_id = response.get_json()["id"]
+
+    assert stub.deliveries == [200, 200]
+    state = web.get_prediction_state(prediction_id)
+    assert state["status"] == "succeeded"
+    assert state["output"] == [f"http://localhost/outputs/{prediction_id}.png"]
+    assert queued_predictions(web) == [prediction_id]
+    assert web.get_card_status(prediction_id)["state"] == "queued"
+
+
+@pytest.mark.parametrize("tamper", ["secret", "body", "missing"])
+def test_webhook_with_a_bad_signature_is_rejected(web, client, monkeypatch, tamper):
+    body = succeeded("pred-bad")
+    headers = signed_delivery(body)
+    if tamper == "secret":
+        monkeypatch.setattr(replicate_stub, "WEBHOOK_SECRET", "whsec_b3RoZXItc2VjcmV0")
+        headers = signed_delivery(body)
+    elif tamper == "body":
+        body = succeeded("pred-other")
+    else:
+        del headers["webhook-signature"]
+
+    response = client.post("/webhooks/replicate", data=body, headers=headers)
+
+    assert response.status_code == 401
+    assert web.get_prediction_state("pred-bad") is None
+    assert web.get_prediction_state("pred-other") is None
+    assert queued_predictions(web) == []
+
+
+def test_expired_webhook_is_rejected(web, client):
+    body = succeeded("pred-old")
+    headers = signed_delivery(body, timestamp=time.time() - web.WEBHOOK_TOLERANCE_SECONDS - 60)
+
+    response = client.post("/webhooks/replicate", data=body, headers=headers)
+
+    assert response.status_code == 401
+    assert web.get_prediction_state("pred-old") is None
+
+
+def test_replayed_webhook_is_applied_once(web, client, monkeypatch):
+    recorded = []
+    record_prediction = web.record_prediction
+    monkeypatch.setattr(web, "record_prediction", lambda prediction: (
+        recorded.append(prediction["id"]), record_prediction(prediction)
+    )[1])
+    body = succeeded("pred-replay")
+    headers = signed_delivery(body, webhook_id="msg_replay")
+
+    first = client.post("/webhooks/replicate", data=body, headers=headers)
+    replay = client.post("/webhooks/replicate", data=body, headers=headers)
+
+    assert first.get_json() == {"status": "ok"}
+    assert replay.get_json() == {"status": "duplicate"}
+    assert recorded == ["pred-replay"]
+    assert queued_predictions(web) == ["pred-replay"]
+
+
+def test_result_reads_only_local_state(web, client, login, monkeypatch):
+    def no_upstream(*args, **kwargs):
+        raise AssertionError("/result must not call Replicate while webhooks are fresh")
+
+    monkeypatch.setattr(web.http_client, "get", no_upstream)
+    web.redis_client.set(f"{web.CARD_SPEC_PREFIX}pred-local", json.dumps({"user_id": "alice"}))
+    web.record_prediction({"id": "pred-local", "status": "processing", "output": None})
+    login("alice")
+
+    assert client.get("/result/pred-local").get_json() == {"status": "processing", "image_url": None}
+
+    web.record_prediction({"id": "pred-local", "status": "succeeded", "output": ["http://img/x.png"]})
+    assert client.get("/result/pred-local").get_json() == {"status": "finishing", "image_url": None}
+
+    web.save_finished_card("pred-local", {"status": "succeeded", "image_url": "http://img/card.webp", "user": "alice"})
+    assert client.get("/result/pred-local").get_json()["image_url"] == "http://img/card.webp"
@@ -0,0 +1,102 @@
+import json
+import math
+
+import pytest
+
+
+class FakeSpotify:
+    """Stands in for spotipy: records every ``artists`` call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def artists(self, ids):
+        assert len(ids) <= 50, "Spotify's /artists takes at most 50 IDs"
+        self.calls.append(list(ids))
+        return {"artists": [{"id": aid, "name": f"Artist {aid}", "genres": ["rock"]} for aid in ids]}
+
+
+@pytest.fixture
+def redis_calls(web, monkeypatch):
+    """Counts the Redis round trips ``resolve_artists`` makes."""
+    calls = {"mget": 0, "pipelines": [], "single": 0}
+    conn = web.redis_client
+    mget, pipeline = conn.mget, conn.pipeline
+
+    def counted_mget(*args, **kwargs):
+        calls["mget"] += 1
+        return mget(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        commands = []
+        setex = pipe.setex
+
+        def counted_setex(*setex_args, **setex_kwargs):
+            commands.append(setex_args[0])
+            return setex(*setex_args, **setex_kwargs)
+
+        pipe.setex = counted_setex
+        calls["pipelines"].append(commands)
+        return pipe
+
+    def single(*args, **kwargs):
+        calls["single"] += 1
+        raise AssertionError("artist info must not be read or written one key at a time")
+
+    monkeypatch.setattr(conn, "mget", counted_mget)
+    monkeypatch.setattr(conn, "pipeline", counted_pipeline)
+    monkeypatch.setattr(conn, "get", single)
+    monkeypatch.setattr(conn, "setex", single)
+    return calls
+
+
+def plays(artist_ids):
+    return [{"track": {"artists": [{"id": aid}]}} for aid in artist_ids]
+
+
+def test_fifty_plays_with_repeated_artists_are_fetched_once(web, redis_calls):
+    items = plays([f"artist{index % 7}" for index in range(50)])
+    sp = FakeSpotify()
+
+    artists = web.resolve_artists(sp, web.played_artist_ids(items))
+
+    assert sorted(artists) == [f"artist{index}" for index in range(7)]
+    assert redis_calls["mget"] == 1
+    assert sp.calls == [[f"artist{index}" for index in range(7)]]
+    assert len(redis_calls["pipelines"]) == 1
+    assert len(redis_calls["pipelines"][0]) == 7
+
+
+def test_misses_are_fetched_in_chunks_of_fifty_and_written_back_in_one_pipeline(web, redis_calls):
+    unique_ids = [f"artist{index:03d}" for index in range(130)]
+    cached_ids = unique_ids[::10]  # 13 件はキャッシュ済み
+    for aid in cached_ids:
+        web.redis_client.set(f"{web.ARTIST_INFO_PREFIX}{aid}", json.dumps({"id": aid, "genres": []}))
+    misses = [aid for aid in unique_ids if aid not in cached_ids]
+    sp = FakeSpotify()
+
+    artists = web.resolve_artists(sp, unique_ids + unique_ids[:40])  # 重複も渡す
+
+    assert set(artists) == set(unique_ids)
+    assert redis_calls["mget"] == 1
+    assert len(sp.calls) == math.ceil(len(misses) / 50)
+    assert all(len(chunk) <= 50 for chunk in sp.calls)
+    assert [aid for chunk in sp.calls for aid in chunk] == misses
+    assert len(redis_calls["pipelines"]) == 1
+    assert redis_calls["pipelines"][0] == [f"{web.ARTIST_INFO_PREFIX}{aid}" for aid in misses]
+
+
+def test_second_call_is_served_from_the_cache(web, redis_calls):
+    artist_ids = [f"artist{index:03d}" for index in range(60)]
+    web.resolve_artists(FakeSpotify(), artist_ids)
+    redis_calls.update(mget=0, pipelines=[])
+    sp = FakeSpotify()
+
+    artists = web.resolve_artists(sp, artist_ids)
+
+    assert set(artists) == set(artist_ids)
+    assert sp.calls == []
+    assert redis_calls["mget"] == 1
+    assert redis_calls["pipelines"] == []
+    assert redis_calls["single"] == 0
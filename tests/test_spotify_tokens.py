@@ -0,0 +1,48 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import spotify_tokens
+
+
+class SlowOAuth:
+    """Spotify's token endpoint; each refresh waits until ``release`` is set."""
+
+    def __init__(self):
+        self.refreshed = []
+        self.refreshing = threading.Event()
+        self.release = threading.Event()
+
+    def refresh_access_token(self, refresh_token):
+        self.refreshed.append(refresh_token)
+        self.refreshing.set()
+        assert self.release.wait(5)
+        return {
+            "access_token": f"access-{len(self.refreshed)}",
+            "refresh_token": f"refresh-{len(self.refreshed)}",
+            "expires_at": time.time() + 3600,
+        }
+
+
+def test_concurrent_refreshes_ask_spotify_once(web, monkeypatch):
+    oauth = SlowOAuth()
+
+    def waiting(seconds):
+        oauth.release.set()  # 2人目がロック待ちに入ってから更新を終わらせる
+        time.sleep(seconds)
+
+    monkeypatch.setattr(spotify_tokens, "time", SimpleNamespace(time=time.time, sleep=waiting))
+    spotify_tokens.save_token(web.redis_client, "alice", {
+        "access_token": "access-old", "refresh_token": "refresh-old", "expires_at": time.time() - 10,
+    })
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(spotify_tokens.get_access_token, web.redis_client, oauth, "alice")
+        assert oauth.refreshing.wait(5)
+        second = pool.submit(spotify_tokens.get_access_token, web.redis_client, oauth, "alice")
+        tokens = [first.result(5), second.result(5)]
+
+    assert oauth.refreshed == ["refresh-old"]
+    assert tokens == ["access-1", "access-1"]
+    assert spotify_tokens.load_token(web.redis_client, "alice")["refresh_token"] == "refresh-1"
@@ -0,0 +1,109 @@
+import io
+import time
+
+import fakeredis
+import pytest
+
+import replicate_stub
+import template_store
+
+API_BASE = "http://localhost:5001/v1"
+
+
+class StubResponse:
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self._json = response.get_json()
+
+    def json(self):
+        return self._json
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"stub answered {self.status_code}")
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Route template uploads to the Replicate stub's ``/v1/files``; returns the uploaded file objects."""
+    stub_client = replicate_stub.stub.test_client()
+    uploaded = []
+
+    def post(url, headers, files, timeout):
+        name, content, content_type = files["content"]
+        response = StubResponse(stub_client.post(
+            url.removeprefix("http://localhost:5001"),
+            headers=headers,
+            data={"content": (io.BytesIO(content), name, content_type)},
+            content_type="multipart/form-data",
+        ))
+        uploaded.append(response.json())
+        return response
+
+    monkeypatch.setattr(template_store.http_client, "post", post)
+    return uploaded
+
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeRedis()
+
+
+def test_template_is_uploaded_once_and_the_url_reused(conn, uploads):
+    first = template_store.get_template_url(conn, "cat", API_BASE, "token")
+    second = template_store.get_template_url(conn, "cat", API_BASE, "token")
+
+    assert first == second == uploads[0]["urls"]["get"]
+    assert len(uploads) == 1
+    assert replicate_stub.files[uploads[0]["id"]].startswith(b"\x89PNG")
+
+
+def test_cached_url_lives_until_shortly_before_the_file_expires(conn, uploads):
+    template_store.get_template_url(conn, "cat", API_BASE, "token")
+    key = next(iter(conn.scan_iter(f"{template_store.TEMPLATE_FILE_PREFIX}cat:*")))
+
+    expected = 24 * 60 * 60 - template_store.TEMPLATE_FILE_REFRESH_MARGIN
+    assert expected - 5 <= conn.ttl(key) <= expected
+
+
+def test_expired_url_is_uploaded_again(conn, uploads):
+    first = template_store.get_template_url(conn, "cat", API_BASE, "token")
+    key = next(iter(conn.scan_iter(f"{template_store.TEMPLATE_FILE_PREFIX}cat:*")))
+    conn.pexpire(key, 1)  # Redis が期限で消したのと同じ状態にする
+    time.sleep(0.01)
+
+    second = template_store.get_template_url(conn, "cat", API_BASE, "token")
+
+    assert len(uploads) == 2
+    assert second != first
+    assert second == uploads[1]["urls"]["get"]
+
+
+def test_file_expiring_within_the_margin_is_not_cached(conn, uploads, monkeypatch):
+    monkeypatch.setattr(template_store, "_seconds_until", lambda expires_at: 60)
+
+    template_store.get_template_url(conn, "cat", API_BASE, "token")
+    template_store.get_template_url(conn, "cat", API_BASE, "token")
+
+    assert len(uploads) == 2
+    assert list(conn.scan_iter(f"{template_store.TEMPLATE_FILE_PREFIX}*")) == []
+
+
+def test_rejected_url_is_uploaded_again(web, uploads, monkeypatch):
+    monkeypatch.setattr(web, "TEMPLATE_UPLOADS", True)
+    monkeypatch.setattr(web, "REPLICATE_API_BASE", API_BASE)
+    card = {"animal": "cat", "template_data_uri": "data:image/png;base64,"}
+    rejected = web.template_image(card)
+
+    assert web.template_rejected(422, rejected, card)
+    replacement = web.template_image(card, refresh=True)
+
+    assert len(uploads) == 2
+    assert replacement != rejected
+    assert web.template_image(card) == replacement
+    assert not web.template_rejected(422, card["template_data_uri"], card)
+
+
+def test_missing_template_falls_back_without_uploading(conn, uploads):
+    assert template_store.get_template_url(conn, "no-such-animal", API_BASE, "token") is None
+    assert uploads == []
@@ -0,0 +1,116 @@
+import json
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import card_render
+import job_queue
+import worker
+from conftest import ROOT
+
+
+def test_spawned_render_processes_do_not_import_the_app():
+    # spawn で起動したプロセスは main スクリプトを __mp_main__ として読み直す
+    probe = "import runpy, sys; runpy.run_path('worker.py', run_name='__mp_main__'); print('app' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "False"
+
+
+def test_defaults_match_the_app_and_can_fill_the_render_queue(web):
+    assert worker.DEFAULT_QUEUES == (web.CARD_QUEUE, web.PLAYLIST_QUEUE, web.CLEANUP_QUEUE)
+    assert worker.DEFAULT_CONCURRENCY > card_render.RENDER_QUEUE_SIZE
+
+
+@pytest.fixture
+def full_pool(monkeypatch):
+    """Every render slot is taken."""
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(card_render, "_slots", slots)
+
+
+def enqueue_cards(web, count):
+    for index in range(count):
+        job_queue.enqueue(web.redis_client, web.CARD_QUEUE, "finish_card", {"prediction_id": f"pred-{index}"})
+
+
+def finishing_retry_after(web):
+    pipe = web.redis_client.pipeline()
+    web.queue_finishing_backlog(pipe)
+    return web.finishing_retry_after(*pipe.execute())
+
+
+def test_full_render_queue_defers_without_counting_an_attempt(web, monkeypatch):
+    def busy(payload):
+        raise card_render.RenderQueueFull(7)
+
+    monkeypatch.setitem(worker.JOB_HANDLERS, "finish_card", (busy, None))
+    job_queue.enqueue(web.redis_client, web.CARD_QUEUE, "finish_card", {"prediction_id": "pred-busy"})
+
+    assert not worker.process_one(web.redis_client, web.CARD_QUEUE)
+
+    assert job_queue.stats(web.redis_client, web.CARD_QUEUE) == {"ready": 0, "inflight": 0, "delayed": 1, "dead": 0}
+    delayed = job_queue.queue_keys(web.CARD_QUEUE)[2]
+    [(raw, _)] = web.redis_client.zrange(delayed, 0, -1, withscores=True)
+    assert json.loads(raw)["attempts"] == 0
+
+
+def test_full_pool_leaves_cards_queued_and_keeps_the_busy_answer(web, full_pool, monkeypatch):
+    claimed = []
+    monkeypatch.setitem(worker.JOB_HANDLERS, "finish_card", (claimed.append, None))
+    monkeypatch.setattr(web, "FINISH_BACKLOG_MAX", 10)
+    enqueue_cards(web, 100)
+    assert finishing_retry_after(web)
+
+    assert not worker.process_one(web.redis_client, web.CARD_QUEUE)
+
+    assert claimed == []
+    assert job_queue.stats(web.redis_client, web.CARD_QUEUE)["ready"] == 100
+    assert finishing_retry_after(web)
+
+
+def test_deferred_cards_count_towards_the_backlog(web, monkeypatch):
+    monkeypatch.setattr(web, "FINISH_BACKLOG_MAX", 1)
+    enqueue_cards(web, 1)
+    raw, _ = job_queue.claim(web.redis_client, web.CARD_QUEUE)
+    job_queue.defer(web.redis_client, web.CARD_QUEUE, raw, 30)
+
+    assert finishing_retry_after(web)
+
+
+def test_other_queues_are_served_while_the_pool_is_full(web, full_pool, monkeypatch):
+    published = []
+    monkeypatch.setitem(worker.JOB_HANDLERS, "publish_playlist", (published.append, None))
+    enqueue_cards(web, 3)
+    job_queue.enqueue(web.redis_client, web.PLAYLIST_QUEUE, "publish_playlist", {"prediction_id": "pred-0"})
+
+    worker._loop(web.redis_client, worker.DEFAULT_QUEUES, 0, True, threading.Event())
+
+    assert published == [{"prediction_id": "pred-0"}]
+    assert job_queue.stats(web.redis_client, web.CARD_QUEUE)["ready"] == 3
+
+
+def test_card_image_is_not_downloaded_while_the_pool_is_full(web, full_pool, monkeypatch):
+    def download(*args, **kwargs):
+        raise AssertionError("the image must not be fetched without a render slot")
+
+    monkeypatch.setattr(web.http_client, "get", download)
+
+    with pytest.raises(card_render.RenderQueueFull):
+        web.finish_card("pred-0", "http://localhost/outputs/pred-0.png", {})
+
+
+def test_unused_reserved_slot_is_given_back(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(card_render, "_slots", slots)
+
+    with card_render.reserved_slot():
+        with card_render.reserved_slot():  # 入れ子は外側の枠を使う
+            assert card_render.has_reserved_slot()
+        assert not slots.acquire(blocking=False)
+
+    assert not card_render.has_reserved_slot()
+    assert slots.acquire(blocking=False)
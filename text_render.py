@@ -0,0 +1,189 @@
+"""Styled card text (rainbow fill, round outline, drop shadow) from a glyph atlas.
+
+The card titles used to be drawn with one ``draw.text`` call per outline
+offset, i.e. about 50 FreeType renders per character.  Here every glyph is
+rasterized once per (font, size, style, colour); the outline is a
+morphological dilation of the glyph mask, the shadow is the mask itself
+moved by the shadow offset, and the finished sprite is kept in an LRU
+atlas.  Drawing a string is then one ``alpha_composite`` per character.
+
+The smoothing, tone and glow passes run on a layer cropped to the text's
+bounding box plus the blur margin, so their cost scales with the text
+area instead of the whole card.
+"""
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter, ImageFont
+
+GLYPH_ATLAS_SIZE = int(os.getenv("GLYPH_ATLAS_SIZE", "512"))
+
+TextStyle = namedtuple(
+    "TextStyle", ["outline_width", "outline_color", "shadow_offset", "shadow_color"]
+)
+
+CARD_TEXT_STYLE = TextStyle(
+    outline_width=4,
+    outline_color=(255, 255, 255, 255),  # 白
+    shadow_offset=(6, 6),  # シャドウのずらし量
+    shadow_color=(0, 0, 0, 180),  # 半透明の黒い影
+)
+
+# 🌈 虹色グラデーション
+RAINBOW_COLORS = (
+    (255, 0, 0),      # 赤
+    (255, 127, 70),   # オレンジ
+    (200, 200, 70),   # 黄
+    (100, 230, 70),   # 緑
+    (0, 0, 255),      # 青
+    (75, 0, 130),     # 藍
+    (148, 0, 211),    # 紫
+)
+
+
+@lru_cache(maxsize=32)
+def get_font(path, size):
+    """Load a TrueType font once per process, falling back to Pillow's default."""
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def _dilate(mask, radius):
+    """Grow an L-mode mask by a disk of ``radius`` pixels (max over the disk)."""
+    src = np.asarray(mask)
+    out = src.copy()
+    h, w = src.shape
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dx or dy) and dx * dx + dy * dy <= radius * radius:
+                ys, yd = (slice(0, h - dy), slice(dy, h)) if dy >= 0 else (slice(-dy, h), slice(0, h + dy))
+                xs, xd = (slice(0, w - dx), slice(dx, w)) if dx >= 0 else (slice(-dx, w), slice(0, w + dx))
+                np.maximum(out[yd, xd], src[ys, xs], out=out[yd, xd])
+    return Image.fromarray(out, "L")
+
+
+def _solid(size, color, mask, offset=(0, 0), canvas_size=None):
+    """Return an RGBA layer of ``color`` whose alpha is ``mask`` scaled by the colour's alpha."""
+    rgb, alpha = color[:3], color[3] if len(color) > 3 else 255
+    if alpha != 255:
+        mask = mask.point(lambda v: v * alpha // 255)
+    layer = Image.new("RGBA", canvas_size or size, rgb + (0,))
+    layer.paste(Image.new("RGBA", size, rgb + (255,)), offset, mask)
+    return layer
+
+
+@lru_cache(maxsize=GLYPH_ATLAS_SIZE)
+def styled_glyph(font_path, font_size, char, color, style):
+    """Return (sprite, advance) for one styled character.
+
+    The sprite's top-left corner sits ``style.outline_width`` pixels up and
+    left of the text origin; ``advance`` is the glyph's bbox width, which is
+    how the card layout has always stepped from one character to the next.
+    """
+    font = get_font(font_path, font_size)
+    pad = style.outline_width
+    sx, sy = (max(v, 0) for v in style.shadow_offset)
+    left, _, right, bottom = font.getbbox(char)
+    mask_size = (max(right + 2 * pad, 1), max(bottom + 2 * pad, 1))
+    sprite_size = (mask_size[0] + sx, mask_size[1] + sy)
+
+    mask = Image.new("L", mask_size, 0)
+    ImageDraw.Draw(mask).text((pad, pad), char, font=font, fill=255)
+
+    sprite = Image.new("RGBA", sprite_size, (0, 0, 0, 0))
+    sprite.alpha_composite(_solid(mask_size, style.shadow_color, mask, (sx, sy), sprite_size))
+    sprite.alpha_composite(_solid(mask_size, style.outline_color, _dilate(mask, pad), canvas_size=sprite_size))
+    sprite.alpha_composite(_solid(mask_size, tuple(color), mask, canvas_size=sprite_size))
+    return sprite, right - left
+
+
+def _blit(layer, sprite, x, y):
+    """alpha_composite ``sprite`` at (x, y), clipping at the layer edges."""
+    src_x, src_y = max(-x, 0), max(-y, 0)
+    right = min(sprite.width, layer.width - x)
+    bottom = min(sprite.height, layer.height - y)
+    if right <= src_x or bottom <= src_y:
+        return
+    layer.alpha_composite(sprite, (x + src_x, y + src_y), (src_x, src_y, right, bottom))
+
+
+def text_size(text, font_path, font_size):
+    """Return the (width, height) of ``text``'s bounding box."""
+    left, top, right, bottom = get_font(font_path, font_size).getbbox(text)
+    return right - left, bottom - top
+
+
+def draw_styled_text(layer, xy, text, font_path, font_size,
+                     style=CARD_TEXT_STYLE, colors=RAINBOW_COLORS):
+    """Draw ``text`` onto the RGBA ``layer`` with per-character cycling colours."""
+    x, y = xy
+    for i, char in enumerate(text):
+        color = colors[i % len(colors)] + (255,)
+        sprite, advance = styled_glyph(font_path, font_size, char, color, style)
+        _blit(layer, sprite, round(x) - style.outline_width, round(y) - style.outline_width)
+        x += advance
+    return x
+
+
+def _text_box(xy, text, font_path, font_size, style, colors):
+    """Return the (left, top, right, bottom) box covered by the styled sprites."""
+    x, y = xy
+    left = top = float("inf")
+    right = bottom = float("-inf")
+    for i, char in enumerate(text):
+        color = colors[i % len(colors)] + (255,)
+        sprite, advance = styled_glyph(font_path, font_size, char, color, style)
+        sx, sy = round(x) - style.outline_width, round(y) - style.outline_width
+        left, top = min(left, sx), min(top, sy)
+        right, bottom = max(right, sx + sprite.width), max(bottom, sy + sprite.height)
+        x += advance
+    return left, top, right, bottom
+
+
+def _contrast(img, factor, canvas_area):
+    """ImageEnhance.Contrast for a crop of a larger, otherwise transparent canvas.
+
+    The pivot is the mean luminance over the full canvas, which is what the
+    full-size layer used to produce; pixels outside the crop are black.
+    """
+    luma_sum = float(np.asarray(img.convert("L"), dtype=np.float64).sum())
+    mean = int(luma_sum / canvas_area + 0.5)
+    degenerate = Image.new("L", img.size, mean).convert(img.mode)
+    degenerate.putalpha(img.getchannel("A"))
+    return Image.blend(degenerate, img, factor)
+
+
+def draw_glowing_text(base, xy, text, font_path, font_size, brightness=1.0, contrast=1.0,
+                      glow_radius=6, glow_brightness=1.6,
+                      style=CARD_TEXT_STYLE, colors=RAINBOW_COLORS):
+    """Draw styled text with the card's SMOOTH_MORE, tone and glow passes onto ``base``.
+
+    Only the text's bounding box plus a ``3 * glow_radius`` margin is
+    allocated and filtered; the result is composited back at its offset.
+    """
+    if not text:
+        return
+    left, top, right, bottom = _text_box(xy, text, font_path, font_size, style, colors)
+    margin = 3 * glow_radius + 2
+    x0, y0 = max(left - margin, 0), max(top - margin, 0)
+    x1, y1 = min(right + margin, base.width), min(bottom + margin, base.height)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    layer = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+    draw_styled_text(layer, (xy[0] - x0, xy[1] - y0), text, font_path, font_size, style, colors)
+
+    filtered = layer.filter(ImageFilter.SMOOTH_MORE)
+    filtered = ImageEnhance.Brightness(filtered).enhance(brightness)
+    filtered = _contrast(filtered, contrast, base.width * base.height)
+
+    # 💫 glowを生成
+    glow = filtered.filter(ImageFilter.GaussianBlur(glow_radius))
+    glow = ImageEnhance.Brightness(glow).enhance(glow_brightness)
+
+    base.alpha_composite(glow, (x0, y0))
+    base.alpha_composite(filtered, (x0, y0))
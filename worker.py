@@ -0,0 +1,181 @@
+"""Background worker that drains the Music Monster job queues.
+
+Usage (from the repository root, with the same environment as the app):
+    python worker.py [--queue cards,playlists,cleanup] [--concurrency N] [--max-inflight 0] [--burst]
+
+Queues are polled in the order given, so card finishing always goes
+before the Spotify playlist of a delivered card, and both before gallery
+cleanup.
+
+Cards are rendered on ``card_render``'s process pool, so the threads
+mostly wait.  ``--concurrency`` defaults to one more thread than the
+pool's ``RENDER_QUEUE_SIZE`` slots, so the pool can fill up and a thread
+is still free for the other queues.  A ``cards`` job is only claimed
+once a render slot is held: while the pool is full the cards stay queued
+and the threads go on to the other queues.  A card that still finds the
+pool full is put back for the pool's ``retry_after`` without counting as
+a failed attempt.
+
+The render processes are spawned, and every spawned process imports this
+script again as ``__mp_main__``; ``app`` is therefore imported on first
+use, not at the top, so the render processes do not build the Flask app.
+
+``--burst`` processes whatever is queued and exits, which is handy when
+running against a local Redis.  ``run_worker`` accepts any redis-py
+compatible connection, so it can also be driven in-process with fakeredis.
+"""
+import argparse
+import os
+import threading
+import time
+import traceback
+
+import card_render
+import job_queue
+
+POLL_INTERVAL_SECONDS = 0.5
+DEFAULT_QUEUES = ("cards", "playlists", "cleanup")  # app.CARD_QUEUE, PLAYLIST_QUEUE, CLEANUP_QUEUE
+RENDER_QUEUES = {"cards"}  # ジョブを取る前に仕上げプールの枠を確保するキュー
+# 仕上げの枠（実行中＋待ち）が全部埋まっても playlists・cleanup を回すスレッドが1本残る
+DEFAULT_CONCURRENCY = card_render.RENDER_QUEUE_SIZE + 1
+
+
+def _app():
+    import app
+    return app
+
+
+def handle_finish_card(payload):
+    _app().run_finish_card_job(payload)
+
+
+def dead_finish_card(payload, error):
+    _app().set_card_status(payload["prediction_id"], "failed", error=str(error)[:200])
+
+
+def handle_publish_playlist(payload):
+    _app().run_publish_playlist_job(payload)
+
+
+def dead_publish_playlist(payload, error):
+    _app().fail_source_playlist(payload["prediction_id"], error)
+
+
+def handle_cleanup_card(payload):
+    _app().run_cleanup_card_job(payload)
+
+
+def handle_expire_playlist(payload):
+    _app().run_expire_playlist_job(payload)
+
+
+# job type -> (handler, called once the job is dead-lettered)
+JOB_HANDLERS = {
+    "finish_card": (handle_finish_card, dead_finish_card),
+    "publish_playlist": (handle_publish_playlist, dead_publish_playlist),
+    "cleanup_card": (handle_cleanup_card, None),
+    "expire_playlist": (handle_expire_playlist, None),
+}
+
+
+def process_one(conn, queue, max_inflight=0):
+    """Claim and run one job; return False when there was nothing to do.
+
+    Jobs of ``RENDER_QUEUES`` are only claimed once a render slot is held,
+    so while the pool is full they stay queued (and counted by the 503
+    gate) and the loop moves on to the other queues.
+    """
+    if queue not in RENDER_QUEUES:
+        return _run_one(conn, queue, max_inflight)
+    try:
+        with card_render.reserved_slot():
+            return _run_one(conn, queue, max_inflight)
+    except card_render.RenderQueueFull:
+        return False
+
+
+def _run_one(conn, queue, max_inflight):
+    claimed = job_queue.claim(conn, queue, max_inflight=max_inflight)
+    if not claimed:
+        return False
+    raw, job = claimed
+    handler, on_dead = JOB_HANDLERS.get(job["type"], (None, None))
+    started = time.time()
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job type: {job['type']}")
+        handler(job["payload"])
+    except card_render.RenderQueueFull as busy:
+        # 仕上げのプロセスプールが満杯: 失敗回数に数えずに後で回す
+        job_queue.defer(conn, queue, raw, busy.retry_after)
+        print(f"⏳ Job deferred {busy.retry_after}s, render queue full: {job['type']} {job['id']}")
+        return False  # 何も進んでいないので、次のキューへ進んで待つ
+    except Exception as error:
+        traceback.print_exc()
+        if job_queue.fail(conn, queue, raw, job, error):
+            print(f"💀 Job dead-lettered: {job['type']} {job['id']} ({error})")
+            if on_dead:
+                on_dead(job["payload"], error)
+        else:
+            print(f"🔁 Job will be retried: {job['type']} {job['id']} ({error})")
+    else:
+        job_queue.complete(conn, queue, raw)
+        print(f"✅ Job done: {job['type']} {job['id']} in {time.time() - started:.1f}s")
+    return True
+
+
+def _loop(conn, queues, max_inflight, burst, stop):
+    while not stop.is_set():
+        try:
+            worked = any(process_one(conn, queue, max_inflight) for queue in queues)
+        except Exception as error:
+            # Redis が一時的に落ちていても worker 自体は止めない
+            print(f"⚠️ Worker loop error: {error}")
+            worked = False
+        if not worked:
+            if burst:
+                return
+            stop.wait(POLL_INTERVAL_SECONDS)
+
+
+def run_worker(conn=None, queues=DEFAULT_QUEUES, concurrency=DEFAULT_CONCURRENCY, max_inflight=0, burst=False):
+    """Run ``concurrency`` worker threads until interrupted (or the queues drain in burst mode)."""
+    conn = conn or _app().redis_client
+    if isinstance(queues, str):
+        queues = [queue.strip() for queue in queues.split(",") if queue.strip()]
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_loop, args=(conn, queues, max_inflight, burst, stop), daemon=True)
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    print(
+        f"🛠️ Worker started: queues={','.join(queues)} concurrency={concurrency} "
+        f"render_processes={card_render.RENDER_PROCESSES} render_queue={card_render.RENDER_QUEUE_SIZE}"
+    )
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Music Monster background worker")
+    parser.add_argument("--queue", default=",".join(DEFAULT_QUEUES),
+                        help="comma-separated queues, highest priority first")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("WORKER_CONCURRENCY") or DEFAULT_CONCURRENCY))
+    parser.add_argument("--max-inflight", type=int, default=int(os.getenv("WORKER_MAX_INFLIGHT", "0")),
+                        help="cap on jobs running across all workers (0 = no cap)")
+    parser.add_argument("--burst", action="store_true", help="exit once the queue is empty")
+    args = parser.parse_args()
+    run_worker(
+        queues=args.queue,
+        concurrency=args.concurrency,
+        max_inflight=args.max_inflight,
+        burst=args.burst,
+    )